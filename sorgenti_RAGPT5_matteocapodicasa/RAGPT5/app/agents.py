@@ -1,10 +1,37 @@
 import os
 import json
-from openai import OpenAI
-from tools import ensure_policy_parameters, ensure_sar
+import time
+import asyncio
+import threading
+from types import SimpleNamespace
+from openai import OpenAI, AsyncOpenAI, APITimeoutError, RateLimitError
+from tools import ensure_policy_parameters, ensure_sar, read_entities, environment_index, ENTITY_TYPES
+from classifier import classify_nlacp, environment_matcher, IDENTIFY_FASTPATH_MIN_CONFIDENCE
+from cache import CACHE, LLM_CACHE, cache_key
+from hedging import LATENCY, call_hedged, acall_hedged
+from runs import RunCancelled
+from metrics import LLM_CALLS, LLM_IN_FLIGHT, TOKENS, HEDGES, VERIFIER, FUSED, FIRST_RULE, QUEUE_WAIT, LLM_SECONDS
+from ratelimit import LIMITER, estimate_tokens
+from jsonstream import ArrayItemStream
 
 
 MODEL = os.getenv("MODEL", "gpt-5")
+# timeout della singola chiamata quando la richiesta non ha una deadline
+LLM_CALL_TIMEOUT = float(os.getenv("LLM_CALL_TIMEOUT", "600"))
+# Step 3: "local" = solo rank_entities in processo, "rerank" = shortlist locale riordinata dall'LLM
+RETRIEVE_MODE = os.getenv("RETRIEVE_MODE", "local")
+RETRIEVE_K = int(os.getenv("RETRIEVE_K", "5"))
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "10"))
+# generate/refine in streaming quando la run ha un logger (/api/log): ogni regola esce appena chiusa
+LLM_STREAM = os.getenv("LLM_STREAM", "on").strip().lower() not in ("0", "off", "false", "no")
+# Step 6: "patch" = solo le regole segnalate dal verifier (issues con indice e campo), "full" = policy intera
+REFINE_MODE = os.getenv("REFINE_MODE", "patch").strip().lower()
+RULE_FIELDS = ("decision", "subject", "action", "resource", "purpose", "condition")
+# Layout dei messaggi per il prefix caching del provider: prima il contenuto statico (guardrail e
+# istruzioni dello step, poi il vocabolario dell'environment), per ultimo il JSON della run.
+# Il vocabolario dell'environment va sempre in generate/refine/patch, tagliato a PROMPT_VOCAB_MAX_CHARS
+# (0 = mai) sempre allo stesso modo, così il prefisso resta identico tra le run.
+PROMPT_VOCAB_MAX_CHARS = int(os.getenv("PROMPT_VOCAB_MAX_CHARS", "6000"))
 
 from prompts import (
     SYS_PREPROCESS,
@@ -12,99 +39,531 @@ from prompts import (
     SYS_RETRIEVE,
     SYS_GENERATE,
     SYS_VERIFY,
-    SYS_REFINE
+    SYS_REFINE,
+    SYS_PATCH,
+    SYS_FUSED
 )
 
 client = OpenAI()
+aclient = AsyncOpenAI()
+
+# dopo il fork ogni worker apre i propri pool di connessioni
+def reset_clients():
+    global client, aclient
+    client = OpenAI()
+    aclient = AsyncOpenAI()
+
+
+# campi dello state che ogni step manda al modello (mai env_data, id o contatori)
+STATE_PROJECTION = {
+    "preprocess": ("input_text",),
+    "fused": ("input_text",),
+    "identify": ("text_preproc",),
+    "retrieve": ("text_preproc",),
+    "generate": ("text_preproc", "env_var"),
+    "refine": ("text_preproc", "env_var", "policy_json", "verifier_output"),
+    "patch": ("text_preproc", "env_var"),
+    "verify": ("text_preproc", "policy_json"),
+}
+
+def project_state(state, step):
+    return {k: state.get(k) for k in STATE_PROJECTION[step]}
+
+# env -> (sections da cui è stato costruito, messaggio); rifatto se l'environment cambia
+_vocab_memo = {}
+
+# voci a turno tra i tipi finché stanno in budget caratteri (virgolette, escape e separatore compresi):
+# il taglio dipende solo dall'environment e non si serializza mai più del necessario
+def _capped_vocab(sections, budget):
+    items = {t: list(sections.get(t, [])) for t in ENTITY_TYPES}
+    out = {t: [] for t in ENTITY_TYPES}
+    budget -= len(json.dumps(out))
+    for i in range(max(map(len, items.values()), default=0)):
+        for t in ENTITY_TYPES:
+            if i < len(items[t]):
+                x = items[t][i]
+                budget -= len(x) + 4 + x.count('"') + x.count("\\")
+                if budget < 0:
+                    return out, True
+                out[t].append(x)
+    return out, False
+
+def _vocab_message(env):
+    sections = read_entities(env)
+    memo = _vocab_memo.get(env)
+    if memo is None or memo[0] is not sections:
+        header = ("ENVIRONMENT VOCABULARY{}. Rules are snapped to state.env_var when it has entries, otherwise to "
+                  "these lists; values for subject/action/resource/purpose/condition come ONLY from them:\n")
+        budget = PROMPT_VOCAB_MAX_CHARS - len(header) - len(" (truncated)")
+        vocab, truncated = _capped_vocab(sections, budget)
+        content = header.format(" (truncated)" if truncated else "") + json.dumps(vocab, ensure_ascii=False)
+        memo = (sections, content)
+        _vocab_memo[env] = memo
+    return memo[1]
+
+# vocabolario su cui si snappano le regole (tools._snap_index): state.env_var se ha almeno una voce,
+# altrimenti None = l'intero environment, come dice il messaggio del vocabolario
+def _snap_vocab(state):
+    vocab = state.get("env_var")
+    return vocab if isinstance(vocab, dict) and any(vocab.values()) else None
+
+# [istruzioni, vocabolario?, dati della run]: i primi due sono identici per tutte le run dello stesso step ed environment
+def build_messages(system_prompt, payload, env=None):
+    messages = [{"role": "system", "content": system_prompt}]
+    vocab = _vocab_message(env) if env is not None and PROMPT_VOCAB_MAX_CHARS > 0 else None
+    if vocab is not None:
+        messages.append({"role": "system", "content": vocab})
+    messages.append({"role": "user", "content": json.dumps(payload, ensure_ascii=False)})
+    return messages
+
+# token per step, accumulati in state["usage"] e restituiti nel payload finale
+def _step_usage(state, step):
+    return state.setdefault("usage", {}).setdefault(step or "unknown", {
+        "calls": 0, "cache_hits": 0, "prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0, "queue_ms": 0.0
+    })
+
+# token del prompt serviti dalla cache di prefissi del provider (usage.prompt_tokens_details.cached_tokens)
+def cached_tokens(usage):
+    details = getattr(usage, "prompt_tokens_details", None)
+    return getattr(details, "cached_tokens", None) or 0
+
+def record_usage(state, step, usage, started=None):
+    per_step = _step_usage(state, step)
+    per_step["calls"] += 1
+    env = state.get("env", "")
+    cached = 0
+    if usage is not None:
+        prompt = getattr(usage, "prompt_tokens", None) or 0
+        completion = getattr(usage, "completion_tokens", None) or 0
+        cached = cached_tokens(usage)
+        per_step["prompt_tokens"] += prompt
+        per_step["completion_tokens"] += completion
+        per_step["cached_tokens"] += cached
+        TOKENS.inc(prompt, step=step or "unknown", env=env, kind="prompt")
+        TOKENS.inc(completion, step=step or "unknown", env=env, kind="completion")
+        TOKENS.inc(cached, step=step or "unknown", env=env, kind="cached")
+    if started is not None:
+        LLM_SECONDS.observe(time.time() - started, step=step or "unknown", env=env,
+                            prefix_cache="hit" if cached else "miss")
+
+
+# budget di chiamate condiviso tra gli statement di una stessa richiesta (fan-out)
+class CallBudget:
+    def __init__(self, used=0):
+        self.used = used
+        self._lock = threading.Lock()
+
+    def take(self, limit):
+        with self._lock:
+            if self.used >= limit:
+                return False
+            self.used += 1
+            return True
+
+def calls_used(state):
+    budget = state.get("budget")
+    return budget.used if budget is not None else state["n_calls"]
+
+def deadline_passed(state):
+    deadline = state.get("deadline")
+    if deadline is not None and time.time() >= deadline:
+        state["deadline_exceeded"] = True
+        return True
+    return False
 
+def cancelled(state):
+    cancel = state.get("cancel")
+    return cancel is not None and cancel.is_set()
 
 def check_limits(state):
-    if state["n_calls"] >= state.get("max_calls", 12) or state["n_iter"] > state.get("max_iter", 3):
+    if calls_used(state) >= state.get("max_calls", 12) or state["n_iter"] > state.get("max_iter", 3) \
+            or deadline_passed(state) or cancelled(state):
         state["complete"] = True
         return True
     return False
 
-def call_model(state, messages, logger=None):
-    if check_limits(state):
+# il timeout di ogni chiamata è il tempo che resta alla richiesta
+def call_timeout(state):
+    deadline = state.get("deadline")
+    if deadline is None:
+        return LLM_CALL_TIMEOUT
+    return max(deadline - time.time(), 0.001)
+
+# una risposta in cache non consuma n_calls: viene contata a parte in n_cache_hits
+def _cacheable(state, key):
+    return key is not None and LLM_CACHE and not state.get("cache_bypass")
+
+def _cache_lookup(state, key, logger, step):
+    if not _cacheable(state, key):
+        return None
+    return _cache_hit(state, CACHE.get(key), logger, step)
+
+# CACHE.get può leggere e scrivere SQLite: nelle coroutine va fuori dal loop
+async def _acache_lookup(state, key, logger, step):
+    if not _cacheable(state, key):
+        return None
+    return _cache_hit(state, await asyncio.to_thread(CACHE.get, key), logger, step)
+
+def _cache_hit(state, content, logger, step):
+    if content is None:
+        return None
+    try:
+        result = json.loads(content)
+    except ValueError:
         return None
 
+    state["n_cache_hits"] = state.get("n_cache_hits", 0) + 1
+    _step_usage(state, step)["cache_hits"] += 1
+    LLM_CALLS.inc(step=step, outcome="cache_hit")
+    if logger:
+        logger({"event": "llm_cache_hit", "step": step, "response_head": content[:200]})
+    return result
+
+# parte comune di call_model / call_model_async prima della chiamata
+def _call_begin(state, messages, logger, step):
+    budget = state.get("budget")
+    if budget is not None and not budget.take(state.get("max_calls", 12)):
+        state["complete"] = True
+        return False
     state["n_calls"] += 1
+    LLM_IN_FLIGHT.inc()
 
     if logger:
         logger({
             "event": "llm_call_start",
+            "step": step,
             "model": MODEL,
             "messages": len(messages),
             "sys_len": len(messages[0]["content"]) if messages and messages[0]["role"]=="system" else 0,
             "user_len": sum(len(m.get("content","")) for m in messages if m.get("role")=="user")
         })
+    return True
+
+# attesa nello scheduler rate limit (ratelimit.py), riportata per ogni chiamata
+def _admit(state, messages):
+    return LIMITER.acquire(estimate_tokens(messages), state.get("priority"), state.get("deadline"), state.get("cancel"))
+
+async def _aadmit(state, messages):
+    return await LIMITER.aacquire(estimate_tokens(messages), state.get("priority"), state.get("deadline"),
+                                  state.get("cancel"))
+
+def _admitted(state, ticket, logger, step):
+    if not LIMITER.enabled:
+        return
+    per_step = _step_usage(state, step)
+    per_step["queue_ms"] = round(per_step["queue_ms"] + ticket.wait_ms, 3)
+    QUEUE_WAIT.observe(ticket.wait_ms / 1000, step=step or "unknown", priority=state.get("priority") or "default")
+    if logger:
+        logger({"event": "llm_call_admitted", "step": step, "queue_ms": round(ticket.wait_ms, 1),
+                "tokens_est": ticket.tokens})
+
+# parte comune dopo la risposta: usage, parsing del JSON, scrittura in cache
+def _call_end(state, response, logger, step, key=None, started=None):
+    result, content = _call_result(state, response, logger, step, started)
+    if result is not None and LLM_CACHE and key is not None:
+        CACHE.put(key, content)
+    return result
+
+async def _acall_end(state, response, logger, step, key=None, started=None):
+    result, content = _call_result(state, response, logger, step, started)
+    if result is not None and LLM_CACHE and key is not None:
+        await asyncio.to_thread(CACHE.put, key, content)
+    return result
+
+# (risposta parsata, testo) oppure (None, None)
+def _call_result(state, response, logger, step, started):
+    record_usage(state, step, getattr(response, "usage", None), started)
+    if logger and getattr(response, "usage", None):
+        usage = response.usage
+        logger({
+            "event":"llm_call_usage",
+            "step":step,
+            "prompt_tokens":getattr(usage,"prompt_tokens",None),
+            "completion_tokens":getattr(usage,"completion_tokens",None),
+            "cached_tokens":cached_tokens(usage),
+            "total_tokens":getattr(usage,"total_tokens",None)
+        })
 
-    try:
-        response = client.chat.completions.create(
-            model=MODEL,
-            response_format={"type": "json_object"},
-            messages=messages
-        )
-
-        if logger and getattr(response, "usage", None):
-            usage = response.usage
-            logger({
-                "event":"llm_call_usage",
-                "prompt_tokens":getattr(usage,"prompt_tokens",None),
-                "completion_tokens":getattr(usage,"completion_tokens",None),
-                "total_tokens":getattr(usage,"total_tokens",None)
-            })
-
-        if not getattr(response, "choices", None) or not response.choices:
-            if logger: logger({"event":"empty_completion"})
-            state["complete"] = True
-            return None
-
-        msg = response.choices[0].message
-        content = (msg.content or "")
+    if not getattr(response, "choices", None) or not response.choices:
+        if logger: logger({"event":"empty_completion"})
+        LLM_CALLS.inc(step=step, outcome="empty")
+        state["complete"] = True
+        return None, None
 
-        if logger:
-            logger({"event": "llm_call_preview", "response_head": content[:200]})
+    msg = response.choices[0].message
+    content = (msg.content or "")
 
-        try:
-            result = json.loads(content) if content else {}
-        except Exception:
-            if logger:
-                logger({"event": "json_parse_error", "ok": False, "response_head": content[:200]})
-            state["complete"] = True
-            return None
+    if logger:
+        logger({"event": "llm_call_preview", "response_head": content[:200]})
 
+    try:
+        result = json.loads(content) if content else {}
+    except Exception:
         if logger:
-            logger({"event": "llm_call_end", "ok": True})
+            logger({"event": "json_parse_error", "ok": False, "response_head": content[:200]})
+        LLM_CALLS.inc(step=step, outcome="parse_error")
+        state["complete"] = True
+        return None, None
 
-        return result
+    LLM_CALLS.inc(step=step, outcome="ok")
 
-    except Exception as e:
+    if logger:
+        logger({"event": "llm_call_end", "ok": True})
+
+    return result, content
+
+def _hedge_logger(state, logger, step):
+    def on_hedge(after):
+        state["hedges_fired"] = state.get("hedges_fired", 0) + 1
+        HEDGES.inc(step=step, result="fired")
         if logger:
-            logger({"event": "llm_call_exception", "error": repr(e)})
+            logger({"event": "llm_hedge_fired", "step": step, "after_ms": int(after * 1000)})
+    return on_hedge
+
+# il duplicato passa dal budget di chiamate e dal rate limiter come la chiamata principale;
+# False = niente duplicato (budget finito)
+def _hedge_budget(state):
+    budget = state.get("budget")
+    if budget is not None:
+        return budget.take(state.get("max_calls", 12))
+    return state["n_calls"] < state.get("max_calls", 12)
+
+def _hedge_admission(state, messages):
+    def admit(attempt):
+        if not _hedge_budget(state):
+            return False
+        attempt.ticket = LIMITER.acquire(estimate_tokens(messages), state.get("priority"), state.get("deadline"),
+                                         attempt.cancel)
+        return True
+    return admit
+
+def _ahedge_admission(state, messages):
+    async def admit(attempt):
+        if not _hedge_budget(state):
+            return False
+        attempt.ticket = await LIMITER.aacquire(estimate_tokens(messages), state.get("priority"),
+                                                state.get("deadline"), attempt.cancel)
+        return True
+    return admit
+
+# losers: tentativi ammessi che hanno perso; contano come chiamate e il loro usage (se arrivato) va nei totali
+def _call_done(state, logger, step, started, hedged, won, losers=()):
+    LATENCY.record(step, time.time() - started)
+    if hedged:
+        state["n_calls"] += 1
+    for attempt in losers:
+        record_usage(state, step, attempt.usage)
+    if hedged and won:
+        state["hedges_won"] = state.get("hedges_won", 0) + 1
+        HEDGES.inc(step=step, result="won")
+    if hedged and logger:
+        logger({"event": "llm_hedge_done", "step": step, "hedge_won": won, "losers": len(losers)})
+
+def _retry_after(e, default=1.0):
+    try:
+        return float(e.response.headers.get("retry-after", default))
+    except (AttributeError, TypeError, ValueError):
+        return default
+
+def _call_failed(state, e, logger, step=None):
+    if isinstance(e, RunCancelled):
+        LLM_CALLS.inc(step=step, outcome="cancelled")
+        if logger:
+            logger({"event": "llm_call_cancelled", "step": step})
         state["complete"] = True
         return None
+    if isinstance(e, RateLimitError):
+        LIMITER.penalize(_retry_after(e))
+    timeout = isinstance(e, (APITimeoutError, TimeoutError))
+    if timeout:
+        state["timeouts"] = state.get("timeouts", 0) + 1
+        # il timeout della chiamata coincide con la deadline della richiesta
+        if state.get("deadline") is not None and state["deadline"] - time.time() < 0.05:
+            state["deadline_exceeded"] = True
+    state.setdefault("errors", []).append({"step": step, "error": repr(e), "timeout": timeout})
+    LLM_CALLS.inc(step=step, outcome="timeout" if timeout else "error")
+    if logger:
+        logger({"event": "llm_call_timeout" if timeout else "llm_call_exception", "step": step, "error": repr(e)})
+    state["complete"] = True
+    return None
 
+def call_model(state, messages, logger=None, step=None):
+    if check_limits(state):
+        return None
+    key = cache_key(MODEL, messages, step)
+    cached = _cache_lookup(state, key, logger, step)
+    if cached is not None:
+        return cached
+    if not _call_begin(state, messages, logger, step):
+        return None
+    ticket = None
+    # ogni tentativo restituisce al rate limiter i token non usati appena finisce (anche se perde)
+    def create(timeout, attempt):
+        try:
+            return _stream_attempt(messages, timeout, attempt)
+        finally:
+            LIMITER.settle(attempt.ticket if attempt.hedge else ticket, attempt.usage)
+    try:
+        try:
+            ticket = _admit(state, messages)
+            _admitted(state, ticket, logger, step)
+            started = time.time()
+            response, hedged, won, losers = call_hedged(create, call_timeout(state), LATENCY.hedge_after(step),
+                                                         on_hedge=_hedge_logger(state, logger, step),
+                                                         cancel=state.get("cancel"),
+                                                         admit_hedge=_hedge_admission(state, messages))
+        finally:
+            LLM_IN_FLIGHT.dec()
+        _call_done(state, logger, step, started, hedged, won, losers)
+        return _call_end(state, response, logger, step, key, started)
+    except Exception as e:
+        return _call_failed(state, e, logger, step)
 
+async def call_model_async(state, messages, logger=None, step=None):
+    if check_limits(state):
+        return None
+    key = cache_key(MODEL, messages, step)
+    cached = await _acache_lookup(state, key, logger, step)
+    if cached is not None:
+        return cached
+    if not _call_begin(state, messages, logger, step):
+        return None
+    ticket = None
+    async def create(timeout, attempt):
+        try:
+            response = await aclient.chat.completions.create(
+                model=MODEL,
+                response_format={"type": "json_object"},
+                messages=messages,
+                timeout=timeout
+            )
+            attempt.usage = getattr(response, "usage", None)
+            return response
+        finally:
+            await LIMITER.asettle(attempt.ticket if attempt.hedge else ticket, attempt.usage)
+    try:
+        try:
+            ticket = await _aadmit(state, messages)
+            _admitted(state, ticket, logger, step)
+            started = time.time()
+            response, hedged, won, losers = await acall_hedged(create, call_timeout(state), LATENCY.hedge_after(step),
+                                                               on_hedge=_hedge_logger(state, logger, step),
+                                                               cancel=state.get("cancel"),
+                                                               admit_hedge=_ahedge_admission(state, messages))
+        finally:
+            LLM_IN_FLIGHT.dec()
+        _call_done(state, logger, step, started, hedged, won, losers)
+        return await _acall_end(state, response, logger, step, key, started)
     except Exception as e:
-        if logger:
-            logger({"event": "llm_call_exception", "error": str(e)})
-        state["complete"] = True
+        return _call_failed(state, e, logger, step)
+
+
+# Streaming (stream=True): il testo arriva a pezzi e on_text(pezzo) lo vede subito.
+# Niente hedge; cancellazione e deadline controllate tra un chunk e l'altro.
+# Alla fine la risposta ricomposta passa da _call_end come quella non in streaming.
+def _stream_create(messages, timeout, api):
+    return api.chat.completions.create(
+        model=MODEL,
+        response_format={"type": "json_object"},
+        messages=messages,
+        timeout=timeout,
+        stream=True,
+        stream_options={"include_usage": True}
+    )
+
+def _stream_chunk(state, chunk, parts, started, timeout, on_text):
+    if cancelled(state):
+        raise RunCancelled()
+    if time.time() - started >= timeout:
+        raise TimeoutError(f"no complete response within {timeout:.1f}s")
+    text = chunk.choices[0].delta.content if chunk.choices else None
+    if text:
+        parts.append(text)
+        if on_text:
+            on_text(text)
+    return getattr(chunk, "usage", None)
+
+def _streamed_response(parts, usage):
+    choices = [SimpleNamespace(message=SimpleNamespace(content="".join(parts)))] if parts else []
+    return SimpleNamespace(choices=choices, usage=usage)
+
+# tentativo di call_model: in streaming anche se nessuno legge i pezzi, così un tentativo perso o
+# cancellato si interrompe chiudendo la connessione (hedging.Attempt) invece di restare in volo fino al timeout
+def _stream_attempt(messages, timeout, attempt):
+    parts = []
+    with attempt.bind(_stream_create(messages, timeout, client)) as stream:
+        for chunk in stream:
+            attempt.check()
+            text = chunk.choices[0].delta.content if chunk.choices else None
+            if text:
+                parts.append(text)
+            attempt.usage = getattr(chunk, "usage", None) or attempt.usage
+    # uno shutdown della connessione chiude lo stream senza errori: il testo è troncato
+    attempt.check()
+    return _streamed_response(parts, attempt.usage)
+
+def call_model_stream(state, messages, logger=None, step=None, on_text=None):
+    if check_limits(state):
+        return None
+    key = cache_key(MODEL, messages, step)
+    cached = _cache_lookup(state, key, logger, step)
+    if cached is not None:
+        return cached
+    if not _call_begin(state, messages, logger, step):
+        return None
+    try:
+        parts, usage, ticket = [], None, None
+        try:
+            ticket = _admit(state, messages)
+            _admitted(state, ticket, logger, step)
+            started, timeout = time.time(), call_timeout(state)
+            with _stream_create(messages, timeout, client) as stream:
+                for chunk in stream:
+                    usage = _stream_chunk(state, chunk, parts, started, timeout, on_text) or usage
+        finally:
+            LLM_IN_FLIGHT.dec()
+            # anche se lo stream si interrompe (rete, stop, deadline): il bucket riavrà la stima non usata
+            LIMITER.settle(ticket, usage, "".join(parts))
+        _call_done(state, logger, step, started, False, False)
+        return _call_end(state, _streamed_response(parts, usage), logger, step, key, started)
+    except Exception as e:
+        return _call_failed(state, e, logger, step)
+
+async def call_model_stream_async(state, messages, logger=None, step=None, on_text=None):
+    if check_limits(state):
+        return None
+    key = cache_key(MODEL, messages, step)
+    cached = await _acache_lookup(state, key, logger, step)
+    if cached is not None:
+        return cached
+    if not _call_begin(state, messages, logger, step):
         return None
+    try:
+        parts, usage, ticket = [], None, None
+        try:
+            ticket = await _aadmit(state, messages)
+            _admitted(state, ticket, logger, step)
+            started, timeout = time.time(), call_timeout(state)
+            async with await _stream_create(messages, timeout, aclient) as stream:
+                async for chunk in stream:
+                    usage = _stream_chunk(state, chunk, parts, started, timeout, on_text) or usage
+        finally:
+            LLM_IN_FLIGHT.dec()
+            await LIMITER.asettle(ticket, usage, "".join(parts))
+        _call_done(state, logger, step, started, False, False)
+        return await _acall_end(state, _streamed_response(parts, usage), logger, step, key, started)
+    except Exception as e:
+        return _call_failed(state, e, logger, step)
 
 
+# Ogni step è diviso in costruzione dei messaggi e applicazione della risposta,
+# condivise tra la versione sincrona (agent_*) e quella asincrona (agent_*_async).
 
 # Step 1: Pre-processing
-def agent_preprocess(state, logger=None):
-    if check_limits(state):
-        return state
-
-    messages = [
-        {"role": "system", "content": SYS_PREPROCESS},
-        {"role": "user", "content": json.dumps({"state": state}, ensure_ascii=False)}
-    ]
+def _preprocess_messages(state):
+    return build_messages(SYS_PREPROCESS, {"state": project_state(state, "preprocess")})
 
-    msg = call_model(state, messages, logger=logger)
+def _preprocess_apply(state, msg, logger):
     if msg is None:
         return state
 
@@ -115,66 +574,183 @@ def agent_preprocess(state, logger=None):
 
     return state
 
+def agent_preprocess(state, logger=None):
+    if check_limits(state):
+        return state
+    msg = call_model(state, _preprocess_messages(state), logger=logger, step="preprocess")
+    return _preprocess_apply(state, msg, logger)
 
-# Step 2: NLACP Identification
-def agent_identify(state, logger=None):
+async def agent_preprocess_async(state, logger=None):
     if check_limits(state):
         return state
+    msg = await call_model_async(state, _preprocess_messages(state), logger=logger, step="preprocess")
+    return _preprocess_apply(state, msg, logger)
+
 
-    messages = [
-        {"role": "system", "content": SYS_IDENTIFY},
-        {"role": "user", "content": json.dumps({"state": state}, ensure_ascii=False)}
-    ]
+# Step 2: NLACP Identification
+# fast-path locale: se il classificatore lessicale è sicuro si salta la chiamata al modello
+def _identify_fastpath(state, logger):
+    text = state.get("text_preproc") or state.get("input_text") or ""
+    verdict = classify_nlacp(text, environment_matcher(state.get("env", "default")))
+    if verdict["is_nlacp"] is None or verdict["confidence"] < IDENTIFY_FASTPATH_MIN_CONFIDENCE:
+        if logger:
+            logger({"event": "identify_fastpath", "decided": False,
+                    "confidence": verdict["confidence"], "reason": verdict["reason"]})
+        return False
 
-    msg = call_model(state, messages, logger=logger)
+    state["is_nlacp"] = verdict["is_nlacp"]
+    if logger:
+        logger({"event": "identify_done", "is_nlacp": state["is_nlacp"], "source": "local",
+                "confidence": verdict["confidence"], "reason": verdict["reason"]})
+    return True
+
+def _identify_messages(state):
+    return build_messages(SYS_IDENTIFY, {"state": project_state(state, "identify")})
+
+def _identify_apply(state, msg, logger):
     if msg is None:
         return state
 
     state["is_nlacp"] = bool(msg.get("is_nlacp"))
 
     if logger:
-        logger({"event": "identify_done", "is_nlacp": state["is_nlacp"]})
+        logger({"event": "identify_done", "is_nlacp": state["is_nlacp"], "source": "llm", "confidence": None})
 
     return state
 
+def agent_identify(state, logger=None):
+    if check_limits(state):
+        return state
+    if _identify_fastpath(state, logger):
+        return state
+    msg = call_model(state, _identify_messages(state), logger=logger, step="identify")
+    return _identify_apply(state, msg, logger)
 
-# Step 3: Information Retrieval
-def agent_retrieve(state, logger=None):
+async def agent_identify_async(state, logger=None):
     if check_limits(state):
         return state
+    if _identify_fastpath(state, logger):
+        return state
+    msg = await call_model_async(state, _identify_messages(state), logger=logger, step="identify")
+    return _identify_apply(state, msg, logger)
 
-    messages = [
-        {"role": "system", "content": SYS_RETRIEVE},
-        {"role": "user", "content": json.dumps({
-            "state": state,
-            "env_data": state.get("env_data", "")
-        }, ensure_ascii=False)}
-    ]
 
-    msg = call_model(state, messages, logger=logger)
+# Step 3: Information Retrieval
+# rank_entities sull'indice dell'environment, k per tipo, senza chiamare il modello
+def _retrieve_candidates(state, k):
+    index = environment_index(state.get("env", "default"))
+    query = state.get("text_preproc") or state.get("input_text") or ""
+    return {t: index.rank(t, query, k) if len(index[t]) else [] for t in ENTITY_TYPES}
+
+def _retrieve_messages(state, candidates):
+    return build_messages(SYS_RETRIEVE, {
+        "state": project_state(state, "retrieve"),
+        "candidates": candidates,
+        "k": RETRIEVE_K
+    })
+
+def _retrieve_apply(state, msg, logger, candidates, source):
+    # senza risposta del modello (o in modalità local) resta la shortlist lessicale
     if msg is None:
-        return state
-
-    retr = msg.get("env_var") or {}
-    for k in ("subjects", "actions", "resources", "purposes", "conditions"):
-        retr.setdefault(k, [])
+        source = "local"
+
+    retr = {}
+    for k in ENTITY_TYPES:
+        allowed = candidates.get(k, [])
+        if source == "llm":
+            picked = (msg.get("env_var") or {}).get(k) or []
+            retr[k] = [c for c in picked if c in allowed][:RETRIEVE_K]
+        else:
+            retr[k] = allowed[:RETRIEVE_K]
     state["env_var"] = retr
 
     if logger:
         logger({
             "event": "retrieve_done",
+            "source": source,
             "subjects": retr.get("subjects"),
             "actions": retr.get("actions")
         })
 
     return state
 
+def agent_retrieve(state, logger=None):
+    if check_limits(state):
+        return state
+    if RETRIEVE_MODE != "rerank":
+        return _retrieve_apply(state, None, logger, _retrieve_candidates(state, RETRIEVE_K), "local")
+    candidates = _retrieve_candidates(state, RERANK_CANDIDATES)
+    msg = call_model(state, _retrieve_messages(state, candidates), logger=logger, step="retrieve")
+    return _retrieve_apply(state, msg, logger, candidates, "llm")
 
-# Step 4 & 4.1: ACP Generation & Post-Processing ( o Step 6 se presente feedback)
-def agent_generate(state, logger=None, attack=None):
+async def agent_retrieve_async(state, logger=None):
+    if check_limits(state):
+        return state
+    if RETRIEVE_MODE != "rerank":
+        return _retrieve_apply(state, None, logger, _retrieve_candidates(state, RETRIEVE_K), "local")
+    candidates = _retrieve_candidates(state, RERANK_CANDIDATES)
+    msg = await call_model_async(state, _retrieve_messages(state, candidates), logger=logger, step="retrieve")
+    return _retrieve_apply(state, msg, logger, candidates, "llm")
+
+
+# Step 1–3 fusi (mode=fused): una sola chiamata per text_preproc, is_nlacp ed env_var.
+# Se la risposta non passa la validazione lo state resta com'era e la pipeline fa i tre step classici.
+def _fused_messages(state, candidates):
+    return build_messages(SYS_FUSED, {
+        "state": project_state(state, "fused"),
+        "candidates": candidates,
+        "k": RETRIEVE_K
+    })
+
+def validate_fused(msg, candidates):
+    if not isinstance(msg, dict):
+        return None, "no answer"
+    text = msg.get("text_preproc")
+    if not isinstance(text, str) or not text.strip():
+        return None, "missing text_preproc"
+    if not isinstance(msg.get("is_nlacp"), bool):
+        return None, "missing is_nlacp"
+    env_var = msg.get("env_var")
+    if env_var is None and not msg["is_nlacp"]:
+        env_var = {}
+    if not isinstance(env_var, dict) or any(not isinstance(env_var.get(t, []), list) for t in ENTITY_TYPES):
+        return None, "malformed env_var"
+
+    retr = {t: [c for c in env_var.get(t, []) if c in candidates.get(t, [])][:RETRIEVE_K] for t in ENTITY_TYPES}
+    if msg["is_nlacp"] and not any(retr[t] for t in ("subjects", "actions", "resources")):
+        return None, "no subject, action or resource from candidates"
+    return {"text_preproc": text.strip(), "is_nlacp": msg["is_nlacp"], "env_var": retr}, ""
+
+def _fused_apply(state, msg, logger, candidates):
+    fused, reason = validate_fused(msg, candidates)
+    state["front"] = {"mode": "fused", "fallback": fused is None, "reason": reason}
+    FUSED.inc(outcome="fallback" if fused is None else "ok")
+    if fused is not None:
+        state.update(fused)
+
+    if logger:
+        logger({"event": "fused_done", "ok": fused is not None, "reason": reason,
+                "text_preproc": state.get("text_preproc"), "is_nlacp": state.get("is_nlacp"),
+                "subjects": state["env_var"].get("subjects"), "actions": state["env_var"].get("actions")})
+    return state
+
+def agent_fused(state, logger=None):
     if check_limits(state):
         return state
+    candidates = _retrieve_candidates(state, RERANK_CANDIDATES)
+    msg = call_model(state, _fused_messages(state, candidates), logger=logger, step="fused")
+    return _fused_apply(state, msg, logger, candidates)
+
+async def agent_fused_async(state, logger=None):
+    if check_limits(state):
+        return state
+    candidates = _retrieve_candidates(state, RERANK_CANDIDATES)
+    msg = await call_model_async(state, _fused_messages(state, candidates), logger=logger, step="fused")
+    return _fused_apply(state, msg, logger, candidates)
+
 
+# Step 4 & 4.1: ACP Generation & Post-Processing ( o Step 6 se presente feedback)
+def _generate_messages(state, logger):
     verifier = state.get("verifier_output") or {}
     has_verified = state.get("has_verified", False) 
     v_status = (verifier.get("status", "") or "").strip().lower()  
@@ -184,8 +760,14 @@ def agent_generate(state, logger=None, attack=None):
     if refine_mode:
         state["n_iter"] += 1
         if check_limits(state):
-            return state
+            return None, refine_mode, None
+        targets = _patch_targets(state)
+        if targets is not None:
+            return _patch_messages(state, targets, logger), refine_mode, targets
+    return _full_messages(state, refine_mode, logger), refine_mode, None
 
+def _full_messages(state, refine_mode, logger):
+    verifier = state.get("verifier_output") or {}
     system_prompt = SYS_REFINE if refine_mode else SYS_GENERATE
     if logger:
         logger({"event": "gen_mode",
@@ -196,34 +778,117 @@ def agent_generate(state, logger=None, attack=None):
                     or (verifier.get("error") if refine_mode else ""))
 
     user_content = {
-        "state": state,
-        "env_data": state.get("env_data", ""),
+        "state": project_state(state, "refine" if refine_mode else "generate"),
         "feedback": feedback_val
     }
 
-    messages = [
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": json.dumps(user_content, ensure_ascii=False)}
-    ]
+    return build_messages(system_prompt, user_content, state.get("env", "default"))
+
+# indici delle regole da correggere con una patch; None = refine dell'intera policy
+# (REFINE_MODE=full, feedback libero, issues assenti o non legate a una regola, es. missing_acrs)
+def _patch_targets(state):
+    issues = (state.get("verifier_output") or {}).get("issues") or []
+    if REFINE_MODE != "patch" or state.get("feedback") or not issues:
+        return None
+    if any(issue["index"] is None for issue in issues):
+        return None
+    return sorted({issue["index"] for issue in issues})
+
+def _patch_messages(state, targets, logger):
+    rules = state.get("policy_json", {}).get("dsarcp", [])
+    issues = state["verifier_output"]["issues"]
+    if logger:
+        logger({"event": "gen_mode", "mode": "patch", "iteration": state["n_iter"],
+                "rules": targets, "rules_total": len(rules)})
+    user_content = {
+        "state": project_state(state, "patch"),
+        "rules": [{
+            "index": i,
+            "rule": rules[i],
+            "issues": [{"field": x["field"], "error": x["error"]} for x in issues if x["index"] == i],
+        } for i in targets]
+    }
+    return build_messages(SYS_PATCH, user_content, state.get("env", "default"))
+
+# only: {indice: campi} -> snap solo dei campi cambiati da una patch
+def _snap_policy(state, policy_json, attack, only=None):
+    if attack:
+        return ensure_sar(
+            policy_json,
+            state.get("env", "default"),
+            vocab=_snap_vocab(state),
+            only=only)
+    return ensure_policy_parameters(
+        policy_json,
+        state.get("env", "default"),
+        vocab=_snap_vocab(state),
+        only=only
+    )
+
+# la patch tocca solo le regole in targets: campi cambiati (ri-snappati) e regole eliminate.
+# Le voci malformate si saltano; False se la patch è inutilizzabile (si rifà la refine completa)
+def _patch_apply(state, msg, targets, logger, attack):
+    if msg is None:
+        return True
+    patch = msg.get("patch", []) if isinstance(msg, dict) else None
+    if patch is None and isinstance(msg, dict):
+        patch = []
+    if not isinstance(patch, list):
+        return _patch_invalid(state, logger, "patch is not a list", 0)
+
+    rules = [dict(r) for r in state.get("policy_json", {}).get("dsarcp", [])]
+    changed, deleted = {}, set()
+    skipped = 0
+    for item in patch:
+        i = item.get("index") if isinstance(item, dict) else None
+        fields = (item.get("fields") or {}) if isinstance(item, dict) else None
+        if type(i) is not int or i not in targets or not isinstance(fields, dict):
+            skipped += 1
+            continue
+        if item.get("delete"):
+            deleted.add(i)
+            continue
+        for field, value in fields.items():
+            if field in RULE_FIELDS and isinstance(value, str) and value != rules[i].get(field):
+                rules[i][field] = value
+                changed.setdefault(i, set()).add(field)
+    if patch and skipped == len(patch):
+        return _patch_invalid(state, logger, "no valid patch entries", skipped)
+
+    policy_json = _snap_policy(state, {"dsarcp": rules}, attack, only=changed)
+    policy_json["dsarcp"] = [r for i, r in enumerate(policy_json["dsarcp"]) if i not in deleted]
+    state["policy_json"] = policy_json
+    if msg.get("feedback") is not None:
+        state["feedback"] = msg["feedback"]
+
+    if logger:
+        logger({
+            "event": "refine_done",
+            "mode": "patch",
+            "iteration": state["n_iter"],
+            "rules_count": len(policy_json["dsarcp"]),
+            "changed": {str(i): sorted(fields) for i, fields in sorted(changed.items())},
+            "deleted": sorted(deleted),
+            "skipped": skipped,
+            "feedback_used": True
+        })
+
+    return True
 
-    msg = call_model(state, messages, logger=logger)
+def _patch_invalid(state, logger, reason, skipped):
+    if logger:
+        logger({"event": "refine_patch_invalid", "iteration": state["n_iter"], "reason": reason,
+                "skipped": skipped})
+    return False
+
+def _generate_apply(state, msg, refine_mode, logger, attack):
     if msg is None:
         if not refine_mode:
             state["feedback"] = None
         return state
 
     policy_json = msg.get("policy_json") or state.get("policy_json", {"dsarcp": []})
-    if attack:
-        policy_json = ensure_sar(
-            policy_json,
-            state.get("env", "default"),
-            vocab=state.get("env_var", {}))
-    else:    
-        policy_json = ensure_policy_parameters(
-            policy_json,
-            state.get("env", "default"),
-            vocab=state.get("env_var", {})
-        )
+    policy_json = _snap_policy(state, policy_json, attack)
     state["policy_json"] = policy_json
 
     if logger:
@@ -246,42 +911,167 @@ def agent_generate(state, logger=None, attack=None):
 
     return state
 
+# eventi "rule": una regola già snappata per evento, indicizzata come in policy_json.dsarcp.
+# Durante lo streaming escono man mano che il parser chiude un oggetto; alla fine si
+# (ri)emettono solo gli indici mancanti o diversi dal risultato finale, che resta quello non in streaming.
+class RuleEmitter:
+    def __init__(self, state, logger, step, attack):
+        self.state = state
+        self.logger = logger
+        self.step = step
+        self.attack = attack
+        self.parser = ArrayItemStream(("policy_json", "dsarcp"))
+        self.started = time.time()
+        self.emitted = []
+
+    def _emit(self, index, rule, final):
+        if not self.emitted:
+            FIRST_RULE.observe(time.time() - self.started, step=self.step)
+        if index == len(self.emitted):
+            self.emitted.append(rule)
+        else:
+            self.emitted[index] = rule
+        self.logger({"event": "rule", "step": self.step, "iteration": self.state["n_iter"], "index": index,
+                     "rule": rule, "final": final, "elapsed_ms": int((time.time() - self.started) * 1000)})
+
+    def on_text(self, text):
+        for rule in self.parser.feed(text):
+            if isinstance(rule, dict):
+                snapped = _snap_policy(self.state, {"dsarcp": [rule]}, self.attack)["dsarcp"][0]
+                self._emit(len(self.emitted), snapped, False)
+
+    def finish(self, msg):
+        if msg is None:
+            if self.emitted:
+                self.logger({"event": "rules_discarded", "step": self.step, "count": len(self.emitted)})
+            return
+        rules = self.state.get("policy_json", {}).get("dsarcp", [])
+        for i, rule in enumerate(rules):
+            if i >= len(self.emitted) or self.emitted[i] != rule:
+                self._emit(i, rule, True)
+        if len(self.emitted) > len(rules):
+            self.logger({"event": "rules_discarded", "step": self.step, "count": len(self.emitted) - len(rules)})
+
+def _streaming(state, logger):
+    return logger is not None and state.get("stream", False)
+
+# una patch è piccola: niente streaming, ma in /api/log le regole escono comunque come eventi "rule".
+# False = patch inutilizzabile: il chiamante rifà la refine dell'intera policy nella stessa iterazione
+def _patched(state, msg, targets, logger, step, attack):
+    if not _patch_apply(state, msg, targets, logger, attack):
+        return False
+    if _streaming(state, logger):
+        RuleEmitter(state, logger, step, attack).finish(msg)
+    return True
 
+def agent_generate(state, logger=None, attack=None):
+    if check_limits(state):
+        return state
+    messages, refine_mode, targets = _generate_messages(state, logger)
+    if messages is None:
+        return state
+    step = "refine" if refine_mode else "generate"
+    if targets is not None:
+        msg = call_model(state, messages, logger=logger, step=step)
+        if _patched(state, msg, targets, logger, step, attack):
+            return state
+        messages = _full_messages(state, refine_mode, logger)
+    if not _streaming(state, logger):
+        msg = call_model(state, messages, logger=logger, step=step)
+        return _generate_apply(state, msg, refine_mode, logger, attack)
+    rules = RuleEmitter(state, logger, step, attack)
+    msg = call_model_stream(state, messages, logger=logger, step=step, on_text=rules.on_text)
+    _generate_apply(state, msg, refine_mode, logger, attack)
+    rules.finish(msg)
+    return state
 
+async def agent_generate_async(state, logger=None, attack=None):
+    if check_limits(state):
+        return state
+    messages, refine_mode, targets = _generate_messages(state, logger)
+    if messages is None:
+        return state
+    step = "refine" if refine_mode else "generate"
+    if targets is not None:
+        msg = await call_model_async(state, messages, logger=logger, step=step)
+        if _patched(state, msg, targets, logger, step, attack):
+            return state
+        messages = _full_messages(state, refine_mode, logger)
+    if not _streaming(state, logger):
+        msg = await call_model_async(state, messages, logger=logger, step=step)
+        return _generate_apply(state, msg, refine_mode, logger, attack)
+    rules = RuleEmitter(state, logger, step, attack)
+    msg = await call_model_stream_async(state, messages, logger=logger, step=step, on_text=rules.on_text)
+    _generate_apply(state, msg, refine_mode, logger, attack)
+    rules.finish(msg)
+    return state
 
 
 # Step 5: Verifica la correttezza della policy generata
-def agent_verify(state, logger=None):
-    if check_limits(state):
-        return state
+# issues del verifier normalizzate: index fuori dalla policy o non intero -> None, campo sconosciuto -> None
+def _verify_issues(issues, state):
+    n_rules = len(state.get("policy_json", {}).get("dsarcp", []))
+    out = []
+    for issue in issues if isinstance(issues, list) else []:
+        if not isinstance(issue, dict):
+            continue
+        index = issue.get("index")
+        valid = isinstance(index, int) and not isinstance(index, bool) and 0 <= index < n_rules
+        out.append({
+            "index": index if valid else None,
+            "field": issue.get("field") if issue.get("field") in RULE_FIELDS else None,
+            "error": str(issue.get("error") or ""),
+        })
+    return out
 
-    messages = [
-        {"role": "system", "content": SYS_VERIFY},
-        {"role": "user", "content": json.dumps({"state": state}, ensure_ascii=False)}
-    ]
+def _verify_messages(state):
+    return build_messages(SYS_VERIFY, {"state": project_state(state, "verify")})
 
-    msg = call_model(state, messages, logger=logger)
+def _verify_apply(state, msg, logger):
     if msg is None:
         state["verifier_output"] = {"status": "incorrect", "error": "verify call failed"}
         state["has_verified"] = True
+        VERIFIER.inc(env=state.get("env", ""), status="failed")
         return state
 
     report = msg.get("verifier_output") or msg.get("verifier_report") or {}
     status = report.get("status", "incorrect")
     error = report.get("error", "")
+    issues = _verify_issues(report.get("issues") or msg.get("issues"), state)
 
-    state["verifier_output"] = {"status": status, "error": error}
+    state["verifier_output"] = {"status": status, "error": error, "issues": issues}
     state["has_verified"] = True
+    VERIFIER.inc(env=state.get("env", ""), status=str(status).strip().lower())
     state["feedback"] = msg.get("feedback") or state.get("feedback")
 
     if logger:
         logger({
             "event": "verify_done",
             "status": status,
-            "error": error
+            "error": error,
+            "issues": issues
         })
 
     return state
 
+def agent_verify(state, logger=None):
+    if check_limits(state):
+        return state
+    msg = call_model(state, _verify_messages(state), logger=logger, step="verify")
+    return _verify_apply(state, msg, logger)
 
-
+async def agent_verify_async(state, logger=None):
+    if check_limits(state):
+        return state
+    msg = await call_model_async(state, _verify_messages(state), logger=logger, step="verify")
+    return _verify_apply(state, msg, logger)
+
+
+ASYNC_AGENTS = {
+    agent_preprocess: agent_preprocess_async,
+    agent_identify: agent_identify_async,
+    agent_retrieve: agent_retrieve_async,
+    agent_generate: agent_generate_async,
+    agent_verify: agent_verify_async,
+    agent_fused: agent_fused_async,
+}
@@ -1,74 +1,117 @@
 import os
 import json
 import time
-import uuid
+import threading
 import traceback
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from flask import Flask, request, jsonify, render_template, Response, stream_with_context
-from agents import (
-    agent_preprocess,
-    agent_identify,
-    agent_retrieve,
-    agent_generate,
-    agent_verify
+from environments import ENV_PRELOAD, REGISTRY
+from cache import CACHE
+from ratelimit import LIMITER
+from decision import POLICIES, InvalidRequest, PolicyEngine
+from policystore import STORE
+from agents import calls_used
+from runs import RUNS, RunIdInUse
+from runlog import RUNLOGS, RUN_LOG_KEEPALIVE, parse_event_id
+from metrics import METRICS, CONTENT_TYPE
+from pipeline import (
+    MAX_ITER,
+    MAX_CALLS,
+    PIPELINE_MODE,
+    init_state,
+    finish_payload,
+    run_steps,
+    run_pipeline
 )
 
 APP_NAME = "RAGPT5"
 MODEL = os.getenv("MODEL", "gpt-5")
-MAX_ITER = int(os.getenv("MAX_ITER", "3"))
-MAX_CALLS = int(os.getenv("MAX_CALLS", "12"))
-STOP_REQUESTED = False
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "32"))
 
 app = Flask(__name__)
 
-def overdo(state):
-    hit = state["complete"] \
-          or state["n_calls"] >= state.get("max_calls", MAX_CALLS) or state["n_iter"] >= state.get("max_iter", MAX_ITER)
-    if hit:
-        state["complete"] = True
-    return hit
-    
+# environment fissati (ENV_PINNED) e precaricati (ENV_PRELOAD) indicizzati prima della prima richiesta
+REGISTRY.warmup()
+REGISTRY.warmup([n for n in ENV_PRELOAD if n not in REGISTRY.pinned], pin=False)
+
+# testo dell'environment dallo snapshot condiviso del registry (niente I/O per richiesta)
 def load_environment_data(env_name):
-    filename = f"data/{env_name}.txt"
-    if not os.path.exists(filename):
-        raise FileNotFoundError(f"File {filename} non trovato")
-    with open(filename, "r", encoding="utf-8") as f:
-        return f.read()
-
-def init_state(text, environment, env_data=""):
-    return {
-        "id": str(uuid.uuid4()),
-        "env": environment,
-        "env_data": env_data,
-        "input_text": text,
-        "text_preproc": None,
-        "is_nlacp": None,
-        "env_var": {"subjects": [], "actions": [], "resources": [], "purposes": [], "conditions": []},
-        "policy_json": {"dsarcp": []},
-        "verifier_output": {"status": "unknown", "error": ""},
-        "has_verified": False,
-        "n_iter": 0,
-        "n_calls": 0,
-        "max_iter": MAX_ITER,     
-        "max_calls": MAX_CALLS,   
-        "complete": False,
-        "feedback": None
-    }
-
-def finish_payload(state, start_time):
-    elapsed = int((time.time() - start_time) * 1000)
-    return {
-        "dsarcp": state.get("policy_json", {}).get("dsarcp", []),
-        "verifier_output": state.get("verifier_output"),
-        "n_iter": state.get("n_iter"),
-        "n_calls": state.get("n_calls"),
-        "complete": state.get("complete"),
-        "env": state.get("env"),
-        "id": state.get("id"),
-        "elapsed_ms": elapsed
-    }
-
-def sse(event, data):
-    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+    return REGISTRY.get(env_name).text
+
+# esito dell'ingest nello store da allegare al payload: conteggi e hash delle relazioni nuove
+def store_summary(result):
+    return {k: result[k] for k in ("added", "duplicates", "conflicts", "subsumptions")}
+
+def parse_flag(value):
+    return str(value or "false").strip().lower() in ("1", "true", "yes", "on")
+
+# timeout_ms della richiesta -> secondi (None = REQUEST_TIMEOUT)
+def parse_timeout(value):
+    try:
+        ms = float(value)
+    except (TypeError, ValueError):
+        return None
+    return ms / 1000.0 if ms > 0 else None
+
+# "classic" | "fused" (None = PIPELINE_MODE)
+def parse_mode(value):
+    return (value or "").strip().lower() or None
+
+def sse(event, data, event_id=None):
+    head = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{head}event: {event}\ndata: {json.dumps(data)}\n\n"
+
+# le regole snappate in streaming hanno un tipo di evento SSE proprio
+def log_event_name(data):
+    return "rule" if data.get("event") == "rule" else "log"
+
+# eventi del log di una run con seq > last; gli eventi usciti dal ring buffer sono segnalati con "gap"
+def sse_since(runlog, events, missed):
+    chunks = [sse("log", {"msg": "gap", "id": runlog.run_id, "missed": missed})] if missed else []
+    chunks.extend(sse(event, data, f"{runlog.run_id}:{seq}") for seq, event, data in events)
+    return chunks
+
+# logger della pipeline che scrive nel log della run
+def run_logger(state, runlog):
+    def log(event):
+        event["time"] = int(time.time() * 1000)
+        event["iter"] = state["n_iter"]
+        event["calls"] = calls_used(state)
+        runlog.append(log_event_name(event), event)
+    return log
+
+# run /api/log in background: gli eventi restano nel log anche se il client si disconnette
+def run_logged(state, runlog, attack):
+    start_time = time.time()
+    try:
+        for _ in run_steps(state, logger=run_logger(state, runlog), attack=attack):
+            pass
+        payload = finish_payload(state, start_time)
+        runlog.append("result", payload)
+        runlog.append("done", payload)
+    except Exception as e:
+        traceback.print_exc()
+        runlog.append("error", {"error": str(e), "id": state["id"]})
+    finally:
+        runlog.close()
+
+def replay(runlog, last=0):
+    runlog.attach()
+    try:
+        while True:
+            events, missed, done = runlog.wait(last, RUN_LOG_KEEPALIVE)
+            if events:
+                last = events[-1][0]
+            chunks = sse_since(runlog, events, missed)
+            if chunks:
+                yield "".join(chunks)
+            elif done:
+                return
+            else:
+                yield ": keepalive\n\n"
+    finally:
+        runlog.detach()
 
 @app.route("/", methods=["GET"])
 def index():
@@ -77,7 +120,8 @@ def index():
         app_name=APP_NAME,
         model=MODEL,
         max_iter=MAX_ITER,
-        max_calls=MAX_CALLS
+        max_calls=MAX_CALLS,
+        pipeline_mode=PIPELINE_MODE
     )
 
 @app.route("/api/generate", methods=["POST"])
@@ -86,7 +130,9 @@ def generate_policy():
     try:
         data = request.get_json(force=True)
         text = (data.get("text") or "").strip()
-        environment = (data.get("environment") or "").strip().lower()
+        environment = str(data.get("environment") or "").strip().lower()
+        attack = parse_flag(data.get("attack"))
+        no_cache = parse_flag(data.get("no_cache"))
 
         if not environment:
             return jsonify({"error": "environment is required"}), 400
@@ -98,60 +144,151 @@ def generate_policy():
         except FileNotFoundError as e:
             return jsonify({"error": str(e)}), 404
 
-        state = init_state(text, environment, env_data)
-
-        # Step 1
-        state = agent_preprocess(state)
-        if overdo(state): 
-            return jsonify(finish_payload(state, start_time))
-
-        # Step 2
-        state = agent_identify(state)
-        if overdo(state): 
-            return jsonify(finish_payload(state, start_time))
-        if state.get("is_nlacp") is False:
-            state["verifier_output"] = {"status": "correct", "error": ""}
-            return jsonify(finish_payload(state, start_time))
+        state = init_state(text, environment, env_data, cache_bypass=no_cache,
+                           timeout=parse_timeout(data.get("timeout_ms")), run_id=data.get("id"),
+                           mode=parse_mode(data.get("mode")), priority=data.get("priority"),
+                           speculate=parse_flag(data["speculate"]) if "speculate" in data else None)
+        try:
+            run_pipeline(state, attack=attack)
+        except RunIdInUse:
+            return jsonify({"error": "run id already in use", "id": state["id"]}), 409
+        payload = finish_payload(state, start_time)
+        if parse_flag(data.get("store")):
+            payload["store"] = store_summary(STORE.ingest(environment, payload))
+        return jsonify(payload)
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
 
-        # Step 3
-        state = agent_retrieve(state)
-        if overdo(state): 
-            return jsonify(finish_payload(state, start_time))
 
-        # Step 4
-        state = agent_generate(state, attack=attack)
-        if overdo(state): 
-            return jsonify(finish_payload(state, start_time))
+# una riga NDJSON in ingresso -> un payload in uscita (errori inclusi, senza fermare il batch)
+def run_batch_item(line_no, line, default_env, attack, no_cache, mode=None, store=False, cancel=None):
+    start_time = time.time()
+    try:
+        data = json.loads(line)
+        if not isinstance(data, dict):
+            raise ValueError("expected a JSON object")
+    except ValueError as e:
+        return {"line": line_no, "error": f"invalid json: {e}"}
+
+    text = (data.get("text") or "").strip()
+    environment = (data.get("environment") or default_env or "").strip().lower()
+    if not environment:
+        return {"line": line_no, "error": "environment is required"}
+    if not text:
+        return {"line": line_no, "error": "text is required"}
 
-        # Step 5–6
-        while True:
-            state = agent_verify(state)
-            if overdo(state): 
-                break
+    try:
+        env_data = load_environment_data(environment)
+        state = init_state(text, environment, env_data, cache_bypass=parse_flag(data.get("no_cache", no_cache)),
+                           timeout=parse_timeout(data.get("timeout_ms")), mode=parse_mode(data.get("mode", mode)),
+                           priority="batch")
+        state["cancel"] = cancel
+        run_pipeline(state, attack=parse_flag(data.get("attack", attack)))
+    except FileNotFoundError as e:
+        return {"line": line_no, "error": str(e)}
+    except Exception as e:
+        traceback.print_exc()
+        return {"line": line_no, "error": str(e)}
 
-            if (state.get("verifier_output", {}).get("status", "").strip().lower() == "correct"):
-                break
+    payload = finish_payload(state, start_time)
+    payload["line"] = line_no
+    if parse_flag(data.get("store", store)):
+        payload["store"] = store_summary(STORE.ingest(environment, payload))
+    return payload
 
-            if state["n_iter"] >= state.get("max_iter", MAX_ITER):
-                state["complete"] = True
-                break
 
-            state = agent_generate(state, attack=attack)
-            if overdo(state): 
-                break
+@app.route("/api/generate/batch", methods=["POST"])
+def generate_batch():
+    try:
+        concurrency = int(request.args.get("concurrency") or BATCH_CONCURRENCY)
+    except ValueError:
+        return jsonify({"error": "concurrency must be an integer"}), 400
+    concurrency = max(1, min(concurrency, BATCH_MAX_CONCURRENCY))
+    default_env = (request.args.get("environment") or "").strip().lower()
+    attack = parse_flag(request.args.get("attack"))
+    no_cache = parse_flag(request.args.get("no_cache"))
+    mode = parse_mode(request.args.get("mode"))
+    store = parse_flag(request.args.get("store"))
+    stream = request.stream
 
-        return jsonify(finish_payload(state, start_time))
-    except Exception as e:
-        traceback.print_exc()
-        return jsonify({"error": str(e)}), 500
+    def generate():
+        start_time = time.time()
+        totals = {"items": 0, "ok": 0, "errors": 0, "n_calls": 0}
+
+        def emit(futures):
+            for f in futures:
+                item = f.result()
+                totals["items"] += 1
+                if "error" in item:
+                    totals["errors"] += 1
+                else:
+                    totals["ok"] += 1
+                    totals["n_calls"] += item.get("n_calls") or 0
+                yield json.dumps(item, ensure_ascii=False) + "\n"
+
+        # l'input si legge una riga alla volta: in memoria restano solo gli item in volo
+        cancel = threading.Event()
+        pool = ThreadPoolExecutor(max_workers=concurrency)
+        pending = set()
+        try:
+            for line_no, raw in enumerate(stream, start=1):
+                line = raw.decode("utf-8", errors="replace").strip()
+                if not line:
+                    continue
+                if len(pending) >= concurrency:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    yield from emit(done)
+                pending.add(pool.submit(run_batch_item, line_no, line, default_env, attack, no_cache, mode, store,
+                                        cancel))
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                yield from emit(done)
+        finally:
+            # client disconnesso (GeneratorExit) o errore: le righe in coda non partono, le run in corso si fermano
+            if pending:
+                cancel.set()
+            pool.shutdown(wait=False, cancel_futures=True)
+
+        elapsed = time.time() - start_time
+        totals["elapsed_ms"] = int(elapsed * 1000)
+        totals["items_per_s"] = round(totals["items"] / elapsed, 3) if elapsed > 0 else None
+        totals["concurrency"] = concurrency
+        yield json.dumps({"summary": totals}) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
 
 
+# Last-Event-ID (riconnessione di EventSource) o ?run=<id>: riprende dal log della run invece di rieseguirla
 @app.route("/api/log", methods=["GET"])
 def log():
+    resume = parse_event_id(request.headers.get("Last-Event-ID") or request.args.get("last_event_id"))
+    run_id = (request.args.get("run") or "").strip()
+    if resume is not None or run_id:
+        run_id, last = resume or (run_id, 0)
+        runlog = RUNLOGS.get(run_id)
+        # run finita e già letta tutta: 204 ferma le riconnessioni di EventSource
+        if runlog is not None and not runlog.since(last)[0] and runlog.done:
+            return Response(status=204)
+        if runlog is not None:
+            return Response(stream_with_context(replay(runlog, last)), mimetype="text/event-stream", headers={
+                "Cache-Control": "no-cache",
+                "X-Accel-Buffering": "no"
+            })
+        # run scaduta o mai esistita: non si riparte da capo (raddoppierebbe le chiamate al modello)
+        return jsonify({"error": "run not found", "id": run_id}), 404
+
     text = (request.args.get("text") or "").strip()
     env = (request.args.get("environment") or "").strip().lower()
-    attack_raw = (request.args.get("attack") or "false").strip().lower()
-    attack = attack_raw in ("1", "true", "yes", "on")
+    attack = parse_flag(request.args.get("attack"))
+    no_cache = parse_flag(request.args.get("no_cache"))
+    timeout = parse_timeout(request.args.get("timeout_ms"))
+    mode = parse_mode(request.args.get("mode"))
+    stream = parse_flag(request.args["stream"]) if "stream" in request.args else None
+    speculate = parse_flag(request.args["speculate"]) if "speculate" in request.args else None
 
     if not env:
         return Response(sse("error", {"error": "environment is required"}), mimetype="text/event-stream")
@@ -163,102 +300,108 @@ def log():
     except FileNotFoundError as e:
         return Response(sse("error", {"error": str(e)}), mimetype="text/event-stream")
 
-    def generate():
-        global STOP_REQUESTED
-        STOP_REQUESTED = False
-        start_time = time.time()
-        state = init_state(text, env, env_data)
-        logs = []
-
-        def log(event):
-            event["time"] = int(time.time() * 1000)
-            event["iter"] = state["n_iter"]
-            event["calls"] = state["n_calls"]
-            logs.append(event)
-
-        def flush():
-            nonlocal logs
-            while logs:
-                yield sse("log", logs.pop(0))
-
-        yield sse("log", {"msg": "start", "id": state["id"], "env": env})
-
-        # Step 1
-        log({"step": 1, "phase": "start", "msg": "pre-processing"})
-        state = agent_preprocess(state, logger=log)
-        yield from flush()
-        log({"step": 1, "phase": "end", "text_preproc": state.get("text_preproc")})
-        yield from flush()
-        if overdo(state):
-            payload = finish_payload(state, start_time)
-            yield sse("done", payload)
-            return
-
-        # Step 2
-        log({"step": 2, "phase": "start", "msg": "identify"})
-        state = agent_identify(state, logger=log)
-        yield from flush()
-        log({"step": 2, "phase": "end", "is_nlacp": state.get("is_nlacp")})
-        yield from flush()
-        if state.get("is_nlacp") is False:
-            payload = finish_payload(state, start_time)
-            yield sse("done", payload)
-            return
-
-        # Step 3
-        log({"step": 3, "phase": "start", "msg": "retrieving domain info"})
-        state = agent_retrieve(state, logger=log)
-        yield from flush()
-        log({"step": 3, "phase": "end", "env_var": state["env_var"]})
-        yield from flush()
-
-        # Step 4
-        log({"step": 4, "phase": "start", "msg": "generating policy"})
-        state = agent_generate(state, logger=log)
-        yield from flush()
-        log({"step": 4, "phase": "end", "rules_count": len(state.get("policy_json", {}).get("dsarcp", []))})
-        log({"event": "policy_preview","dsarcp": state.get("policy_json", {}).get("dsarcp", [])[:3]})
-        yield from flush()
-
-        # Step 5–6
-        while True:
-            log({"step": 5, "phase": "start", "msg": "verify"})
-            state = agent_verify(state, logger=log)
-            yield from flush()
-            log({"step": 5, "phase": "end", "verifier_output": state.get("verifier_output")})
-            yield from flush()
-
-            if overdo(state):
-                break
-            if (state.get("verifier_output", {}).get("status", "").strip().lower() == "correct"):
-                break
-            if state["n_iter"] >= state.get("max_iter", MAX_ITER):
-                break
-            if state["n_calls"] >= MAX_CALLS:
-                state["complete"] = True
-                break
-
-            log({"step": 6, "phase": "start", "msg": "refine"})
-            state = agent_generate(state, logger=log)
-            yield from flush()
-            log({"step": 6, "phase": "end", "n_iter": state["n_iter"]})
-            yield from flush()
-            if overdo(state): break
-
-        payload = finish_payload(state, start_time)
-        yield sse("result", payload)
-        yield sse("done", payload)
+    state = init_state(text, env, env_data, cache_bypass=no_cache, timeout=timeout, mode=mode, stream=stream,
+                       priority="interactive", speculate=speculate)
+    # l'Event di cancellazione esiste già qui: il log lo imposta se nessuno legge più la run
+    state["cancel"] = threading.Event()
+    runlog = RUNLOGS.create(state["id"], state["cancel"])
+    runlog.append("log", {"msg": "start", "id": state["id"], "env": env})
+    threading.Thread(target=run_logged, args=(state, runlog, attack), name=f"run-{state['id']}", daemon=True).start()
 
-    return Response(stream_with_context(generate()), mimetype="text/event-stream", headers={
+    return Response(stream_with_context(replay(runlog)), mimetype="text/event-stream", headers={
         "Cache-Control": "no-cache",
         "X-Accel-Buffering": "no"
     })
 
+# decisione su una richiesta ("request") o più ("requests"), con le regole salvate in POLICY_DIR
+# per l'environment oppure con quelle passate in "policy" (uno o più payload di /api/generate)
+@app.route("/api/evaluate", methods=["POST"])
+def evaluate():
+    data = request.get_json(force=True, silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"error": "invalid json"}), 400
+    explain = parse_flag(data.get("explain"))
+    policy = data.get("policy")
+    try:
+        return _evaluate(data, policy, explain)
+    except InvalidRequest as e:
+        return jsonify({"error": str(e)}), 400
+
+def _evaluate(data, policy, explain):
+    if policy is not None:
+        engine = PolicyEngine.from_payloads(policy if isinstance(policy, list) else [policy])
+    elif data.get("source") == "store":
+        environment = str(data.get("environment") or "").strip().lower()
+        engine = PolicyEngine(STORE.rules(environment))
+        if not engine.rules:
+            return jsonify({"error": f"no stored policies for environment {environment}"}), 404
+    else:
+        environment = str(data.get("environment") or "").strip().lower()
+        if not environment:
+            return jsonify({"error": "environment or policy is required"}), 400
+        engine = POLICIES.engine(environment)
+        if engine is None:
+            return jsonify({"error": f"no saved policies for environment {environment}"}), 404
+
+    if isinstance(data.get("requests"), list):
+        if not all(isinstance(r, dict) for r in data["requests"]):
+            return jsonify({"error": "requests must be objects"}), 400
+        return jsonify({"decisions": engine.decide_many(data["requests"], explain), "rules": len(engine.rules)})
+    if not isinstance(data.get("request"), dict):
+        return jsonify({"error": "request or requests is required"}), 400
+    return jsonify(engine.decide(data["request"], explain))
+
+# store delle regole per environment (policystore.py): ingest di payload salvati, regole con provenienza,
+# conflitti allow/deny e regole ridondanti
+@app.route("/api/policies/<env>", methods=["GET", "POST"])
+def policies(env):
+    env = env.strip().lower()
+    if request.method == "GET":
+        return jsonify(dict(STORE.stats(env), rules=STORE.rules(env)))
+    data = request.get_json(force=True, silent=True)
+    payloads = data if isinstance(data, list) else [data]
+    if not all(isinstance(p, dict) and isinstance(p.get("dsarcp"), list) for p in payloads):
+        return jsonify({"error": "expected a payload with dsarcp, or a list of them"}), 400
+    return jsonify({"results": [STORE.ingest(env, p) for p in payloads], "stats": STORE.stats(env)})
+
+@app.route("/api/policies/<env>/conflicts", methods=["GET"])
+def policy_conflicts(env):
+    return jsonify({"conflicts": STORE.conflicts(env.strip().lower())})
+
+@app.route("/api/policies/<env>/subsumptions", methods=["GET"])
+def policy_subsumptions(env):
+    return jsonify({"subsumptions": STORE.subsumptions(env.strip().lower())})
+
+@app.route("/api/cache", methods=["GET"])
+def cache_stats():
+    return jsonify(CACHE.stats())
+
+@app.route("/api/environments", methods=["GET"])
+def environments_stats():
+    return jsonify(REGISTRY.stats())
+
+@app.route("/api/ratelimit", methods=["GET"])
+def ratelimit_stats():
+    return jsonify(LIMITER.stats())
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return Response(METRICS.render(), content_type=CONTENT_TYPE)
+
+@app.route("/api/runs", methods=["GET"])
+def runs_stats():
+    return jsonify(dict(RUNS.stats(), logs=RUNLOGS.stats()))
+
+# cancella solo la run indicata (id restituito nel primo evento di /api/log o passato a /api/generate)
 @app.route("/api/stop", methods=["POST"])
 def stop():
-    global STOP_REQUESTED
-    STOP_REQUESTED = True
-    return jsonify({"status": "stopped"})
+    data = request.get_json(silent=True) or {}
+    run_id = (data.get("id") or request.args.get("id") or "").strip()
+    if not run_id:
+        return jsonify({"error": "id is required"}), 400
+    if not RUNS.cancel(run_id):
+        return jsonify({"error": "run not found", "id": run_id}), 404
+    return jsonify({"status": "stopped", "id": run_id})
 
 
 if __name__ == "__main__":
@@ -0,0 +1,166 @@
+import json
+import time
+import asyncio
+import threading
+import traceback
+from urllib.parse import parse_qs
+from asgiref.wsgi import WsgiToAsgi
+from app import (app as flask_app, load_environment_data, parse_flag, parse_timeout, parse_mode, sse, sse_since,
+                 run_logger)
+from runlog import RUNLOGS, RUN_LOG_KEEPALIVE, parse_event_id
+from pipeline import init_state, finish_payload, arun_steps
+
+# Entry point ASGI: /api/log gira su coroutine (una run aperta costa un socket, non un thread),
+# con lo stesso log delle run e la stessa ripresa da Last-Event-ID dell'app Flask;
+# tutte le altre route restano le route Flask sincrone.
+#   uvicorn asgi:application --host 0.0.0.0 --port 8000
+
+wsgi = WsgiToAsgi(flask_app)
+
+SSE_HEADERS = [
+    (b"content-type", b"text/event-stream"),
+    (b"cache-control", b"no-cache"),
+    (b"x-accel-buffering", b"no"),
+]
+
+
+async def send_chunk(send, chunk, more_body=True):
+    await send({"type": "http.response.body", "body": chunk.encode("utf-8"), "more_body": more_body})
+
+
+# come run_logged di app.py, su coroutine: la run resta un task anche senza lettori
+async def arun_logged(state, runlog, attack):
+    start_time = time.time()
+    try:
+        async for _ in arun_steps(state, logger=run_logger(state, runlog), attack=attack):
+            pass
+        payload = finish_payload(state, start_time)
+        runlog.append("result", payload)
+        runlog.append("done", payload)
+    except Exception as e:
+        traceback.print_exc()
+        runlog.append("error", {"error": str(e), "id": state["id"]})
+    finally:
+        runlog.close()
+
+
+# i task delle run in background, finché non finiscono
+_runs = set()
+
+
+def start_run(state, runlog, attack):
+    task = asyncio.ensure_future(arun_logged(state, runlog, attack))
+    _runs.add(task)
+    task.add_done_callback(_runs.discard)
+
+
+# il lettore dorme finché append/close del log non lo sveglia (o per il keepalive)
+async def areplay(runlog, last=0):
+    while True:
+        events, missed, done = await runlog.await_since(last, RUN_LOG_KEEPALIVE)
+        if events:
+            last = events[-1][0]
+        chunks = sse_since(runlog, events, missed)
+        if chunks:
+            yield "".join(chunks)
+        elif done:
+            return
+        else:
+            yield ": keepalive\n\n"
+
+
+async def send_json(send, status, data):
+    await send({"type": "http.response.start", "status": status, "headers": [(b"content-type", b"application/json")]})
+    await send_chunk(send, json.dumps(data), more_body=False)
+
+
+async def log_stream(scope, receive, send):
+    args = {k: v[-1] for k, v in parse_qs(scope.get("query_string", b"").decode("utf-8")).items()}
+    headers = dict(scope.get("headers") or [])
+    resume = parse_event_id(headers.get(b"last-event-id", b"").decode("latin-1") or args.get("last_event_id"))
+    run_id = (args.get("run") or "").strip()
+    runlog = None
+    last = 0
+    if resume is not None or run_id:
+        run_id, last = resume or (run_id, 0)
+        # può leggere il log condiviso in SQLite: fuori dal loop
+        runlog = await asyncio.to_thread(RUNLOGS.get, run_id)
+        if runlog is not None and not runlog.since(last)[0] and runlog.done:
+            await send({"type": "http.response.start", "status": 204, "headers": []})
+            return await send_chunk(send, "", more_body=False)
+        if runlog is None:
+            return await send_json(send, 404, {"error": "run not found", "id": run_id})
+
+    if runlog is None:
+        text = (args.get("text") or "").strip()
+        env = (args.get("environment") or "").strip().lower()
+        attack = parse_flag(args.get("attack"))
+        no_cache = parse_flag(args.get("no_cache"))
+        timeout = parse_timeout(args.get("timeout_ms"))
+        mode = parse_mode(args.get("mode"))
+        stream = parse_flag(args["stream"]) if "stream" in args else None
+        speculate = parse_flag(args["speculate"]) if "speculate" in args else None
+
+        await send({"type": "http.response.start", "status": 200, "headers": SSE_HEADERS})
+
+        if not env:
+            return await send_chunk(send, sse("error", {"error": "environment is required"}), more_body=False)
+        if not text:
+            return await send_chunk(send, sse("error", {"error": "text is required"}), more_body=False)
+        try:
+            env_data = load_environment_data(env)
+        except FileNotFoundError as e:
+            return await send_chunk(send, sse("error", {"error": str(e)}), more_body=False)
+
+        state = init_state(text, env, env_data, cache_bypass=no_cache, timeout=timeout, mode=mode, stream=stream,
+                           priority="interactive", speculate=speculate)
+        state["cancel"] = threading.Event()
+        runlog = RUNLOGS.create(state["id"], state["cancel"])
+        runlog.append("log", {"msg": "start", "id": state["id"], "env": env})
+        start_run(state, runlog, attack)
+    else:
+        await send({"type": "http.response.start", "status": 200, "headers": SSE_HEADERS})
+
+    async def pump():
+        async for chunk in areplay(runlog, last):
+            await send_chunk(send, chunk)
+        await send_chunk(send, "", more_body=False)
+
+    # se il client chiude la connessione smette solo la lettura: la run continua finché
+    # RUN_LOG_DETACH non scade senza che nessuno si riconnetta
+    async def watch_disconnect():
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+
+    runlog.attach()
+    try:
+        reader = asyncio.ensure_future(pump())
+        watcher = asyncio.ensure_future(watch_disconnect())
+        done, _ = await asyncio.wait({reader, watcher}, return_when=asyncio.FIRST_COMPLETED)
+        for task in (reader, watcher):
+            if task not in done:
+                task.cancel()
+        if reader in done:
+            reader.result()
+    finally:
+        runlog.detach()
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] == "http" and scope["path"] == "/api/log" and scope["method"] == "GET":
+        return await log_stream(scope, receive, send)
+    return await wsgi(scope, receive, send)
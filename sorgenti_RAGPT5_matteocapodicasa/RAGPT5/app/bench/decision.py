@@ -0,0 +1,102 @@
+import random
+import time
+
+from bench.micro import synthetic_vocab
+from decision import PolicyEngine, canon
+
+# Throughput del motore di decisione: regole sintetiche su un vocabolario (con jolly "none",
+# purpose e condition), richieste casuali sugli stessi termini più alcune fuori vocabolario.
+
+
+HOT_SET = 2000
+
+
+def synthetic_rules(n_rules, vocab, seed=0):
+    rnd = random.Random(seed)
+    subjects, actions, resources = vocab["subjects"], vocab["actions"], vocab["resources"]
+    pick = lambda items, p_none: "none" if rnd.random() < p_none else rnd.choice(items)
+    return [{
+        "decision": "deny" if rnd.random() < 0.3 else "allow",
+        "subject": pick(subjects, 0.05),
+        "action": pick(actions, 0.1),
+        "resource": pick(resources, 0.1),
+        "purpose": pick(vocab["purposes"], 0.8),
+        "condition": pick(vocab["conditions"], 0.8),
+    } for _ in range(n_rules)]
+
+
+def synthetic_requests(n, vocab, seed=1):
+    rnd = random.Random(seed)
+    out = []
+    for _ in range(n):
+        out.append({
+            "subject": rnd.choice(vocab["subjects"]) if rnd.random() < 0.95 else "unknown subject",
+            "action": rnd.choice(vocab["actions"]),
+            "resource": rnd.choice(vocab["resources"]),
+            "purpose": rnd.choice(vocab["purposes"]) if rnd.random() < 0.5 else None,
+            "conditions": [rnd.choice(vocab["conditions"])] if rnd.random() < 0.5 else [],
+        })
+    return out
+
+
+def vocab_for(n_subjects=200, n_actions=20, n_resources=1000):
+    words = synthetic_vocab(n_subjects + n_actions + n_resources + 40, seed=7)
+    return {
+        "subjects": words[:n_subjects],
+        "actions": words[n_subjects:n_subjects + n_actions],
+        "resources": words[n_subjects + n_actions:n_subjects + n_actions + n_resources],
+        "purposes": words[-40:-20],
+        "conditions": words[-20:],
+    }
+
+
+def _rate(n, seconds):
+    return round(n / seconds) if seconds > 0 else None
+
+
+def bench_rules(n_rules, n_requests, vocab, repeat=3):
+    t0 = time.perf_counter()
+    engine = PolicyEngine(synthetic_rules(n_rules, vocab), cache_size=0)
+    build_ms = (time.perf_counter() - t0) * 1000
+    requests = synthetic_requests(n_requests, vocab)
+    # argomenti già canonici: misura solo l'indice (come un PEP che normalizza a monte)
+    args = [(canon(r["subject"]), canon(r["action"]), canon(r["resource"]), canon(r["purpose"]),
+             frozenset(canon(c) for c in r["conditions"])) for r in requests]
+
+    def best(fn):
+        times = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - t0)
+        return min(times)
+
+    uncached = best(lambda: [engine.evaluate(*a) for a in args])
+    # un PEP vede poche combinazioni ripetute: stessa quantità di richieste su un insieme di HOT_SET
+    hot = [args[i % HOT_SET] for i in range(n_requests)]
+    cached_engine = PolicyEngine(engine.rules)
+    cached = best(lambda: [cached_engine.evaluate(*a) for a in hot])
+    decide = best(lambda: engine.decide_many(requests))
+
+    decisions = [engine.evaluate(*a)[0] for a in args]
+    return {
+        "rules": n_rules,
+        "requests": n_requests,
+        "build_ms": round(build_ms, 3),
+        "evaluate_per_s": _rate(n_requests, uncached),
+        "evaluate_cached_per_s": _rate(n_requests, cached),
+        "decide_per_s": _rate(n_requests, decide),
+        "hot_set": HOT_SET,
+        "allow_ratio": round(decisions.count("allow") / len(decisions), 4),
+    }
+
+
+def run(rule_counts=(100, 1000, 10000, 100000), n_requests=100000, log=print):
+    vocab = vocab_for()
+    out = []
+    for n in rule_counts:
+        r = bench_rules(n, n_requests, vocab)
+        log(f"decision rules={n}: evaluate={r['evaluate_per_s']}/s cached={r['evaluate_cached_per_s']}/s "
+            f"decide={r['decide_per_s']}/s build={r['build_ms']}ms")
+        out.append(r)
+    return out
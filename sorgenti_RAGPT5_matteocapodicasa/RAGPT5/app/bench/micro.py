@@ -0,0 +1,109 @@
+import random
+import statistics
+import time
+
+import tools
+
+# Microbenchmark dello snap-to-vocab su vocabolari sintetici (da 100 a 100k voci).
+# Le query sono voci del vocabolario con un refuso, più qualche stringa che non corrisponde a nulla.
+
+SYLLABLES = ("ra", "to", "me", "li", "co", "sta", "pro", "fes", "sor", "dat", "ba", "se", "ren", "do",
+             "ap", "pli", "ca", "zio", "ne", "gra", "de", "re", "port", "stu", "dent", "an", "ma", "nu")
+
+
+def synthetic_vocab(size, seed=0):
+    rnd = random.Random(seed)
+    seen = set()
+    out = []
+    while len(out) < size:
+        words = ["".join(rnd.choice(SYLLABLES) for _ in range(rnd.randint(2, 4))) for _ in range(rnd.randint(1, 3))]
+        item = " ".join(words)
+        if item not in seen:
+            seen.add(item)
+            out.append(item)
+    return out
+
+
+def typo(s, rnd):
+    if len(s) < 3:
+        return s
+    i = rnd.randrange(len(s))
+    return s[:i] + rnd.choice("aeiourst") + s[i + 1:]
+
+
+def queries_for(vocab, n, seed=1):
+    rnd = random.Random(seed)
+    out = [typo(rnd.choice(vocab), rnd) for _ in range(n - n // 5)]
+    out += ["zzqx " + str(i) for i in range(n // 5)]
+    rnd.shuffle(out)
+    return out
+
+
+def _timed(fn, items):
+    samples = []
+    for item in items:
+        t0 = time.perf_counter()
+        fn(item)
+        samples.append((time.perf_counter() - t0) * 1000)
+    return samples
+
+
+def summarize(samples_ms):
+    samples = sorted(samples_ms)
+    return {
+        "n": len(samples),
+        "mean_ms": round(statistics.fmean(samples), 4),
+        "p50_ms": round(samples[len(samples) // 2], 4),
+        "p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 4),
+    }
+
+
+def rules_for(vocab, small, n, seed=2):
+    rnd = random.Random(seed)
+    return {"dsarcp": [{
+        "decision": rnd.choice(("allow", "deny")),
+        "subject": typo(rnd.choice(vocab), rnd),
+        "action": typo(rnd.choice(vocab), rnd),
+        "resource": typo(rnd.choice(vocab), rnd),
+        "purpose": rnd.choice(small + ["none"]),
+        "condition": "none",
+    } for _ in range(n)]}
+
+
+def bench_size(size, n_queries=200, n_rules=10, repeat=5):
+    vocab = synthetic_vocab(size)
+    queries = queries_for(vocab, n_queries)
+
+    # primo accesso: costruzione dell'indice (matrice o liste n-gram) + prima query
+    index = tools.VocabIndex(tuple(vocab))
+    t0 = time.perf_counter()
+    index.nearest(queries[0])
+    build_ms = (time.perf_counter() - t0) * 1000
+
+    nearest = _timed(lambda q: index.nearest(q), queries)
+    rank = _timed(lambda q: index.rank(q, k=5), queries)
+
+    # con vocab esplicito l'EntityIndex viene ricostruito a ogni chiamata (caso dei vocabolari del client)
+    small = vocab[:100]
+    entity_vocab = {"subjects": vocab, "actions": vocab, "resources": vocab, "purposes": small, "conditions": small}
+    policy = rules_for(vocab, small, n_rules)
+    ensure = _timed(lambda p: tools.ensure_policy_parameters(p, None, vocab=entity_vocab), [policy] * repeat)
+
+    return {
+        "vocab_size": size,
+        "index_build_ms": round(build_ms, 3),
+        "nearest": summarize(nearest),
+        "rank_entities": summarize(rank),
+        "ensure_policy_parameters": dict(summarize(ensure), rules=n_rules),
+    }
+
+
+def run(sizes, n_queries=200, n_rules=10, repeat=5, log=print):
+    out = []
+    for size in sizes:
+        result = bench_size(size, n_queries, n_rules, repeat)
+        log(f"micro vocab={size}: nearest p50={result['nearest']['p50_ms']}ms "
+            f"rank p50={result['rank_entities']['p50_ms']}ms "
+            f"ensure p50={result['ensure_policy_parameters']['p50_ms']}ms")
+        out.append(result)
+    return out
@@ -0,0 +1,215 @@
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Finto endpoint /v1/chat/completions: latenza configurabile e risposte JSON
+# preconfezionate per ogni prompt SYS_* (riconosciuto dalla riga "ROLE: Step N").
+#   python -m bench.mock_openai --port 8090 --latency lognormal:800,0.5
+
+
+# "fixed:MS" | "uniform:MIN_MS,MAX_MS" | "lognormal:MEDIAN_MS,SIGMA" -> funzione che restituisce secondi
+def parse_latency(spec):
+    kind, _, params = (spec or "fixed:0").partition(":")
+    values = [float(v) for v in params.split(",") if v.strip()] if params else []
+    if kind == "fixed":
+        ms = values[0] if values else 0.0
+        return lambda: ms / 1000.0
+    if kind == "uniform":
+        lo, hi = values
+        return lambda: random.uniform(lo, hi) / 1000.0
+    if kind == "lognormal":
+        median, sigma = values
+        return lambda: random.lognormvariate(math.log(median), sigma) / 1000.0
+    raise ValueError(f"unknown latency distribution: {spec}")
+
+
+def _user_payload(messages):
+    for m in reversed(messages):
+        if m.get("role") == "user":
+            try:
+                return json.loads(m.get("content") or "{}")
+            except ValueError:
+                return {}
+    return {}
+
+def _first(values):
+    return values[0] if values else "none"
+
+def answer(messages):
+    system = "\n".join(m.get("content", "") for m in messages if m.get("role") == "system")
+    payload = _user_payload(messages)
+    state = payload.get("state") or {}
+
+    if "ROLE: Fused front-end" in system:
+        k = payload.get("k") or 5
+        return {"text_preproc": state.get("input_text") or "", "is_nlacp": True,
+                "env_var": {t: v[:k] for t, v in (payload.get("candidates") or {}).items()}}
+    if "ROLE: Step 1" in system:
+        return {"text_preproc": state.get("input_text") or ""}
+    if "ROLE: Step 2" in system:
+        return {"is_nlacp": True}
+    if "ROLE: Step 3" in system:
+        k = payload.get("k") or 5
+        return {"env_var": {t: v[:k] for t, v in (payload.get("candidates") or {}).items()}}
+    if "ROLE: Step 6 - Targeted refinement" in system:
+        # patch vuota per ogni regola segnalata: i valori sono già presi dal vocabolario
+        return {"patch": [{"index": r.get("index"), "fields": {}} for r in payload.get("rules") or []]}
+    if "ROLE: Step 4" in system or "ROLE: Step 6" in system:
+        # una regola per soggetto (almeno una), così lo streaming ha più oggetti da emettere
+        env_var = state.get("env_var") or {}
+        return {"policy_json": {"dsarcp": [{
+            "decision": "allow" if i % 2 == 0 else "deny",
+            "subject": subject,
+            "action": _first(env_var.get("actions")),
+            "resource": _first(env_var.get("resources")),
+            "purpose": "none",
+            "condition": "none",
+        } for i, subject in enumerate((env_var.get("subjects") or ["none"])[:5])]}}
+    if "ROLE: Step 5" in system:
+        return {"verifier_output": {"status": "correct", "error": ""}}
+    return {}
+
+
+def _tokens(text):
+    return max(1, len(re.findall(r"\w+|[^\w\s]", text)))
+
+
+# cache di prefissi come quella del provider: a confini di messaggio, da 1024 token in su, a blocchi di 128
+PREFIX_CACHE_MIN = 1024
+PREFIX_CACHE_BLOCK = 128
+
+def _prefixes(messages):
+    out, tokens = [], 0
+    for i, m in enumerate(messages):
+        tokens += _tokens(m.get("content") or "")
+        out.append((hash(json.dumps(messages[:i + 1], sort_keys=True)), tokens))
+    return out
+
+
+class MockState:
+    def __init__(self, latency):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.injected = 0.0
+        self.prefixes = set()
+
+    def record(self, delay):
+        with self.lock:
+            self.requests += 1
+            self.injected += delay
+
+    # token del prompt già visti come prefisso (usage.prompt_tokens_details.cached_tokens)
+    def cached(self, messages):
+        prefixes = _prefixes(messages)
+        with self.lock:
+            hit = max((tokens for key, tokens in prefixes if key in self.prefixes), default=0)
+            self.prefixes.update(key for key, _ in prefixes)
+        if hit < PREFIX_CACHE_MIN:
+            return 0
+        return hit - (hit - PREFIX_CACHE_MIN) % PREFIX_CACHE_BLOCK
+
+    def snapshot(self):
+        with self.lock:
+            return self.requests, self.injected
+
+    def stats(self):
+        with self.lock:
+            return {"requests": self.requests,
+                    "mean_injected_ms": round(1000 * self.injected / self.requests, 3) if self.requests else None}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # header e body partono in due write: senza TCP_NODELAY il delayed ACK aggiunge ~40ms a chiamata
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length) or b"{}")
+        messages = body.get("messages") or []
+
+        delay = self.server.mock.latency()
+        self.server.mock.record(delay)
+        content = json.dumps(answer(messages))
+        prompt_tokens = sum(_tokens(m.get("content") or "") for m in messages)
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": _tokens(content),
+                 "total_tokens": prompt_tokens + _tokens(content),
+                 "prompt_tokens_details": {"cached_tokens": self.server.mock.cached(messages)}}
+        if body.get("stream"):
+            return self.stream(body, content, delay, usage)
+        time.sleep(delay)
+
+        out = json.dumps({
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "mock"),
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": content}}],
+            "usage": usage,
+        }).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(out)))
+        self.end_headers()
+        try:
+            self.wfile.write(out)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    # stream=True: primo token dopo il 10% della latenza, il resto distribuito sul tempo rimanente
+    def stream(self, body, content, delay, usage):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        base = {"id": f"chatcmpl-{uuid.uuid4().hex}", "object": "chat.completion.chunk",
+                "created": int(time.time()), "model": body.get("model", "mock")}
+        pieces = [content[i:i + 8] for i in range(0, len(content), 8)]
+        time.sleep(delay * 0.1)
+        step = delay * 0.9 / max(1, len(pieces))
+        try:
+            for piece in pieces:
+                chunk = dict(base, choices=[{"index": 0, "delta": {"content": piece}, "finish_reason": None}])
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+                time.sleep(step)
+            final = dict(base, choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}])
+            self.wfile.write(f"data: {json.dumps(final)}\n\n".encode("utf-8"))
+            if (body.get("stream_options") or {}).get("include_usage"):
+                self.wfile.write(f"data: {json.dumps(dict(base, choices=[], usage=usage))}\n\n".encode("utf-8"))
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # il client ha chiuso la connessione (hedge perso, run cancellata)
+            pass
+
+
+def serve(port=0, latency="fixed:0", background=True):
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    server.mock = MockState(parse_latency(latency))
+    if background:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="mock OpenAI chat completions server")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", default="fixed:0")
+    args = parser.parse_args()
+    print(f"mock OpenAI on http://127.0.0.1:{args.port}/v1 (latency {args.latency})")
+    serve(args.port, args.latency, background=False).serve_forever()
@@ -0,0 +1,79 @@
+import json
+import time
+
+# Confronto classic vs fused sugli stessi input: latenza, chiamate, fallback del fused e accordo
+# con il percorso classico (preso come riferimento). Contro il mock l'accordo è banale:
+# ha senso con --base-url verso il provider vero e un file --inputs.
+
+INPUTS = [
+    {"text": "The professor can update the grade report of a student.", "environment": "universita"},
+    {"text": "A student cannot delete the thesis.", "environment": "universita"},
+    {"text": "The advisor may read the thesis for evaluation purposes.", "environment": "universita"},
+    {"text": "The course starts in October.", "environment": "universita"},
+]
+
+
+def load_inputs(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _jaccard(a, b):
+    a, b = set(a or []), set(b or [])
+    return 1.0 if not a and not b else len(a & b) / len(a | b)
+
+def _rules(state):
+    return sorted(json.dumps(r, sort_keys=True) for r in state["policy_json"].get("dsarcp", []))
+
+
+def run_once(item, mode):
+    from app import load_environment_data
+    from pipeline import init_state, run_pipeline
+    env = item.get("environment") or "universita"
+    state = init_state(item["text"], env, load_environment_data(env), cache_bypass=True, mode=mode)
+    t0 = time.perf_counter()
+    run_pipeline(state)
+    state["elapsed_ms"] = (time.perf_counter() - t0) * 1000
+    return state
+
+
+def compare(inputs, log=print):
+    rows = []
+    for i, item in enumerate(inputs):
+        classic = run_once(item, "classic")
+        fused = run_once(item, "fused")
+        front = fused.get("front") or {}
+        types = ("subjects", "actions", "resources")
+        rows.append({
+            "input": i,
+            "classic_ms": round(classic["elapsed_ms"], 3),
+            "fused_ms": round(fused["elapsed_ms"], 3),
+            "classic_calls": classic["n_calls"],
+            "fused_calls": fused["n_calls"],
+            "fused_fallback": bool(front.get("fallback")),
+            "fused_reason": front.get("reason"),
+            "is_nlacp_match": classic.get("is_nlacp") == fused.get("is_nlacp"),
+            "env_var_jaccard": round(sum(_jaccard(classic["env_var"].get(t), fused["env_var"].get(t))
+                                         for t in types) / len(types), 4),
+            "dsarcp_match": _rules(classic) == _rules(fused),
+            "classic_status": (classic.get("verifier_output") or {}).get("status"),
+            "fused_status": (fused.get("verifier_output") or {}).get("status"),
+        })
+        log(f"modes input={i}: classic={rows[-1]['classic_ms']:.0f}ms fused={rows[-1]['fused_ms']:.0f}ms "
+            f"fallback={rows[-1]['fused_fallback']} dsarcp_match={rows[-1]['dsarcp_match']}")
+
+    n = len(rows) or 1
+    summary = {
+        "inputs": len(rows),
+        "classic_mean_ms": round(sum(r["classic_ms"] for r in rows) / n, 3),
+        "fused_mean_ms": round(sum(r["fused_ms"] for r in rows) / n, 3),
+        "classic_mean_calls": round(sum(r["classic_calls"] for r in rows) / n, 3),
+        "fused_mean_calls": round(sum(r["fused_calls"] for r in rows) / n, 3),
+        "fallback_rate": round(sum(r["fused_fallback"] for r in rows) / n, 4),
+        "is_nlacp_agreement": round(sum(r["is_nlacp_match"] for r in rows) / n, 4),
+        "env_var_jaccard": round(sum(r["env_var_jaccard"] for r in rows) / n, 4),
+        "dsarcp_agreement": round(sum(r["dsarcp_match"] for r in rows) / n, 4),
+        "classic_correct": round(sum(r["classic_status"] == "correct" for r in rows) / n, 4),
+        "fused_correct": round(sum(r["fused_status"] == "correct" for r in rows) / n, 4),
+    }
+    return {"summary": summary, "runs": rows}
@@ -0,0 +1,232 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from bench import mock_openai, micro, modes, decision
+
+# Benchmark: pipeline e agenti contro il mock OpenAI a concorrenza crescente, più i microbenchmark
+# dello snap-to-vocab. Il risultato è un JSON confrontabile tra commit (--compare).
+#   cd app && python -m bench.run --latency lognormal:300,0.4 --out bench_results.json
+#   python -m bench.run --skip-micro --compare bench_results.json
+#   python -m bench.run --base-url https://api.openai.com/v1 --skip-endpoints --skip-agents --skip-micro --inputs reqs.ndjson
+
+TEXT = ("The professor can update the grade report of a student. "
+        "A student cannot delete the thesis.")
+ENVIRONMENT = "universita"
+
+
+def _levels(value):
+    return [int(v) for v in value.split(",") if v.strip()]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(__file__)).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# una misura: `runs` chiamate di fn() con `concurrency` thread. L'overhead stimato è la latenza
+# media meno il tempo iniettato dal mock per le chiamate di una run (esatto solo senza fan-out).
+def drive(fn, concurrency, runs, mock):
+    req0, inj0 = mock.snapshot() if mock else (0, 0.0)
+    samples, errors = [], 0
+
+    def one(_):
+        t0 = time.perf_counter()
+        ok = fn()
+        return (time.perf_counter() - t0) * 1000, ok
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for ms, ok in pool.map(one, range(runs)):
+            samples.append(ms)
+            errors += 0 if ok else 1
+    wall = time.perf_counter() - t0
+    req1, inj1 = mock.snapshot() if mock else (0, 0.0)
+
+    out = micro.summarize(samples)
+    calls = req1 - req0
+    injected_ms = 1000 * (inj1 - inj0) / calls if calls else 0.0
+    out.update({
+        "concurrency": concurrency,
+        "errors": errors,
+        "throughput_rps": round(runs / wall, 3),
+        "model_calls_per_run": round(calls / runs, 3),
+        "mean_injected_ms": round(injected_ms, 3),
+        "overhead_ms_est": round(out["mean_ms"] - injected_ms * calls / runs, 3),
+    })
+    return out
+
+
+def endpoint_targets(flask_app, mode="classic"):
+    client = flask_app.test_client()
+
+    def generate():
+        r = client.post("/api/generate", json={"text": TEXT, "environment": ENVIRONMENT, "mode": mode})
+        return r.status_code == 200 and "dsarcp" in (r.get_json() or {})
+
+    def log():
+        r = client.get("/api/log", query_string={"text": TEXT, "environment": ENVIRONMENT, "mode": mode})
+        return b"event: done" in r.get_data()
+
+    suffix = "" if mode == "classic" else f"?mode={mode}"
+    return {"/api/generate" + suffix: generate, "/api/log" + suffix: log}
+
+
+def agent_targets(env_data):
+    import agents
+    from pipeline import init_state, run_pipeline
+
+    # una run completa fornisce gli input realistici dei singoli step
+    seed = run_pipeline(init_state(TEXT, ENVIRONMENT, env_data))
+    stages = [
+        ("agent_preprocess", agents.agent_preprocess, ()),
+        ("agent_fused", agents.agent_fused, ()),
+        ("agent_identify", agents.agent_identify, ("text_preproc",)),
+        ("agent_retrieve", agents.agent_retrieve, ("text_preproc", "is_nlacp")),
+        ("agent_generate", agents.agent_generate, ("text_preproc", "is_nlacp", "env_var")),
+        ("agent_verify", agents.agent_verify, ("text_preproc", "is_nlacp", "env_var", "policy_json")),
+    ]
+
+    def target(agent, fields):
+        def fn():
+            state = init_state(TEXT, ENVIRONMENT, env_data)
+            for f in fields:
+                state[f] = seed.get(f)
+            agent(state)
+            return not state.get("errors")
+        return fn
+
+    return {name: target(agent, fields) for name, agent, fields in stages}
+
+
+def run_concurrency(targets, levels, runs_per_worker, min_runs, mock, log):
+    out = {}
+    for name, fn in targets.items():
+        out[name] = []
+        for c in levels:
+            result = drive(fn, c, max(min_runs, c * runs_per_worker), mock)
+            log(f"{name} c={c}: p50={result['p50_ms']}ms p95={result['p95_ms']}ms "
+                f"rps={result['throughput_rps']} overhead~{result['overhead_ms_est']}ms")
+            out[name].append(result)
+    return out
+
+
+# confronto con un file precedente: rapporto nuovo/vecchio sulle p50
+def compare(old, new):
+    rows = []
+    for section in ("endpoints", "agents"):
+        for name, levels in (new.get(section) or {}).items():
+            before = {r["concurrency"]: r for r in (old.get(section) or {}).get(name, [])}
+            for r in levels:
+                b = before.get(r["concurrency"])
+                if b and b["p50_ms"]:
+                    rows.append((f"{name} c={r['concurrency']}", b["p50_ms"], r["p50_ms"]))
+    before = {r["vocab_size"]: r for r in old.get("micro") or []}
+    for r in new.get("micro") or []:
+        b = before.get(r["vocab_size"])
+        for key in ("nearest", "rank_entities", "ensure_policy_parameters"):
+            if b and b[key]["p50_ms"]:
+                rows.append((f"{key} vocab={r['vocab_size']}", b[key]["p50_ms"], r[key]["p50_ms"]))
+    # throughput delle decisioni: rapporto sul tempo per decisione, come per le p50
+    before = {r["rules"]: r for r in old.get("decision") or []}
+    for r in new.get("decision") or []:
+        b = before.get(r["rules"])
+        for key in ("evaluate_per_s", "decide_per_s"):
+            if b and b.get(key) and r.get(key):
+                rows.append((f"{key} rules={r['rules']}", round(1000 / b[key], 6), round(1000 / r[key], 6)))
+    return [{"name": n, "old_p50_ms": o, "new_p50_ms": v, "ratio": round(v / o, 3)} for n, o, v in rows]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="RAGPT5 benchmark")
+    parser.add_argument("--latency", default="fixed:50", help="fixed:MS | uniform:MIN,MAX | lognormal:MEDIAN,SIGMA")
+    parser.add_argument("--concurrency", default="1,2,4,8,16,32")
+    parser.add_argument("--runs-per-worker", type=int, default=4)
+    parser.add_argument("--min-runs", type=int, default=8)
+    parser.add_argument("--vocab-sizes", default="100,1000,10000,100000")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--skip-endpoints", action="store_true")
+    parser.add_argument("--skip-agents", action="store_true")
+    parser.add_argument("--skip-micro", action="store_true")
+    parser.add_argument("--skip-modes", action="store_true")
+    parser.add_argument("--skip-decision", action="store_true")
+    parser.add_argument("--decision-rules", default="100,1000,10000,100000")
+    parser.add_argument("--modes", default="classic,fused", help="pipeline modes driven on the endpoints")
+    parser.add_argument("--inputs", help="NDJSON {text, environment} for the classic/fused comparison")
+    parser.add_argument("--base-url", help="use this endpoint instead of the mock (e.g. the real provider)")
+    parser.add_argument("--out", default="bench_results.json")
+    parser.add_argument("--compare", help="previous results file")
+    args = parser.parse_args(argv)
+    log = lambda msg: print(msg, file=sys.stderr, flush=True)
+
+    # il client OpenAI viene creato all'import di agents: l'ambiente va preparato prima
+    server = None
+    if args.base_url:
+        os.environ["OPENAI_BASE_URL"] = args.base_url
+    else:
+        server = mock_openai.serve(0, args.latency)
+        os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{server.server_address[1]}/v1"
+        os.environ["OPENAI_API_KEY"] = "bench"
+    mock = server.mock if server else None
+    os.environ.setdefault("LLM_CACHE", "off")
+    os.environ.setdefault("HEDGE", "off")
+
+    import numpy
+    results = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "python": platform.python_version(),
+            "numpy": numpy.__version__,
+            "latency": args.latency if server else None,
+            "base_url": args.base_url,
+            "env": {k: os.environ.get(k) for k in ("MODEL", "LLM_CACHE", "HEDGE", "FANOUT", "FANOUT_CONCURRENCY",
+                                                   "RETRIEVE_MODE", "MAX_ITER", "MAX_CALLS")},
+        },
+    }
+    levels = _levels(args.concurrency)
+
+    if not args.skip_endpoints or not args.skip_agents:
+        from app import app as flask_app, load_environment_data
+        env_data = load_environment_data(ENVIRONMENT)
+        if not args.skip_endpoints:
+            targets = {}
+            for mode in args.modes.split(","):
+                targets.update(endpoint_targets(flask_app, mode.strip()))
+            results["endpoints"] = run_concurrency(targets, levels, args.runs_per_worker, args.min_runs, mock, log)
+        if not args.skip_agents:
+            results["agents"] = run_concurrency(agent_targets(env_data), levels,
+                                                args.runs_per_worker, args.min_runs, mock, log)
+    if not args.skip_modes:
+        results["modes"] = modes.compare(modes.load_inputs(args.inputs) if args.inputs else modes.INPUTS, log=log)
+    if not args.skip_micro:
+        results["micro"] = micro.run(_levels(args.vocab_sizes), n_queries=args.queries, log=log)
+
+    if not args.skip_decision:
+        results["decision"] = decision.run(_levels(args.decision_rules), log=log)
+
+    if server:
+        results["mock"] = server.mock.stats()
+        server.shutdown()
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            results["compare"] = compare(json.load(f), results)
+        for row in results["compare"]:
+            log(f"{row['name']}: {row['old_p50_ms']} -> {row['new_p50_ms']} ms (x{row['ratio']})")
+
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    log(f"results written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
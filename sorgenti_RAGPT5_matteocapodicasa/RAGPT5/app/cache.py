@@ -0,0 +1,182 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+# cache delle risposte del modello: LRU in memoria davanti a uno store SQLite su disco.
+# La chiave è l'hash di modello + prompt di sistema + messaggi canonicalizzati.
+LLM_CACHE = os.getenv("LLM_CACHE", "on").strip().lower() not in ("0", "off", "false", "no")
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", os.path.join(os.path.dirname(__file__), "cache", "llm_cache.sqlite3"))
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600)))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "50000"))
+LLM_CACHE_MEMORY_ENTRIES = int(os.getenv("LLM_CACHE_MEMORY_ENTRIES", "1024"))
+# accessed_at dei hit (anche quelli in memoria) si scrive a blocchi, alla prossima put o ogni N hit
+LLM_CACHE_TOUCH_BATCH = int(os.getenv("LLM_CACHE_TOUCH_BATCH", "64"))
+# verify e refine non passano dalla cache: con la stessa policy in ingresso darebbero a ogni
+# iterazione lo stesso verdetto (o la stessa correzione) invece di una nuova risposta del modello
+UNCACHED_STEPS = frozenset(("verify", "refine"))
+
+
+def _canonical(content):
+    try:
+        return json.loads(content)
+    except (TypeError, ValueError):
+        return content
+
+def cache_key(model, messages, step=None):
+    if step in UNCACHED_STEPS:
+        return None
+    system = messages[0]["content"] if messages and messages[0].get("role") == "system" else ""
+    canonical = {
+        "model": model,
+        "system": system,
+        "messages": [{"role": m.get("role"), "content": _canonical(m.get("content"))} for m in messages],
+    }
+    blob = json.dumps(canonical, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, path=LLM_CACHE_PATH, ttl=LLM_CACHE_TTL,
+                 max_entries=LLM_CACHE_MAX_ENTRIES, memory_entries=LLM_CACHE_MEMORY_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self._mem = OrderedDict()
+        self._touched = {}
+        # _lock protegge la memoria, _db_lock la connessione: una lettura da disco non blocca gli hit in memoria
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._db = None
+        self._puts = 0
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    def _conn(self):
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False, timeout=5)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " key TEXT PRIMARY KEY, content TEXT NOT NULL,"
+                " created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses(accessed_at)")
+            self._db.commit()
+        return self._db
+
+    # una connessione SQLite non va usata attraverso un fork: il worker ne apre una sua
+    def reset(self):
+        self._db = None
+
+    def _remember(self, key, content, created_at):
+        self._mem[key] = (content, created_at)
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.memory_entries:
+            self._mem.popitem(last=False)
+
+    def _take_touched(self):
+        touched, self._touched = self._touched, {}
+        return touched
+
+    # sotto _lock: il blocco da scrivere se ha raggiunto LLM_CACHE_TOUCH_BATCH
+    def _full_batch(self):
+        return self._take_touched() if len(self._touched) >= LLM_CACHE_TOUCH_BATCH else None
+
+    def _flush_touched(self, touched):
+        if touched:
+            with self._db_lock:
+                db = self._conn()
+                self._write_touched(db, touched)
+                db.commit()
+
+    def _write_touched(self, db, touched):
+        if touched:
+            db.executemany("UPDATE responses SET accessed_at = ? WHERE key = ?",
+                           [(at, key) for key, at in touched.items()])
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._mem.get(key)
+            hit = entry is not None and now - entry[1] <= self.ttl
+            if hit:
+                self._mem.move_to_end(key)
+                self._touched[key] = now
+                self.counters["memory_hits"] += 1
+                touched = self._full_batch()
+            else:
+                self._mem.pop(key, None)
+        # senza questo un carico di sole letture non aggiornerebbe mai accessed_at e l'LRU su disco
+        # scarterebbe proprio le chiavi più usate
+        if hit:
+            self._flush_touched(touched)
+            return entry[0]
+
+        expired = False
+        with self._db_lock:
+            db = self._conn()
+            row = db.execute("SELECT content, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and now - row[1] > self.ttl:
+                db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                db.commit()
+                row, expired = None, True
+
+        with self._lock:
+            if row is None:
+                self.counters["evictions"] += int(expired)
+                self.counters["misses"] += 1
+                return None
+            self._remember(key, row[0], row[1])
+            self._touched[key] = now
+            self.counters["disk_hits"] += 1
+            touched = self._full_batch()
+        self._flush_touched(touched)
+        return row[0]
+
+    def put(self, key, content):
+        now = time.time()
+        with self._lock:
+            self._remember(key, content, now)
+            touched = self._take_touched()
+            self.counters["stores"] += 1
+            self._puts += 1
+            evict = self._puts % 100 == 0
+        with self._db_lock:
+            db = self._conn()
+            db.execute(
+                "INSERT OR REPLACE INTO responses (key, content, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, content, now, now),
+            )
+            self._write_touched(db, touched)
+            if evict:
+                self._evict(db, now)
+            db.commit()
+
+    # scadute per TTL, poi le meno usate oltre max_entries
+    def _evict(self, db, now):
+        n = db.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl,)).rowcount
+        total = db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        if total > self.max_entries:
+            n += db.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed_at ASC LIMIT ?)",
+                (total - self.max_entries,),
+            ).rowcount
+        with self._lock:
+            self.counters["evictions"] += n
+
+    def stats(self):
+        with self._lock:
+            out = dict(self.counters)
+            out["memory_entries"] = len(self._mem)
+        hits = out["memory_hits"] + out["disk_hits"]
+        out["hit_ratio"] = round(hits / (hits + out["misses"]), 4) if hits + out["misses"] else None
+        out["enabled"] = LLM_CACHE
+        return out
+
+
+CACHE = ResponseCache()
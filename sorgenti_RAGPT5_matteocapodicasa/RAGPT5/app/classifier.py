@@ -0,0 +1,112 @@
+import os
+import re
+import sys
+from tools import ENTITY_TYPES, norm
+
+# Step 2 fast-path: classificatore lessicale deterministico davanti ad agent_identify.
+# Risponde solo se è sicuro (confidenza >= soglia), altrimenti decide l'LLM.
+IDENTIFY_FASTPATH_MIN_CONFIDENCE = float(os.getenv("IDENTIFY_FASTPATH_MIN_CONFIDENCE", "0.9"))
+
+MODALS = re.compile(r"""\b(
+    can(not)?|can't|may|must|shall|should|ought\sto|
+    (is|are)\s(not\s)?(allowed|permitted|authori[sz]ed|entitled|required|forbidden|prohibited)|
+    (only|never)\b|
+    pu[oò]|possono|deve|devono|dovr[aà]|dovranno|
+    (è|e'|sono)\s(consentit[oaie]|permess[oaie]|autorizzat[oaie]|vietat[oaie]|proibit[oaie])|
+    (non\s)?(consentit[oaie]|vietat[oaie]|autorizzat[oaie])|solo|soltanto|mai
+)\b""", re.X | re.I)
+
+# righe intere di titolo o saluto: una frase che continua dopo "This document"/"Hi" non è boilerplate
+BOILERPLATE = re.compile(r"""^(
+    (table\sof\s)?contents?|index|indice|introduction|introduzione|overview|summary|sommario|
+    (chapter|section|capitolo|sezione)\s[\w.]+|
+    (hello|hi|thanks|thank\syou|ciao|grazie|buongiorno)(\s(all|everyone|team|tutti|a\stutti))?|
+    (this|the\sfollowing)\s(document|section|chapter)|
+    (questo|il\sseguente)\s(documento|capitolo)|
+    [\d.\s]+|
+    [^\w]*
+)[\s!.,:;]*$""", re.X | re.I)
+
+
+# tutte le voci di un environment in un solo indice per parola: una passata sulle parole del testo
+# invece di una regex per voce. Costruito una volta per snapshot (environments.py) e scartato con lui.
+# Le voci multi-parola devono comparire tutte, consecutive; le parole lunghe valgono anche come
+# prefisso (professor -> professore), le corte solo uguali o al plurale in -s (student -> students).
+class VocabMatcher:
+    PREFIX_MIN = 4
+
+    def __init__(self, sections, types=ENTITY_TYPES):
+        self.long = {}
+        self.short = {}
+        for t in types:
+            for entity in sections.get(t, ()):
+                words = re.findall(r"\w+", norm(entity))
+                if words:
+                    table = self.long if len(words[0]) >= self.PREFIX_MIN else self.short
+                    table.setdefault(words[0], []).append((t, entity, words))
+
+    def _word(self, word, token):
+        if len(word) >= self.PREFIX_MIN:
+            return token.startswith(word)
+        return token == word or token == word + "s"
+
+    def _starting(self, token):
+        for n in range(self.PREFIX_MIN, len(token) + 1):
+            yield from self.long.get(token[:n], ())
+        yield from self.short.get(token, ())
+        if token.endswith("s"):
+            yield from self.short.get(token[:-1], ())
+
+    # {tipo: voci trovate nel testo}, nell'ordine in cui compaiono
+    def hits(self, text, types=ENTITY_TYPES):
+        tokens = re.findall(r"\w+", norm(text))
+        hits = {t: [] for t in types}
+        for i, token in enumerate(tokens):
+            for t, entity, words in self._starting(token):
+                if t in hits and entity not in hits[t] and len(words) <= len(tokens) - i \
+                        and all(self._word(w, tok) for w, tok in zip(words[1:], tokens[i + 1:])):
+                    hits[t].append(entity)
+        return hits
+
+    def nbytes(self):
+        return sum(sys.getsizeof(table) + sum(sys.getsizeof(v) for v in table.values())
+                   for table in (self.long, self.short))
+
+
+def vocab_hits(text, vocab, types=ENTITY_TYPES):
+    matcher = vocab if isinstance(vocab, VocabMatcher) else VocabMatcher(vocab, types)
+    return matcher.hits(text, types)
+
+# matcher dell'environment residente (vedi environments.py)
+def environment_matcher(environment):
+    from environments import REGISTRY
+    try:
+        return REGISTRY.get(environment).matcher
+    except FileNotFoundError:
+        return VocabMatcher({})
+
+# -> {"is_nlacp": True|False|None, "confidence": 0-1, "reason": str}
+def classify_nlacp(text, vocab):
+    text = norm(text)
+    if not text:
+        return {"is_nlacp": False, "confidence": 0.97, "reason": "boilerplate"}
+
+    modal = bool(MODALS.search(text))
+    hits = vocab_hits(text, vocab)
+    n_subj, n_act, n_res = (len(hits["subjects"]) > 0, len(hits["actions"]) > 0, len(hits["resources"]) > 0)
+    # un titolo o un saluto con un modale o una voce del vocabolario lo giudica l'LLM
+    if BOILERPLATE.match(text):
+        if modal or any(hits.values()):
+            return {"is_nlacp": None, "confidence": 0.5, "reason": "boilerplate with modal or vocabulary hits"}
+        return {"is_nlacp": False, "confidence": 0.97, "reason": "boilerplate"}
+    question = text.endswith("?")
+
+    if modal and n_subj and n_act and n_res and not question:
+        return {"is_nlacp": True, "confidence": 0.95, "reason": "modal+subject+action+resource"}
+    if modal and n_subj and (n_act or n_res) and not question:
+        return {"is_nlacp": True, "confidence": 0.9, "reason": "modal+subject+" + ("action" if n_act else "resource")}
+    if not modal and not n_subj and not n_act and not n_res:
+        return {"is_nlacp": False, "confidence": 0.9, "reason": "no modal, no vocabulary hits"}
+    if not modal and question:
+        return {"is_nlacp": False, "confidence": 0.85, "reason": "question without modal"}
+    return {"is_nlacp": None, "confidence": 0.5, "reason": "uncertain"}
@@ -0,0 +1,223 @@
+import os
+import json
+import threading
+from functools import lru_cache
+
+from tools import norm
+
+# Motore di decisione sulle regole DSARCP generate (output di finish_payload).
+# Le regole sono indicizzate per soggetto → azione → risorsa; "none" in una regola è un jolly.
+# purpose e condition, se presenti nella regola, devono corrispondere a quelli della richiesta.
+# Combinazione deny-overrides: basta una deny applicabile; senza regole applicabili vale DECISION_DEFAULT.
+POLICY_DIR = os.getenv("POLICY_DIR", os.path.join(os.path.dirname(__file__), "policies"))
+DECISION_DEFAULT = os.getenv("DECISION_DEFAULT", "deny").strip().lower()
+DECISION_CACHE_SIZE = int(os.getenv("DECISION_CACHE_SIZE", "65536"))
+
+WILDCARD = "none"
+FIELDS = ("subject", "action", "resource", "purpose", "condition")
+
+
+# policy o richiesta malformata (arriva dal client): l'endpoint risponde 400
+class InvalidRequest(ValueError):
+    pass
+
+
+def _scalar(value):
+    return value is None or isinstance(value, (str, int, float))
+
+
+# valore di una richiesta -> chiave dell'indice (None = attributo assente).
+# I valori ripetuti (pochi termini di vocabolario) non si rinormalizzano.
+_canon_memo = {}
+
+def canon(value):
+    if value is None:
+        return None
+    out = _canon_memo.get(value, False)
+    if out is False:
+        out = " ".join(str(value).lower().split())
+        out = out if out and out != WILDCARD else None
+        if len(_canon_memo) >= DECISION_CACHE_SIZE:
+            _canon_memo.clear()
+        _canon_memo[value] = out
+    return out
+
+
+@lru_cache(maxsize=DECISION_CACHE_SIZE)
+def _rule_key(value):
+    value = norm(str(value)) if value is not None else WILDCARD
+    return None if value in ("", WILDCARD) else value
+
+
+class _Leaf:
+    __slots__ = ("deny", "allow", "conditional")
+
+    def __init__(self):
+        # indici delle regole incondizionate per effetto: la prima basta a decidere
+        self.deny = []
+        self.allow = []
+        # (purpose, condition, decision, indice) per le regole con purpose/condition
+        self.conditional = []
+
+
+class PolicyEngine:
+    def __init__(self, rules, default=DECISION_DEFAULT, cache_size=DECISION_CACHE_SIZE):
+        self.rules = list(rules)
+        self.default = default
+        self.cache_size = cache_size
+        self._cache = {}
+        # chiave None = jolly ("none" nella regola)
+        self._tree = {}
+        for i, r in enumerate(self.rules):
+            if not isinstance(r, dict) or not all(_scalar(r.get(k)) for k in FIELDS + ("decision",)):
+                raise InvalidRequest(f"rule {i} must be an object with string attributes")
+            decision = "allow" if r.get("decision") == "allow" else "deny"
+            s, a, res = _rule_key(r.get("subject")), _rule_key(r.get("action")), _rule_key(r.get("resource"))
+            leaf = self._tree.setdefault(s, {}).setdefault(a, {}).get(res)
+            if leaf is None:
+                leaf = self._tree[s][a][res] = _Leaf()
+            purpose, condition = _rule_key(r.get("purpose")), _rule_key(r.get("condition"))
+            if purpose is None and condition is None:
+                (leaf.deny if decision == "deny" else leaf.allow).append(i)
+            else:
+                leaf.conditional.append((purpose, condition, decision, i))
+
+    @classmethod
+    def from_payloads(cls, payloads, **kwargs):
+        if not all(isinstance(p, dict) and isinstance(p.get("dsarcp") or [], list) for p in payloads):
+            raise InvalidRequest("each policy must be an object with a dsarcp list")
+        return cls([r for p in payloads for r in (p.get("dsarcp") or [])], **kwargs)
+
+    def _leaves(self, s, a, r):
+        tree = self._tree
+        for sk in (s, None) if s is not None else (None,):
+            actions = tree.get(sk)
+            if actions is None:
+                continue
+            for ak in (a, None) if a is not None else (None,):
+                resources = actions.get(ak)
+                if resources is None:
+                    continue
+                for rk in (r, None) if r is not None else (None,):
+                    leaf = resources.get(rk)
+                    if leaf is not None:
+                        yield leaf
+
+    # (decisione, applicabile, indice di una regola che la determina); argomenti già canon().
+    # Alla prima deny applicabile si smette di cercare.
+    def evaluate(self, subject, action, resource, purpose=None, conditions=frozenset()):
+        key = (subject, action, resource, purpose, conditions)
+        hit = self._cache.get(key)
+        if hit is not None:
+            return hit
+
+        out = None
+        allow = None
+        for leaf in self._leaves(subject, action, resource):
+            if leaf.deny:
+                out = ("deny", True, leaf.deny[0])
+                break
+            if allow is None and leaf.allow:
+                allow = leaf.allow[0]
+            for p, c, decision, i in leaf.conditional:
+                if (p is None or p == purpose) and (c is None or c in conditions):
+                    if decision == "deny":
+                        out = ("deny", True, i)
+                        break
+                    if allow is None:
+                        allow = i
+            if out is not None:
+                break
+        if out is None:
+            out = ("allow", True, allow) if allow is not None else (self.default, False, None)
+
+        if self.cache_size:
+            if len(self._cache) >= self.cache_size:
+                self._cache.clear()
+            self._cache[key] = out
+        return out
+
+    # tutte le regole applicabili con l'effetto deciso (solo per explain)
+    def matching(self, subject, action, resource, purpose, conditions, decision):
+        out = []
+        for leaf in self._leaves(subject, action, resource):
+            out.extend(leaf.deny if decision == "deny" else leaf.allow)
+            out.extend(i for p, c, d, i in leaf.conditional
+                       if d == decision and (p is None or p == purpose) and (c is None or c in conditions))
+        return sorted(out)
+
+    # richiesta JSON {subject, action, resource, purpose?, condition? | conditions?}
+    def decide(self, request, explain=False):
+        if not isinstance(request, dict) or not all(_scalar(request.get(k)) for k in FIELDS):
+            raise InvalidRequest("request must be an object with string attributes")
+        conditions = request.get("conditions")
+        if conditions is None:
+            conditions = [request.get("condition")]
+        elif not isinstance(conditions, list) or not all(map(_scalar, conditions)):
+            raise InvalidRequest("conditions must be a list of strings")
+        args = (canon(request.get("subject")), canon(request.get("action")), canon(request.get("resource")),
+                canon(request.get("purpose")), frozenset(c for c in map(canon, conditions) if c is not None))
+        decision, applicable, _ = self.evaluate(*args)
+        out = {"decision": decision, "applicable": applicable}
+        if explain:
+            out["rules"] = [dict(self.rules[i], index=i) for i in self.matching(*args, decision)] if applicable else []
+        return out
+
+    def decide_many(self, requests, explain=False):
+        return [self.decide(r, explain) for r in requests]
+
+
+# payload salvati: un .json (un payload o una lista) oppure l'NDJSON di /api/generate/batch
+def load_payloads(path):
+    with open(path, "r", encoding="utf-8") as f:
+        if path.endswith(".ndjson") or path.endswith(".jsonl"):
+            items = [json.loads(line) for line in f if line.strip()]
+        else:
+            data = json.load(f)
+            items = data if isinstance(data, list) else [data]
+    # le righe di errore e il riepilogo del batch non hanno regole
+    return [p for p in items if isinstance(p, dict) and "dsarcp" in p]
+
+
+# un motore per environment, da tutti i payload in POLICY_DIR; ricompilato quando i file cambiano
+class PolicyDirectory:
+    def __init__(self, path=POLICY_DIR):
+        self.path = path
+        self._engines = {}
+        self._signature = None
+        self._lock = threading.Lock()
+
+    def _files(self):
+        try:
+            names = sorted(os.listdir(self.path))
+        except FileNotFoundError:
+            return ()
+        out = []
+        for name in names:
+            if name.endswith((".json", ".ndjson", ".jsonl")):
+                st = os.stat(os.path.join(self.path, name))
+                out.append((name, st.st_mtime_ns, st.st_size))
+        return tuple(out)
+
+    def _compile(self, files):
+        by_env = {}
+        for name, _, _ in files:
+            for p in load_payloads(os.path.join(self.path, name)):
+                by_env.setdefault((p.get("env") or "").strip().lower(), []).append(p)
+        return {env: PolicyEngine.from_payloads(payloads) for env, payloads in by_env.items()}
+
+    def engine(self, environment):
+        files = self._files()
+        if files != self._signature:
+            with self._lock:
+                if files != self._signature:
+                    self._engines = self._compile(files)
+                    self._signature = files
+        return self._engines.get(environment)
+
+    def environments(self):
+        self.engine(None)
+        return {env: len(e.rules) for env, e in self._engines.items()}
+
+
+POLICIES = PolicyDirectory()
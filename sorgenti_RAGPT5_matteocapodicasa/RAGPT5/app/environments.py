@@ -0,0 +1,270 @@
+import os
+import sys
+import mmap
+import threading
+import time
+from collections import OrderedDict
+from types import MappingProxyType
+
+from tools import DATA_DIR, ENTITY_TYPES, EntityIndex, parse_entities_text
+from classifier import VocabMatcher
+from vocabfile import CompiledVocab, source_stamp
+
+# budget di memoria per gli environment residenti (testo, sezioni, indici, file mappati); 0 = nessun limite.
+# Oltre il budget si scarta l'environment usato meno di recente, mai quelli in ENV_PINNED
+# (caricati e indicizzati all'avvio).
+ENV_MEMORY_MB = float(os.getenv("ENV_MEMORY_MB", "512"))
+ENV_PINNED = [n.strip().lower() for n in os.getenv("ENV_PINNED", "").split(",") if n.strip()]
+# caricati all'avvio ma soggetti all'LRU come gli altri (es. il preload di gunicorn)
+ENV_PRELOAD = [n.strip().lower() for n in os.getenv("ENV_PRELOAD", "").split(",") if n.strip()]
+
+
+# fotografia immutabile di data/<env>.txt: testo grezzo + sezioni parsate.
+# Le richieste in corso tengono il proprio snapshot anche se il file viene ricaricato.
+class EnvironmentSnapshot:
+    kind = "text"
+
+    def __init__(self, name, path, text, stamp):
+        self.name = name
+        self.path = path
+        self.text = text
+        self.stamp = stamp
+        self.loaded_at = time.time()
+        parsed = parse_entities_text(text)
+        self.sections = MappingProxyType({t: tuple(parsed.get(t, [])) for t in ENTITY_TYPES})
+        self._nbytes = sys.getsizeof(text) + sum(
+            sys.getsizeof(v) + sum(sys.getsizeof(s) for s in v) for v in self.sections.values())
+        self._index = None
+        self._index_lock = threading.Lock()
+        self._matcher = None
+
+    @classmethod
+    def load(cls, name, path, stamp):
+        with open(path, "rb") as f:
+            text = f.read().decode("utf-8")
+        return cls(name, path, text, stamp)
+
+    def matches(self, stamp):
+        return self.stamp == stamp
+
+    @property
+    def index(self):
+        if self._index is None:
+            with self._index_lock:
+                if self._index is None:
+                    self._index = EntityIndex(self.sections)
+        return self._index
+
+    # indice per parola del fast-path di Step 2 (classifier.py), costruito al primo uso
+    @property
+    def matcher(self):
+        if self._matcher is None:
+            with self._index_lock:
+                if self._matcher is None:
+                    self._matcher = VocabMatcher(self.sections)
+        return self._matcher
+
+    def warm(self):
+        self.index.build()
+
+    def nbytes(self):
+        return (self._nbytes + (self._index.nbytes() if self._index is not None else 0)
+                + (self._matcher.nbytes() if self._matcher is not None else 0))
+
+
+# snapshot di data/<env>.vocab (vocabfile.py): niente parsing né costruzione dell'indice,
+# sezioni e liste n-gram sono viste sul file mappato. Il testo non viene materializzato
+# (gli step usano solo sections e index).
+class CompiledSnapshot:
+    kind = "compiled"
+
+    def __init__(self, name, path, stamp):
+        self.name = name
+        self.path = path
+        self.text = ""
+        self.stamp = stamp
+        self.loaded_at = time.time()
+        self.vocab = CompiledVocab(path)
+        self.sections = MappingProxyType(self.vocab.sections())
+        self.index = EntityIndex(self.sections, matrices=self.vocab.matrices(), profiles=self.vocab.profiles())
+        self._matcher = None
+        self._matcher_lock = threading.Lock()
+
+    def matches(self, stamp):
+        return self.stamp == stamp
+
+    # chiede al kernel di portare in memoria le pagine del file (condivise tra i worker)
+    def warm(self):
+        if hasattr(mmap, "MADV_WILLNEED"):
+            self.vocab._mm.madvise(mmap.MADV_WILLNEED)
+
+    @property
+    def matcher(self):
+        if self._matcher is None:
+            with self._matcher_lock:
+                if self._matcher is None:
+                    self._matcher = VocabMatcher(self.sections)
+        return self._matcher
+
+    # le pagine mappate contano nel budget: sono memoria residente anche se condivisa
+    def nbytes(self):
+        return (self.vocab.nbytes + self.index.nbytes()
+                + (self._matcher.nbytes() if self._matcher is not None else 0))
+
+
+class EnvironmentRegistry:
+    def __init__(self, data_dir=DATA_DIR, budget_mb=ENV_MEMORY_MB, pinned=ENV_PINNED):
+        self.data_dir = data_dir
+        self.budget = int(budget_mb * 1024 * 1024)
+        self.pinned = set(pinned)
+        self._snapshots = OrderedDict()
+        self._reload_locks = {}
+        self._lock = threading.Lock()
+        self._stats = {}
+        self.counters = {"hits": 0, "loads": 0, "evictions": 0}
+        self.warmup_errors = {}
+
+    def path(self, name):
+        return os.path.join(self.data_dir, f"{name}.txt")
+
+    def compiled_path(self, name):
+        return os.path.join(self.data_dir, f"{name}.vocab")
+
+    def _reload_lock(self, name):
+        with self._lock:
+            return self._reload_locks.setdefault(name, threading.Lock())
+
+    # (stat del .txt, stat del .vocab), None se il file manca
+    def _stamp(self, name):
+        out = []
+        for path in (self.path(name), self.compiled_path(name)):
+            try:
+                out.append(tuple(source_stamp(os.stat(path))))
+            except FileNotFoundError:
+                out.append(None)
+        return tuple(out)
+
+    # il .vocab vale solo se è stato compilato dal .txt attuale (o se il .txt non c'è)
+    def _load(self, name, stamp):
+        txt, compiled = stamp
+        if compiled is not None:
+            try:
+                snap = CompiledSnapshot(name, self.compiled_path(name), stamp)
+                if txt is None or snap.vocab.source == txt:
+                    return snap
+            except ValueError:
+                pass
+        if txt is None:
+            raise FileNotFoundError(f"File data/{name}.txt non trovato")
+        return EnvironmentSnapshot.load(name, self.path(name), stamp)
+
+    def _env_stats(self, name):
+        return self._stats.setdefault(name, {"kind": None, "loads": 0, "hits": 0, "evictions": 0,
+                                             "load_ms": None, "index_ms": None, "bytes": 0})
+
+    # rivalida con mtime/size a ogni accesso (due stat, niente lettura)
+    def get(self, name):
+        stamp = self._stamp(name)
+        if stamp == (None, None):
+            with self._lock:
+                self._snapshots.pop(name, None)
+            raise FileNotFoundError(f"File data/{name}.txt non trovato")
+
+        snap = self._snapshots.get(name)
+        if snap is not None and snap.matches(stamp):
+            with self._lock:
+                if name in self._snapshots:
+                    self._snapshots.move_to_end(name)
+                self.counters["hits"] += 1
+                self._env_stats(name)["hits"] += 1
+            return snap
+
+        lock = self._reload_lock(name)
+        # se un altro thread sta già ricaricando, si serve lo snapshot precedente
+        if snap is not None and not lock.acquire(blocking=False):
+            return snap
+        if snap is None:
+            lock.acquire()
+        try:
+            cur = self._snapshots.get(name)
+            if cur is not None and cur is not snap and cur.matches(self._stamp(name)):
+                return cur
+            # l'indice si costruisce al caricamento: le richieste non lo ricostruiscono mai
+            t0 = time.perf_counter()
+            new = self._load(name, stamp)
+            t1 = time.perf_counter()
+            new.warm()
+            t2 = time.perf_counter()
+            self._store(name, new, (t1 - t0) * 1000, (t2 - t1) * 1000)
+            return new
+        finally:
+            lock.release()
+
+    def _store(self, name, snap, load_ms, index_ms):
+        with self._lock:
+            self._snapshots[name] = snap
+            self._snapshots.move_to_end(name)
+            self.counters["loads"] += 1
+            st = self._env_stats(name)
+            st.update(kind=snap.kind, load_ms=round(load_ms, 3), index_ms=round(index_ms, 3), bytes=snap.nbytes())
+            st["loads"] += 1
+            self._evict(keep=name)
+
+    # LRU: scarta dal più vecchio finché si rientra nel budget (chi tiene già lo snapshot continua a usarlo)
+    def _evict(self, keep):
+        if self.budget <= 0:
+            return
+        used = sum(s.nbytes() for s in self._snapshots.values())
+        for name in list(self._snapshots):
+            if used <= self.budget:
+                break
+            if name == keep or name in self.pinned:
+                continue
+            used -= self._snapshots.pop(name).nbytes()
+            self.counters["evictions"] += 1
+            self._stats[name]["evictions"] += 1
+
+    # carica e indicizza gli environment (fissati, se pin); quelli mancanti finiscono nelle statistiche
+    def warmup(self, names=None, pin=True):
+        names = list(names) if names is not None else sorted(self.pinned)
+        if pin:
+            self.pinned.update(names)
+        for name in names:
+            try:
+                self.get(name)
+                self.warmup_errors.pop(name, None)
+            except (OSError, ValueError) as e:
+                self.warmup_errors[name] = str(e)
+        return dict(self.warmup_errors)
+
+    def cached(self):
+        return dict(self._snapshots)
+
+    # VocabIndex della sezione di un environment residente (la stessa lista, non una copia); None se non c'è
+    def index_of(self, items):
+        for snap in list(self._snapshots.values()):
+            for t, section in snap.sections.items():
+                if section is items:
+                    return snap.index[t]
+        return None
+
+    def stats(self):
+        with self._lock:
+            out = dict(self.counters)
+            envs = {}
+            for name, st in self._stats.items():
+                envs[name] = dict(st)
+                snap = self._snapshots.get(name)
+                envs[name]["resident"] = snap is not None
+                envs[name]["pinned"] = name in self.pinned
+                if snap is not None:
+                    envs[name]["bytes"] = snap.nbytes()
+            out["resident"] = len(self._snapshots)
+            out["used_bytes"] = sum(s.nbytes() for s in self._snapshots.values())
+        out["budget_bytes"] = self.budget or None
+        out["environments"] = envs
+        out["warmup_errors"] = dict(self.warmup_errors)
+        return out
+
+
+REGISTRY = EnvironmentRegistry()
@@ -0,0 +1,64 @@
+import os
+import gc
+
+# Server di produzione prefork: il master importa l'app (environment, indici di similarità, prompt)
+# prima di creare i worker, che condividono quelle pagine copy-on-write.
+#   gunicorn -c gunicorn.conf.py app:app
+# Worker gthread: ogni richiesta (anche uno stream SSE /api/log) occupa un thread del worker.
+# Un worker riciclato dopo WEB_MAX_REQUESTS smette di accettare connessioni e finisce quelle in corso,
+# stream compresi, entro WEB_GRACEFUL_TIMEOUT (di default la deadline di una richiesta + margine).
+
+WEB_BIND = os.getenv("WEB_BIND", "0.0.0.0:8000")
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", "4"))
+WEB_THREADS = int(os.getenv("WEB_THREADS", "16"))
+WEB_MAX_REQUESTS = int(os.getenv("WEB_MAX_REQUESTS", "1000"))
+WEB_MAX_REQUESTS_JITTER = int(os.getenv("WEB_MAX_REQUESTS_JITTER", "100"))
+WEB_GRACEFUL_TIMEOUT = int(os.getenv("WEB_GRACEFUL_TIMEOUT", str(int(float(os.getenv("REQUEST_TIMEOUT", "300"))) + 30)))
+
+bind = WEB_BIND
+workers = WEB_WORKERS
+worker_class = "gthread"
+threads = WEB_THREADS
+preload_app = True
+max_requests = WEB_MAX_REQUESTS
+max_requests_jitter = WEB_MAX_REQUESTS_JITTER
+graceful_timeout = WEB_GRACEFUL_TIMEOUT
+keepalive = 5
+accesslog = "-"
+
+# senza ENV_PRELOAD il master carica e indicizza tutti gli environment di data/ senza fissarli: restano
+# soggetti a ENV_MEMORY_MB e all'LRU (letto da environments.py all'import dell'app, dopo questo file)
+_data = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+if not os.getenv("ENV_PRELOAD") and os.path.isdir(_data):
+    os.environ["ENV_PRELOAD"] = ",".join(sorted({os.path.splitext(n)[0] for n in os.listdir(_data)
+                                                if n.endswith((".txt", ".vocab"))}))
+
+
+# nel master, prima dei worker: via dal file condiviso le run di una generazione precedente
+def on_starting(server):
+    from runs import SharedRuns
+    SharedRuns().purge_stale()
+
+
+# dopo il preload: gli oggetti già creati escono dal GC, così i worker non ne toccano le pagine
+def when_ready(server):
+    gc.collect()
+    gc.freeze()
+
+
+# stato che non deve attraversare il fork: client HTTP, pool di thread, connessioni SQLite, run attive e loro log
+def post_fork(server, worker):
+    import agents
+    import hedging
+    from cache import CACHE
+    from ratelimit import LIMITER
+    from policystore import STORE
+    from runs import RUNS
+    from runlog import RUNLOGS
+
+    agents.reset_clients()
+    hedging.reset_pool()
+    for store in (CACHE, LIMITER.store, STORE):
+        store.reset()
+    RUNS.share()
+    RUNLOGS.share()
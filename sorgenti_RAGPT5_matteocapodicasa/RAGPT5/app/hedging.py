@@ -0,0 +1,326 @@
+import os
+import time
+import socket
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from runs import RunCancelled
+
+# Hedged request: se una chiamata supera il percentile di latenza dello step,
+# se ne lancia un duplicato e vince la prima risposta valida.
+HEDGE = os.getenv("HEDGE", "on").strip().lower() not in ("0", "off", "false", "no")
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+HEDGE_WINDOW = int(os.getenv("HEDGE_WINDOW", "200"))
+
+
+class LatencyTracker:
+    def __init__(self, window=HEDGE_WINDOW):
+        self.window = window
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, step, seconds):
+        with self._lock:
+            self._samples.setdefault(step, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, step, p):
+        with self._lock:
+            samples = sorted(self._samples.get(step, ()))
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
+
+    # dopo quanti secondi lanciare il duplicato (None = nessun hedge)
+    def hedge_after(self, step):
+        return self.percentile(step, HEDGE_PERCENTILE) if HEDGE else None
+
+
+LATENCY = LatencyTracker()
+# thread per i soli duplicati: la chiamata principale gira sul thread del chiamante. Se il pool è pieno
+# il duplicato non parte (non si accoda).
+HEDGE_POOL_SIZE = int(os.getenv("HEDGE_POOL_SIZE", "32"))
+# ogni quanto si controlla la cancellazione della run mentre la chiamata è in volo
+CANCEL_POLL = 0.1
+# quanto aspettare che un tentativo interrotto chiuda la sua connessione prima di contarne l'usage
+ABORT_GRACE = 1.0
+
+
+class Aborted(Exception):
+    pass
+
+
+# shutdown() e non close(): sblocca subito un recv fermo in un altro thread (HTTP/1.1, estensione
+# network_stream di httpcore). Senza socket il tentativo se ne accorge al chunk successivo.
+def _shutdown(stream):
+    response = getattr(stream, "response", None)
+    network = (getattr(response, "extensions", None) or {}).get("network_stream")
+    sock = network.get_extra_info("socket") if network is not None else None
+    if sock is None:
+        return
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+# un tentativo di chiamata. create(timeout, attempt) registra lo stream con bind() e controlla check()
+# tra un chunk e l'altro; abort() chiude la connessione del tentativo perdente o cancellato.
+class Attempt:
+    def __init__(self, hedge=False):
+        self.hedge = hedge
+        self.ticket = None
+        self.usage = None
+        # la principale è già stata ammessa dal chiamante, il duplicato passa da admit_hedge
+        self.admitted = not hedge
+        self.done = threading.Event()
+        self._aborted = threading.Event()
+        self._stream = None
+        self._lock = threading.Lock()
+
+    @property
+    def aborted(self):
+        return self._aborted.is_set()
+
+    # Event impostato all'abort: per le attese fuori dalla chiamata (es. il rate limiter)
+    @property
+    def cancel(self):
+        return self._aborted
+
+    def bind(self, stream):
+        with self._lock:
+            self._stream = stream
+        if self.aborted:
+            _shutdown(stream)
+        return stream
+
+    def abort(self):
+        with self._lock:
+            self._aborted.set()
+            stream = self._stream
+        if stream is not None:
+            _shutdown(stream)
+
+    def check(self):
+        if self.aborted:
+            raise Aborted()
+
+
+# una chiamata in corso: il watchdog la cancella, la fa scadere o lancia il duplicato
+class _Race:
+    def __init__(self, create, timeout, hedge_after, on_hedge, cancel, admit_hedge):
+        self.create = create
+        self.timeout = timeout
+        self.hedge_after = hedge_after
+        self.on_hedge = on_hedge
+        self.cancel = cancel
+        self.admit_hedge = admit_hedge
+        self.start = time.time()
+        self.primary = Attempt()
+        self.hedge = None
+        self.winner = None
+        self.response = None
+        self.error = None
+        self.reason = None
+        self._lock = threading.Lock()
+
+    # il primo tentativo riuscito vince e interrompe l'altro
+    def claim(self, attempt, response):
+        with self._lock:
+            if self.winner is not None or self.reason is not None:
+                return False
+            self.winner, self.response = attempt, response
+            other = self.hedge if attempt is self.primary else self.primary
+        if other is not None:
+            other.abort()
+        return True
+
+    def stop(self, reason):
+        with self._lock:
+            if self.winner is not None or self.reason is not None:
+                return
+            self.reason = reason
+            attempts = [a for a in (self.primary, self.hedge) if a is not None]
+        for a in attempts:
+            a.abort()
+
+    def tick(self, now):
+        if self.cancel is not None and self.cancel.is_set():
+            self.stop("cancelled")
+        elif now - self.start >= self.timeout:
+            self.stop("timeout")
+        elif self.hedge is None and self.hedge_after is not None and now - self.start >= self.hedge_after:
+            self._launch()
+
+    def _launch(self):
+        if not _slots.acquire(blocking=False):
+            self.hedge_after = None
+            return
+        self.hedge = Attempt(hedge=True)
+        if self.on_hedge:
+            self.on_hedge(self.hedge_after)
+        try:
+            _pool.submit(self._run_hedge, self.hedge)
+        except RuntimeError:
+            _slots.release()
+            self.hedge.done.set()
+
+    def _run_hedge(self, attempt):
+        try:
+            attempt.admitted = self.admit_hedge is None or self.admit_hedge(attempt)
+            if not attempt.admitted:
+                return
+            response = self.create(max(self.timeout - (time.time() - self.start), 0.001), attempt)
+            self.claim(attempt, response)
+        except Exception as e:
+            if not attempt.aborted:
+                self.error = self.error or e
+        finally:
+            attempt.done.set()
+            _slots.release()
+
+    # sul thread del chiamante, finita la chiamata principale
+    def finish(self, response, error):
+        if error is None:
+            self.claim(self.primary, response)
+        elif not self.primary.aborted:
+            self.error = error
+        hedge = self.hedge
+        # la principale è fallita da sola: resta il duplicato in volo, se c'è
+        if self.winner is None and self.reason is None and hedge is not None:
+            while not hedge.done.wait(CANCEL_POLL):
+                self.tick(time.time())
+        if hedge is not None and hedge is not self.winner:
+            hedge.abort()
+            hedge.done.wait(ABORT_GRACE)
+        losers = [a for a in (self.primary, hedge) if a is not None and a.admitted and a is not self.winner]
+        if self.winner is not None:
+            return self.response, hedge is not None and hedge.admitted, self.winner is hedge, losers
+        if self.reason == "cancelled":
+            raise RunCancelled()
+        if self.reason == "timeout" or self.error is None:
+            raise TimeoutError(f"no response within {self.timeout:.1f}s")
+        raise self.error
+
+
+# un solo thread controlla cancellazione, deadline e hedge di tutte le chiamate in corso
+class _Watchdog:
+    def __init__(self):
+        self._races = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add(self, race):
+        with self._lock:
+            self._races.add(race)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="hedge-watchdog", daemon=True)
+                self._thread.start()
+
+    def remove(self, race):
+        with self._lock:
+            self._races.discard(race)
+
+    def _run(self):
+        while True:
+            time.sleep(CANCEL_POLL / 2)
+            with self._lock:
+                races = list(self._races)
+            now = time.time()
+            for race in races:
+                race.tick(now)
+
+
+def _new_pool():
+    return ThreadPoolExecutor(max_workers=HEDGE_POOL_SIZE, thread_name_prefix="hedge"), \
+        threading.BoundedSemaphore(HEDGE_POOL_SIZE), _Watchdog()
+
+_pool, _slots, _watchdog = _new_pool()
+
+# i thread non sopravvivono al fork: ogni worker crea pool e watchdog propri
+def reset_pool():
+    global _pool, _slots, _watchdog
+    _pool, _slots, _watchdog = _new_pool()
+
+
+def _next_wake(elapsed, timeout, hedge_after, hedge_due, cancel):
+    wake = timeout - elapsed
+    if hedge_due:
+        wake = min(wake, hedge_after - elapsed)
+    if cancel is not None:
+        wake = min(wake, CANCEL_POLL)
+    return max(wake, 0)
+
+
+# create(timeout, attempt) -> response. Ritorna (response, hedged, hedge_won, losers): losers sono i
+# tentativi ammessi che hanno perso (con ticket e usage, se arrivato), da contabilizzare.
+# admit_hedge(attempt) -> bool prenota il duplicato (budget, rate limit); False = niente duplicato.
+# Solleva RunCancelled se l'Event `cancel` viene impostato durante l'attesa.
+def call_hedged(create, timeout, hedge_after, on_hedge=None, cancel=None, admit_hedge=None):
+    can_hedge = hedge_after is not None and hedge_after < timeout
+    if not can_hedge and cancel is None:
+        return create(timeout, Attempt()), False, False, []
+
+    race = _Race(create, timeout, hedge_after if can_hedge else None, on_hedge, cancel, admit_hedge)
+    _watchdog.add(race)
+    try:
+        try:
+            response, error = create(timeout, race.primary), None
+        except Exception as e:
+            response, error = None, e
+        return race.finish(response, error)
+    finally:
+        _watchdog.remove(race)
+
+
+async def acall_hedged(create, timeout, hedge_after, on_hedge=None, cancel=None, admit_hedge=None):
+    can_hedge = hedge_after is not None and hedge_after < timeout
+    primary = Attempt()
+    if not can_hedge and cancel is None:
+        return await create(timeout, primary), False, False, []
+
+    async def run_hedge(attempt, remaining):
+        attempt.admitted = admit_hedge is None or await admit_hedge(attempt)
+        if not attempt.admitted:
+            raise Aborted()
+        return await create(remaining, attempt)
+
+    start = time.time()
+    attempts = {asyncio.ensure_future(create(timeout, primary)): primary}
+    pending = set(attempts)
+    winner = error = None
+    try:
+        while pending:
+            elapsed = time.time() - start
+            if elapsed >= timeout:
+                break
+            if cancel is not None and cancel.is_set():
+                raise RunCancelled()
+            hedge_due = can_hedge and len(attempts) == 1
+            done, pending = await asyncio.wait(pending, timeout=_next_wake(elapsed, timeout, hedge_after, hedge_due, cancel),
+                                               return_when=asyncio.FIRST_COMPLETED)
+            for t in done:
+                if t.exception() is None:
+                    winner = t
+                    break
+                if not isinstance(t.exception(), Aborted):
+                    error = t.exception()
+            if winner is not None:
+                break
+            if pending and hedge_due and time.time() - start >= hedge_after:
+                if on_hedge:
+                    on_hedge(hedge_after)
+                hedge = Attempt(hedge=True)
+                attempts[asyncio.ensure_future(run_hedge(hedge, max(timeout - (time.time() - start), 0.001)))] = hedge
+                pending = {t for t in attempts if not t.done()}
+        if winner is None:
+            raise error or TimeoutError(f"no response within {timeout:.1f}s")
+        hedges = [a for a in attempts.values() if a.hedge and a.admitted]
+        losers = [a for t, a in attempts.items() if t is not winner and a.admitted]
+        return winner.result(), bool(hedges), attempts[winner].hedge, losers
+    finally:
+        # le richieste perse o cancellate vengono annullate (la connessione si chiude)
+        for t in attempts:
+            if not t.done():
+                t.cancel()
@@ -0,0 +1,94 @@
+import json
+
+# Parser JSON incrementale: riceve il testo a pezzi (token in streaming) e restituisce
+# gli elementi di un array (es. policy_json.dsarcp) appena il loro oggetto si chiude,
+# senza aspettare la fine della risposta. Non valida il resto del documento:
+# alla fine la risposta completa viene comunque parsata con json.loads.
+
+
+class ArrayItemStream:
+    def __init__(self, path=("policy_json", "dsarcp")):
+        self.path = tuple(path)
+        self.text = []
+        # finestra del testo ancora utile: buf[0] è la posizione assoluta base,
+        # pending sono i pezzi arrivati dopo l'ultimo slice
+        self.buf = ""
+        self.base = 0
+        self.pending = []
+        self.pos = 0
+        self.open_item = None
+        # per ogni contenitore aperto: [tipo "{" o "[", chiave nel padre, inizio, è un elemento cercato]
+        self.stack = []
+        self.in_string = False
+        self.escape = False
+        self.string_start = None
+        self.last_string = None
+        self.key = None
+        self.items = 0
+
+    def _target(self):
+        # l'oggetto che si sta aprendo/chiudendo è un elemento dell'array cercato?
+        return bool(self.stack) and self.stack[-1][0] == "[" and \
+            tuple(e[1] for e in self.stack[1:]) == self.path
+
+    def feed(self, chunk):
+        out = []
+        self.text.append(chunk)
+        self.pending.append(chunk)
+        for ch in chunk:
+            pos = self.pos
+            self.pos += 1
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+                    self.last_string = (self.string_start, pos)
+                continue
+            if ch == '"':
+                self.in_string = True
+                self.string_start = pos + 1
+            elif ch == ":":
+                if self.stack and self.stack[-1][0] == "{" and self.last_string:
+                    self.key = self._slice(*self.last_string)
+            elif ch in "{[":
+                parent_key = self.key if self.stack and self.stack[-1][0] == "{" else None
+                target = ch == "{" and self._target()
+                if target:
+                    self.open_item = pos
+                self.stack.append([ch, parent_key, pos, target])
+                self.key = None
+            elif ch in "}]":
+                if not self.stack:
+                    continue
+                kind, _, start, target = self.stack.pop()
+                if target and kind == "{":
+                    self.open_item = None
+                    try:
+                        out.append(json.loads(self._slice(start, pos + 1)))
+                        self.items += 1
+                    except ValueError:
+                        pass
+                self.key = None
+            elif ch == ",":
+                self.key = None
+        return out
+
+    def _slice(self, start, end):
+        # prima di start serve solo l'eventuale elemento ancora aperto: il resto si scarta,
+        # così il buffer resta grande quanto l'elemento corrente e non quanto la risposta
+        keep = max(self.base, start if self.open_item is None else min(start, self.open_item))
+        new = "".join(self.pending)
+        self.pending = []
+        tail = self.base + len(self.buf)
+        if keep >= tail:
+            self.buf = new[keep - tail:]
+        else:
+            self.buf = self.buf[keep - self.base:] + new
+        self.base = keep
+        return self.buf[start - self.base:end - self.base]
+
+    def value(self):
+        return "".join(self.text)
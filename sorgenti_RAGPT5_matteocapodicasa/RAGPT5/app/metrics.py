@@ -0,0 +1,229 @@
+import time
+import threading
+from runs import RUNS
+from runlog import RUNLOGS
+from cache import CACHE
+from environments import REGISTRY
+from ratelimit import LIMITER
+
+# Metriche sempre attive (anche senza logger, es. /api/generate), esposte su /metrics
+# nel formato testuale di Prometheus. Valori per processo, tenuti in memoria.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+STEP_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+RUN_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+ITER_BUCKETS = (0, 1, 2, 3, 5, 8)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+def _num(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(l, "")) for l in self.labelnames)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_labels(self.labelnames, key)} {_num(v)}" for key, v in items]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def dec(self, value=1, **labels):
+        self.inc(-value, **labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=STEP_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * len(self.buckets), 0.0)
+            for i, upper in enumerate(self.buckets):
+                if value <= upper:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    def samples(self):
+        with self._lock:
+            items = sorted((k, (list(c), s)) for k, (c, s) in self._values.items())
+        out = []
+        for key, (counts, total) in items:
+            for upper, n in zip(self.buckets, counts):
+                out.append(f"{self.name}_bucket{_labels(self.labelnames, key, [('le', _num(upper))])} {n}")
+            out.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_num(total)}")
+            out.append(f"{self.name}_count{_labels(self.labelnames, key)} {counts[-1]}")
+        return out
+
+
+# valori letti al momento dello scrape da chi li possiede già (RUNS, CACHE, ...):
+# fn() -> numero, oppure {tupla di label: numero}
+class Callback(Metric):
+    def __init__(self, name, help, fn, kind="gauge", labels=()):
+        super().__init__(name, help, labels)
+        self.kind = kind
+        self.fn = fn
+
+    def samples(self):
+        values = self.fn()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [f"{self.name}{_labels(self.labelnames, key)} {_num(v)}"
+                for key, v in sorted(values.items()) if v is not None]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self.register(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=STEP_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def callback(self, name, help, fn, kind="gauge", labels=()):
+        return self.register(Callback(name, help, fn, kind, labels))
+
+    def render(self):
+        lines = []
+        for m in self._metrics:
+            lines.extend(m.header())
+            lines.extend(m.samples())
+        return "\n".join(lines) + "\n"
+
+
+METRICS = MetricsRegistry()
+
+STEP_SECONDS = METRICS.histogram(
+    "ragpt5_step_duration_seconds", "Duration of a pipeline step (model call included).", ("step",))
+FIRST_RULE = METRICS.histogram(
+    "ragpt5_first_rule_seconds", "Time from the start of a streamed generate/refine call to its first snapped rule.", ("step",))
+LLM_CALLS = METRICS.counter(
+    "ragpt5_llm_calls_total", "Model calls by step and outcome (ok, cache_hit, parse_error, empty, timeout, error, cancelled).",
+    ("step", "outcome"))
+LLM_IN_FLIGHT = METRICS.gauge("ragpt5_llm_calls_in_flight", "Model calls currently waiting for a response.")
+LLM_IN_FLIGHT.set(0)
+TOKENS = METRICS.counter(
+    "ragpt5_tokens_total", "Tokens reported by the model, by step, environment and kind (prompt, completion, cached).",
+    ("step", "env", "kind"))
+FUSED = METRICS.counter("ragpt5_fused_total", "Fused front-end calls by outcome (ok, fallback).", ("outcome",))
+HEDGES = METRICS.counter("ragpt5_hedges_total", "Hedged requests by step and result (fired, won).", ("step", "result"))
+VERIFIER = METRICS.counter("ragpt5_verifier_outcomes_total", "Verifier outcomes by environment and status.",
+                           ("env", "status"))
+RUNS_TOTAL = METRICS.counter(
+    "ragpt5_runs_total", "Finished runs by environment and outcome (correct, incorrect, not_nlacp, cancelled).",
+    ("env", "outcome"))
+LLM_SECONDS = METRICS.histogram(
+    "ragpt5_llm_call_seconds", "Model call latency by step, environment and provider prefix cache (hit, miss).",
+    ("step", "env", "prefix_cache"))
+QUEUE_WAIT = METRICS.histogram("ragpt5_llm_queue_wait_seconds", "Time a model call waited for the rate limiter.",
+                               ("step", "priority"))
+SPECULATIVE = METRICS.counter("ragpt5_speculative_steps_total",
+                              "Speculative identify/retrieve steps by outcome (adopted, discarded).", ("step", "outcome"))
+SPECULATIVE_WASTED = METRICS.counter("ragpt5_speculative_tokens_wasted_total",
+                                     "Tokens spent on discarded speculative steps.", ("step",))
+RUN_SECONDS = METRICS.histogram("ragpt5_run_duration_seconds", "Duration of a whole run.", ("env",), RUN_BUCKETS)
+RUN_ITERATIONS = METRICS.histogram("ragpt5_run_iterations", "Refinement iterations per run.", ("env",), ITER_BUCKETS)
+
+METRICS.callback("ragpt5_runs_in_flight", "Runs currently executing.", lambda: RUNS.stats()["active"])
+METRICS.callback("ragpt5_calls_saved_total", "Model calls avoided by cancelling runs (estimate).",
+                 lambda: RUNS.stats()["calls_saved"], "counter")
+METRICS.callback("ragpt5_run_logs_retained", "Run event logs kept for Last-Event-ID resume.",
+                 lambda: RUNLOGS.stats()["retained"])
+METRICS.callback("ragpt5_run_log_resumes_total", "/api/log streams resumed from a run event log.",
+                 lambda: RUNLOGS.stats()["resumed"], "counter")
+METRICS.callback("ragpt5_cache_lookups_total", "Response cache lookups by result.",
+                 lambda: {(k,): v for k, v in CACHE.stats().items() if k in ("memory_hits", "disk_hits", "misses")},
+                 "counter", ("result",))
+METRICS.callback("ragpt5_cache_memory_entries", "Entries in the in-memory response cache.",
+                 lambda: CACHE.stats()["memory_entries"])
+METRICS.callback("ragpt5_llm_calls_queued", "Model calls waiting for the rate limiter in this process.",
+                 lambda: LIMITER.stats()["waiting"])
+METRICS.callback("ragpt5_environment_bytes", "Memory footprint of resident environments.",
+                 lambda: {(k,): v["bytes"] for k, v in REGISTRY.stats()["environments"].items() if v["resident"]},
+                 labels=("env",))
+METRICS.callback("ragpt5_environment_loads_total", "Environment loads (parse or map + index build).",
+                 lambda: {(k,): v["loads"] for k, v in REGISTRY.stats()["environments"].items()},
+                 "counter", ("env",))
+METRICS.callback("ragpt5_environment_evictions_total", "Environments evicted to stay within ENV_MEMORY_MB.",
+                 lambda: REGISTRY.counters["evictions"], "counter")
+
+
+def observe_step(step, started):
+    STEP_SECONDS.observe(time.time() - started, step=step)
+
+def observe_run(state, started):
+    env = state.get("env") or ""
+    status = ((state.get("verifier_output") or {}).get("status") or "").strip().lower()
+    if state.get("cancelled"):
+        outcome = "cancelled"
+    elif state.get("is_nlacp") is False:
+        outcome = "not_nlacp"
+    else:
+        outcome = "correct" if status == "correct" else "incorrect"
+    RUNS_TOTAL.inc(env=env, outcome=outcome)
+    RUN_SECONDS.observe(time.time() - started, env=env)
+    RUN_ITERATIONS.observe(state.get("n_iter", 0), env=env)
+
+def observe_speculation(step, adopted, tokens):
+    SPECULATIVE.inc(step=step, outcome="adopted" if adopted else "discarded")
+    if not adopted:
+        SPECULATIVE_WASTED.inc(tokens, step=step)
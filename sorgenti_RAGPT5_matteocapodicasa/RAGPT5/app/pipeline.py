@@ -0,0 +1,538 @@
+import os
+import re
+import time
+import uuid
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, wait
+from agents import (
+    agent_preprocess,
+    agent_identify,
+    agent_retrieve,
+    agent_generate,
+    agent_verify,
+    agent_fused,
+    ASYNC_AGENTS,
+    RETRIEVE_MODE,
+    LLM_STREAM,
+    CallBudget,
+    calls_used,
+    deadline_passed,
+    cancelled
+)
+from runs import RUNS
+from ratelimit import PRIORITIES
+from metrics import observe_step, observe_run, observe_speculation
+
+MAX_ITER = int(os.getenv("MAX_ITER", "3"))
+MAX_CALLS = int(os.getenv("MAX_CALLS", "12"))
+# deadline di default di una richiesta (secondi), propagata a tutti gli step
+REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", "300"))
+# fan-out: dopo il pre-processing ogni statement fa identify → verify in concorrenza
+FANOUT = os.getenv("FANOUT", "on").strip().lower() not in ("0", "off", "false", "no")
+FANOUT_CONCURRENCY = int(os.getenv("FANOUT_CONCURRENCY", "4"))
+FANOUT_POLL = 0.2
+# "classic" = step 1, 2 e 3 separati; "fused" = una sola chiamata per i tre (fallback al classico)
+PIPELINE_MODES = ("classic", "fused")
+PIPELINE_MODE = os.getenv("PIPELINE_MODE", "classic").strip().lower()
+# speculazione (opt-in, solo classic): identify e retrieve partono sugli statement del testo grezzo mentre
+# gira il pre-processing; si tengono se il testo pre-processato ha almeno SPECULATE_MIN_OVERLAP
+# delle parole in comune con quello grezzo, altrimenti le chiamate sono sprecate
+SPECULATE = os.getenv("SPECULATE", "off").strip().lower() in ("1", "on", "true", "yes")
+SPECULATE_MIN_OVERLAP = float(os.getenv("SPECULATE_MIN_OVERLAP", "0.8"))
+
+
+def overdo(state):
+    hit = state["complete"] \
+          or calls_used(state) >= state.get("max_calls", MAX_CALLS) or state["n_iter"] >= state.get("max_iter", MAX_ITER) \
+          or deadline_passed(state) or cancelled(state)
+    if hit:
+        state["complete"] = True
+    return hit
+
+def init_state(text, environment, env_data="", cache_bypass=False, timeout=None, run_id=None, mode=None,
+               stream=None, priority=None, speculate=None):
+    return {
+        "id": run_id or str(uuid.uuid4()),
+        "mode": mode if mode in PIPELINE_MODES else PIPELINE_MODE,
+        "env": environment,
+        "env_data": env_data,
+        "input_text": text,
+        "text_preproc": None,
+        "is_nlacp": None,
+        "env_var": {"subjects": [], "actions": [], "resources": [], "purposes": [], "conditions": []},
+        "policy_json": {"dsarcp": []},
+        "verifier_output": {"status": "unknown", "error": ""},
+        "has_verified": False,
+        "n_iter": 0,
+        "n_calls": 0,
+        "n_cache_hits": 0,
+        "cache_bypass": cache_bypass,
+        "stream": LLM_STREAM if stream is None else stream,
+        "priority": priority if priority in PRIORITIES else "default",
+        "speculate": SPECULATE if speculate is None else speculate,
+        "max_iter": MAX_ITER,
+        "max_calls": MAX_CALLS,
+        "complete": False,
+        "feedback": None,
+        "usage": {},
+        "deadline": time.time() + (timeout or REQUEST_TIMEOUT),
+        "deadline_exceeded": False,
+        "timeouts": 0,
+        "hedges_fired": 0,
+        "hedges_won": 0,
+        "errors": []
+    }
+
+def finish_payload(state, start_time):
+    elapsed = int((time.time() - start_time) * 1000)
+    return {
+        "dsarcp": state.get("policy_json", {}).get("dsarcp", []),
+        "verifier_output": state.get("verifier_output"),
+        "n_iter": state.get("n_iter"),
+        "n_calls": state.get("n_calls"),
+        "n_cache_hits": state.get("n_cache_hits", 0),
+        "complete": state.get("complete"),
+        "env": state.get("env"),
+        "id": state.get("id"),
+        "mode": state.get("mode"),
+        "front": state.get("front"),
+        "usage": state.get("usage", {}),
+        "statements": state.get("statements"),
+        "speculation": state.get("speculation"),
+        "latency": {
+            "deadline_exceeded": state.get("deadline_exceeded", False),
+            "timeouts": state.get("timeouts", 0),
+            "hedges_fired": state.get("hedges_fired", 0),
+            "hedges_won": state.get("hedges_won", 0)
+        },
+        "errors": state.get("errors", []),
+        "cancelled": state.get("cancelled", False),
+        "calls_saved": state.get("calls_saved", 0),
+        "elapsed_ms": elapsed
+    }
+
+
+def split_statements(text):
+    parts = re.split(r"(?<=[.;!?])\s+|\n+", text or "")
+    return [p.strip() for p in parts if p and p.strip(" .;!?")]
+
+# sotto-state di uno statement: stessi limiti e stesso budget di chiamate del padre
+def statement_state(state, index, text, budget):
+    sub = init_state(state["input_text"], state["env"], state.get("env_data", ""), state.get("cache_bypass", False))
+    sub.update({
+        "id": state["id"],
+        "statement": index,
+        "text_preproc": text,
+        "max_iter": state.get("max_iter", MAX_ITER),
+        "max_calls": state.get("max_calls", MAX_CALLS),
+        "deadline": state.get("deadline"),
+        "cancel": state.get("cancel"),
+        "stream": state.get("stream", False),
+        "priority": state.get("priority", "default"),
+        "budget": budget,
+    })
+    return sub
+
+# usage e contatori di un sotto-state sommati a quelli del padre
+def merge_usage(state, sub):
+    usage = state.setdefault("usage", {})
+    for step, counts in sub.get("usage", {}).items():
+        acc = usage.setdefault(step, dict.fromkeys(counts, 0))
+        for k, v in counts.items():
+            acc[k] = acc.get(k, 0) + v
+    for k in ("n_cache_hits", "timeouts", "hedges_fired", "hedges_won"):
+        state[k] = state.get(k, 0) + sub.get(k, 0)
+
+def merge_statements(state, subs):
+    rules, errors, statements = [], [], []
+    for sub in subs:
+        rules.extend(sub["policy_json"].get("dsarcp", []))
+        status = (sub.get("verifier_output") or {}).get("status", "")
+        if sub.get("is_nlacp") is not False and status.strip().lower() != "correct":
+            errors.append(f"[{sub['statement']}] {(sub.get('verifier_output') or {}).get('error', '')}".strip())
+        merge_usage(state, sub)
+        state.setdefault("errors", []).extend(dict(e, statement=sub["statement"]) for e in sub.get("errors", []))
+        state["deadline_exceeded"] = state.get("deadline_exceeded") or sub.get("deadline_exceeded", False)
+        statements.append({
+            "statement": sub["statement"],
+            "text_preproc": sub["text_preproc"],
+            "is_nlacp": sub.get("is_nlacp"),
+            "verifier_output": sub.get("verifier_output"),
+            "n_iter": sub["n_iter"],
+            "n_calls": sub["n_calls"],
+            "rules_count": len(sub["policy_json"].get("dsarcp", [])),
+        })
+
+    state["policy_json"] = {"dsarcp": rules}
+    state["is_nlacp"] = any(sub.get("is_nlacp") for sub in subs)
+    state["verifier_output"] = {"status": "incorrect" if errors else "correct", "error": "; ".join(errors)}
+    state["has_verified"] = True
+    state["n_iter"] = max(sub["n_iter"] for sub in subs)
+    state["n_calls"] = state["budget"].used
+    state["complete"] = any(sub["complete"] for sub in subs)
+    state["statements"] = statements
+
+
+# gruppo di flussi da eseguire in concorrenza (uno per statement, o pre-processing + speculazione)
+class Parallel:
+    def __init__(self, flows):
+        self.flows = flows
+
+
+# flusso di un solo step; la durata (dallo yield alla ripresa) finisce in times[key]
+def _timed(agent, st, kwargs, times, key):
+    started = time.time()
+    yield agent, st, kwargs
+    times[key] = time.time() - started
+
+
+def _words(text):
+    return set(re.findall(r"\w+", (text or "").lower()))
+
+def _overlap(a, b):
+    a, b = _words(a), _words(b)
+    return len(a & b) / len(a | b) if a | b else 1.0
+
+
+# identify e retrieve speculativi, uno per statement del testo grezzo, su sotto-state che condividono
+# il budget di chiamate della run (MAX_CALLS vale anche per loro)
+class Speculation:
+    def __init__(self, state, logger=None):
+        raw = split_statements(state["input_text"]) if FANOUT else []
+        self.texts = raw if len(raw) > 1 else [state["input_text"]]
+        self.state = state
+        self.logger = logger
+        budget = state.get("budget") or CallBudget(state["n_calls"])
+        state["budget"] = budget
+        self.identify = [statement_state(state, i, t, budget) for i, t in enumerate(self.texts)]
+        self.retrieve = [statement_state(state, i, t, budget) for i, t in enumerate(self.texts)]
+        self.times = {}
+        self.adopted = {}
+
+    # chiamate che la speculazione può fare nel caso peggiore
+    def max_calls(self):
+        return len(self.texts) * (2 if RETRIEVE_MODE == "rerank" else 1)
+
+    # si specula solo se restano comunque le chiamate per pre-processing, generate e verify di ogni statement
+    def affordable(self):
+        needed = 1 + 2 * len(self.texts)
+        return calls_used(self.state) + self.max_calls() + needed <= self.state.get("max_calls", MAX_CALLS)
+
+    def flows(self):
+        log = lambda i: _speculative(_tagged(self.logger, i) if len(self.texts) > 1 else self.logger)
+        out = [_timed(agent_preprocess, self.state, {"logger": self.logger}, self.times, "preprocess")]
+        for i in range(len(self.texts)):
+            out.append(_timed(agent_identify, self.identify[i], {"logger": log(i)}, self.times, ("identify", i)))
+            out.append(_timed(agent_retrieve, self.retrieve[i], {"logger": log(i)}, self.times, ("retrieve", i)))
+        return out
+
+    # texts: statement del testo pre-processato. Per ogni statement grezzo che corrisponde si tengono
+    # identify e, se è una policy, retrieve; il resto è scartato (is_nlacp falso scarta retrieve)
+    def reconcile(self, texts, wall):
+        matched = len(texts) == len(self.texts)
+        serial = 0.0
+        wasted = {"calls": 0, "tokens": 0}
+        for i, raw in enumerate(self.texts):
+            ident, retr = self.identify[i], self.retrieve[i]
+            steps = ()
+            if matched and _overlap(raw, texts[i]) >= SPECULATE_MIN_OVERLAP \
+                    and ident.get("is_nlacp") is not None and not ident["errors"]:
+                steps = ("identify", "retrieve") if ident["is_nlacp"] and not retr["errors"] else ("identify",)
+            self.adopted[i] = steps
+            serial = max(serial, sum(self.times.get((step, i), 0.0) for step in steps))
+            for step, sub in (("identify", ident), ("retrieve", retr)):
+                merge_usage(self.state, sub)
+                tokens = sum(u["prompt_tokens"] + u["completion_tokens"] for u in sub["usage"].values())
+                observe_speculation(step, step in steps, tokens)
+                if step not in steps:
+                    wasted["calls"] += sub["n_calls"]
+                    wasted["tokens"] += tokens
+        self.state["n_calls"] = self.state["budget"].used
+        # senza speculazione gli step tenuti sarebbero partiti dopo il pre-processing
+        saved = self.times.get("preprocess", 0.0) + serial - wall
+        report = {
+            "statements": len(self.texts),
+            "matched": matched,
+            "adopted": {step: sum(step in s for s in self.adopted.values()) for step in ("identify", "retrieve")},
+            "calls": sum(sub["n_calls"] for sub in self.identify + self.retrieve),
+            "calls_wasted": wasted["calls"],
+            "tokens_wasted": wasted["tokens"],
+            "latency_saved_ms": int(saved * 1000),
+        }
+        self.state["speculation"] = report
+        return report
+
+    # risultati tenuti per lo statement i copiati nello state che prosegue la pipeline
+    def adopt(self, i, target):
+        steps = self.adopted.get(i, ())
+        if "identify" in steps:
+            target["is_nlacp"] = self.identify[i]["is_nlacp"]
+        if "retrieve" in steps:
+            target["env_var"] = self.retrieve[i]["env_var"]
+        target["adopted"] = steps
+
+
+def _speculative(logger):
+    if logger is None:
+        return None
+    def log(event):
+        event["speculative"] = True
+        logger(event)
+    return log
+
+
+# sequenza degli step 1–6, condivisa da /api/generate, /api/generate/batch, /api/log e dall'ASGI.
+# Non esegue gli agenti: fa yield di (agente, state, kwargs) o di un Parallel e lascia
+# l'esecuzione al driver sincrono (run_steps) o asincrono (arun_steps).
+def _flow(state, logger=None, attack=None):
+    log = logger or (lambda event: None)
+
+    # Step 1–3 fusi
+    if state.get("mode") == "fused":
+        log({"step": "1-3", "phase": "start", "msg": "fused front-end"})
+        yield agent_fused, state, {"logger": logger}
+        front = state.get("front") or {}
+        log({"step": "1-3", "phase": "end", "fallback": front.get("fallback"), "reason": front.get("reason")})
+        if overdo(state):
+            return
+        if front.get("fallback") is False:
+            statements = split_statements(state.get("text_preproc")) if FANOUT else []
+            if len(statements) <= 1:
+                yield from _policy_flow(state, logger, attack)
+            else:
+                # più statement: il testo pre-processato resta, identify e retrieve si rifanno per statement
+                yield from _fanout(state, statements, logger, attack)
+            return
+
+    spec = Speculation(state, logger) if state.get("speculate") else None
+    if spec is not None and not spec.affordable():
+        state["speculation"] = {"statements": len(spec.texts), "skipped": "max_calls"}
+        log(dict(state["speculation"], event="speculation"))
+        spec = None
+
+    # Step 1 (con identify e retrieve speculativi in parallelo)
+    log({"step": 1, "phase": "start", "msg": "pre-processing", "speculative": spec is not None})
+    if spec is None:
+        yield agent_preprocess, state, {"logger": logger}
+    else:
+        started = time.time()
+        yield Parallel(spec.flows())
+        wall = time.time() - started
+    log({"step": 1, "phase": "end", "text_preproc": state.get("text_preproc")})
+
+    statements = split_statements(state.get("text_preproc")) if FANOUT else []
+    if spec is not None:
+        log(dict(spec.reconcile(statements if len(statements) > 1 else [state.get("text_preproc")], wall),
+                 event="speculation"))
+    if overdo(state):
+        return
+
+    if len(statements) <= 1:
+        if spec is not None:
+            spec.adopt(0, state)
+        yield from _statement_flow(state, logger, attack)
+        return
+    yield from _fanout(state, statements, logger, attack, spec)
+
+
+def _fanout(state, statements, logger=None, attack=None, spec=None):
+    log = logger or (lambda event: None)
+    budget = state.get("budget") or CallBudget(state["n_calls"])
+    state["budget"] = budget
+    subs = [statement_state(state, i, text, budget) for i, text in enumerate(statements)]
+    if spec is not None:
+        for sub in subs:
+            spec.adopt(sub["statement"], sub)
+    log({"event": "fanout", "statements": len(subs)})
+    yield Parallel([_statement_flow(sub, _tagged(logger, sub["statement"]), attack) for sub in subs])
+    merge_statements(state, subs)
+    log({"event": "fanout_done", "statements": state["statements"]})
+
+
+def _tagged(logger, index):
+    if logger is None:
+        return None
+    def log(event):
+        event["statement"] = index
+        logger(event)
+    return log
+
+
+# Step 2–6 su un singolo statement (o sull'intero testo senza fan-out)
+def _statement_flow(state, logger=None, attack=None):
+    log = logger or (lambda event: None)
+
+    adopted = state.get("adopted", ())
+
+    # Step 2 (già fatto se la speculazione è stata tenuta)
+    if "identify" in adopted:
+        log({"step": 2, "phase": "end", "is_nlacp": state.get("is_nlacp"), "speculative": True})
+    else:
+        log({"step": 2, "phase": "start", "msg": "identify"})
+        yield agent_identify, state, {"logger": logger}
+        log({"step": 2, "phase": "end", "is_nlacp": state.get("is_nlacp")})
+    if overdo(state):
+        return
+    if state.get("is_nlacp") is False:
+        state["verifier_output"] = {"status": "correct", "error": ""}
+        return
+
+    # Step 3
+    if "retrieve" in adopted:
+        log({"step": 3, "phase": "end", "env_var": state["env_var"], "speculative": True})
+    else:
+        log({"step": 3, "phase": "start", "msg": "retrieving domain info"})
+        yield agent_retrieve, state, {"logger": logger}
+        log({"step": 3, "phase": "end", "env_var": state["env_var"]})
+    if overdo(state):
+        return
+
+    yield from _policy_flow(state, logger, attack)
+
+
+# Step 4–6: generazione, verifica e refine
+def _policy_flow(state, logger=None, attack=None):
+    log = logger or (lambda event: None)
+    if state.get("is_nlacp") is False:
+        state["verifier_output"] = {"status": "correct", "error": ""}
+        return
+
+    # Step 4
+    log({"step": 4, "phase": "start", "msg": "generating policy"})
+    yield agent_generate, state, {"logger": logger, "attack": attack}
+    log({"step": 4, "phase": "end", "rules_count": len(state.get("policy_json", {}).get("dsarcp", []))})
+    log({"event": "policy_preview", "dsarcp": state.get("policy_json", {}).get("dsarcp", [])[:3]})
+    if overdo(state):
+        return
+
+    # Step 5–6
+    while True:
+        log({"step": 5, "phase": "start", "msg": "verify"})
+        yield agent_verify, state, {"logger": logger}
+        log({"step": 5, "phase": "end", "verifier_output": state.get("verifier_output")})
+
+        if overdo(state):
+            break
+        if (state.get("verifier_output", {}).get("status", "").strip().lower() == "correct"):
+            break
+        if state["n_iter"] >= state.get("max_iter", MAX_ITER):
+            state["complete"] = True
+            break
+
+        log({"step": 6, "phase": "start", "msg": "refine"})
+        yield agent_generate, state, {"logger": logger, "attack": attack}
+        log({"step": 6, "phase": "end", "n_iter": state["n_iter"]})
+        if overdo(state):
+            break
+
+
+STEP_NAMES = {
+    agent_preprocess: "preprocess",
+    agent_identify: "identify",
+    agent_retrieve: "retrieve",
+    agent_generate: "generate",
+    agent_verify: "verify",
+    agent_fused: "fused",
+}
+
+# agent_generate in modalità refine incrementa n_iter: così si distingue lo step 6 dal 4
+def _step_name(agent, st, n_iter):
+    name = STEP_NAMES[agent]
+    return "refine" if name == "generate" and st["n_iter"] > n_iter else name
+
+def _call_agent(agent, st, kwargs):
+    started, n_iter = time.time(), st["n_iter"]
+    try:
+        agent(st, **kwargs)
+    finally:
+        observe_step(_step_name(agent, st, n_iter), started)
+
+async def _acall_agent(agent, st, kwargs):
+    started, n_iter = time.time(), st["n_iter"]
+    try:
+        await ASYNC_AGENTS[agent](st, **kwargs)
+    finally:
+        observe_step(_step_name(agent, st, n_iter), started)
+
+def _run_flow(flow):
+    for agent, st, kwargs in flow:
+        _call_agent(agent, st, kwargs)
+
+async def _arun_flow(flow, sem):
+    async with sem:
+        for agent, st, kwargs in flow:
+            await _acall_agent(agent, st, kwargs)
+
+
+# fa yield prima di ogni chiamata, durante il fan-out e alla fine,
+# così chi fa streaming può svuotare i log. La run è registrata in RUNS per
+# tutta la durata: se il consumatore chiude il generatore (client disconnesso)
+# la run viene cancellata, comprese le chiamate in volo.
+def run_steps(state, logger=None, attack=None):
+    started = time.time()
+    cancel = RUNS.start(state)
+    try:
+        for item in _flow(state, logger=logger, attack=attack):
+            yield
+            if isinstance(item, Parallel):
+                with ThreadPoolExecutor(max_workers=FANOUT_CONCURRENCY) as pool:
+                    pending = {pool.submit(_run_flow, f) for f in item.flows}
+                    try:
+                        while pending:
+                            done, pending = wait(pending, timeout=FANOUT_POLL)
+                            for f in done:
+                                f.result()
+                            yield
+                    except BaseException:
+                        cancel.set()
+                        raise
+            else:
+                agent, st, kwargs = item
+                _call_agent(agent, st, kwargs)
+        yield
+    except GeneratorExit:
+        cancel.set()
+        raise
+    finally:
+        RUNS.finish(state)
+        observe_run(state, started)
+
+async def arun_steps(state, logger=None, attack=None):
+    started = time.time()
+    cancel = RUNS.start(state)
+    try:
+        for item in _flow(state, logger=logger, attack=attack):
+            yield
+            if isinstance(item, Parallel):
+                sem = asyncio.Semaphore(FANOUT_CONCURRENCY)
+                pending = {asyncio.ensure_future(_arun_flow(f, sem)) for f in item.flows}
+                try:
+                    while pending:
+                        done, pending = await asyncio.wait(pending, timeout=FANOUT_POLL)
+                        for t in done:
+                            t.result()
+                        yield
+                finally:
+                    for t in pending:
+                        t.cancel()
+            else:
+                agent, st, kwargs = item
+                await _acall_agent(agent, st, kwargs)
+        yield
+    except (GeneratorExit, asyncio.CancelledError):
+        cancel.set()
+        raise
+    finally:
+        RUNS.finish(state)
+        observe_run(state, started)
+
+
+def run_pipeline(state, logger=None, attack=None):
+    for _ in run_steps(state, logger=logger, attack=attack):
+        pass
+    return state
+
+async def arun_pipeline(state, logger=None, attack=None):
+    async for _ in arun_steps(state, logger=logger, attack=attack):
+        pass
+    return state
@@ -0,0 +1,264 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from itertools import combinations
+
+from tools import norm, environment_index
+
+# Store persistente delle regole per environment: raccoglie i dsarcp delle run, li canonicalizza sul
+# vocabolario snappato, li deduplica per hash e tiene la provenienza (id delle run che li hanno prodotti).
+# Conflitti (allow/deny sovrapposte) e sussunzioni (regola più generale con la stessa decisione)
+# si trovano con un indice di generalizzazioni invece del confronto a coppie:
+# ogni regola registra le sue 2^k chiavi ottenute mettendo "none" su k dei suoi campi valorizzati.
+#   python policystore.py ingest universita results.ndjson
+#   python policystore.py conflicts universita
+POLICY_STORE_PATH = os.getenv("POLICY_STORE_PATH",
+                              os.path.join(os.path.dirname(__file__), "cache", "policy_store.sqlite3"))
+
+FIELDS = ("subject", "action", "resource", "purpose", "condition")
+WILDCARD = "none"
+SEP = "\x1f"
+
+
+def _key(values):
+    return SEP.join(values)
+
+def rule_hash(decision, values):
+    return hashlib.sha256(f"{decision}{SEP}{_key(values)}".encode("utf-8")).hexdigest()[:32]
+
+# (chiave, maschera dei campi portati a "none") per ogni generalizzazione della regola
+def generalizations(values):
+    concrete = [i for i, v in enumerate(values) if v != WILDCARD]
+    out = []
+    for k in range(len(concrete) + 1):
+        for idx in combinations(concrete, k):
+            g = list(values)
+            mask = 0
+            for i in idx:
+                g[i] = WILDCARD
+                mask |= 1 << i
+            out.append((_key(g), mask))
+    return out
+
+def _wild_mask(values):
+    return sum(1 << i for i, v in enumerate(values) if v == WILDCARD)
+
+# a è più generale (o uguale) di b: ogni campo di a è "none" o uguale a quello di b
+def covers(a, b):
+    return all(x == WILDCARD or x == y for x, y in zip(a, b))
+
+
+# canonicalizzazione sul vocabolario dell'environment: minuscole/spazi, poi snap ai termini noti.
+# Un valore che non si aggancia al vocabolario resta com'è (normalizzato) invece di diventare un jolly.
+# Gli snap già calcolati stanno sull'indice dell'environment e si riusano finché resta lo stesso
+# (un corpus ripete pochi termini).
+SNAP_MEMO_SIZE = 65536
+
+def canonicalize(rules, environment):
+    rules = [r for r in rules if isinstance(r, dict)]
+    index = environment_index(environment)
+    memo = index.snapped
+    raw = [[norm(str(r.get(f) or WILDCARD)) or WILDCARD for f in FIELDS] for r in rules]
+    mapping = {}
+    for j, f in enumerate(FIELDS):
+        todo = []
+        for value in sorted({row[j] for row in raw} - {WILDCARD}):
+            hit = memo.get((f, value))
+            if hit is None:
+                todo.append(value)
+            else:
+                mapping[f, value] = hit
+        if len(memo) >= SNAP_MEMO_SIZE:
+            memo.clear()
+        for value, snapped in zip(todo, index[index.FIELDS[f]].nearest_many(todo) if todo else ()):
+            mapping[f, value] = memo[f, value] = norm(snapped) if snapped != WILDCARD else value
+    out = []
+    for r, row in zip(rules, raw):
+        values = tuple(v if v == WILDCARD else mapping[f, v] for f, v in zip(FIELDS, row))
+        out.append(("allow" if r.get("decision") == "allow" else "deny", values))
+    return out
+
+
+class PolicyStore:
+    def __init__(self, path=POLICY_STORE_PATH):
+        self.path = path
+        self._db = None
+        self._lock = threading.Lock()
+
+    def _conn(self):
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False, timeout=5)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript(
+                "CREATE TABLE IF NOT EXISTS rules ("
+                " env TEXT NOT NULL, hash TEXT NOT NULL, decision TEXT NOT NULL,"
+                " subject TEXT NOT NULL, action TEXT NOT NULL, resource TEXT NOT NULL,"
+                " purpose TEXT NOT NULL, condition TEXT NOT NULL, created_at REAL NOT NULL,"
+                " PRIMARY KEY (env, hash));"
+                "CREATE TABLE IF NOT EXISTS provenance ("
+                " env TEXT NOT NULL, hash TEXT NOT NULL, run_id TEXT NOT NULL, statement INTEGER,"
+                " text TEXT, ingested_at REAL NOT NULL, PRIMARY KEY (env, hash, run_id));"
+                "CREATE TABLE IF NOT EXISTS generalizations ("
+                " env TEXT NOT NULL, gkey TEXT NOT NULL, mask INTEGER NOT NULL, hash TEXT NOT NULL);"
+                "CREATE INDEX IF NOT EXISTS generalizations_key ON generalizations(env, gkey);"
+                "CREATE TABLE IF NOT EXISTS relations ("
+                " env TEXT NOT NULL, kind TEXT NOT NULL, a TEXT NOT NULL, b TEXT NOT NULL,"
+                " detected_at REAL NOT NULL, PRIMARY KEY (env, kind, a, b));"
+            )
+            self._db.commit()
+        return self._db
+
+    # una connessione SQLite non va usata attraverso un fork: il worker ne apre una sua
+    def reset(self):
+        self._db = None
+
+    # regole memorizzate che si sovrappongono a `values`: una query sulle sue generalizzazioni.
+    # Una regola T compare se una sua generalizzazione coincide con una di `values` e T è stata
+    # generalizzata solo sui campi dove `values` è già "none".
+    def _overlapping(self, db, env, values):
+        keys = [k for k, _ in generalizations(values)]
+        placeholders = ",".join("?" * len(keys))
+        rows = db.execute(
+            f"SELECT DISTINCT r.hash, r.decision, r.subject, r.action, r.resource, r.purpose, r.condition"
+            f" FROM generalizations g JOIN rules r ON r.env = g.env AND r.hash = g.hash"
+            f" WHERE g.env = ? AND g.gkey IN ({placeholders}) AND (g.mask & ?) = 0",
+            [env, *keys, ~_wild_mask(values) & 0x1f],
+        ).fetchall()
+        return [(h, d, tuple(rest)) for h, d, *rest in rows]
+
+    # relazioni della nuova regola con quelle già presenti:
+    # conflict = decisioni opposte su richieste in comune (deny vince, l'allow è in parte o del tutto morta),
+    # subsumes = a più generale di b con la stessa decisione (b è ridondante)
+    def _relate(self, db, env, h, decision, values, now):
+        found = []
+        for other, d, ov in self._overlapping(db, env, values):
+            if other == h:
+                continue
+            if d != decision:
+                a, b = (h, other) if decision == "deny" else (other, h)
+                found.append(("conflict", a, b))
+            elif covers(ov, values):
+                found.append(("subsumes", other, h))
+            elif covers(values, ov):
+                found.append(("subsumes", h, other))
+        db.executemany("INSERT OR IGNORE INTO relations (env, kind, a, b, detected_at) VALUES (?, ?, ?, ?, ?)",
+                       [(env, kind, a, b, now) for kind, a, b in found])
+        return found
+
+    # payload di finish_payload (o {"id", "dsarcp"}): regole nuove, duplicati e relazioni trovate
+    def ingest(self, env, payload):
+        run_id = str(payload.get("id") or "")
+        canonical = canonicalize(payload.get("dsarcp") or [], env)
+        # con il fan-out le regole sono in ordine di statement: rules_count dice a quale appartengono
+        sources = []
+        for st in payload.get("statements") or []:
+            sources += [(st.get("statement"), st.get("text_preproc"))] * (st.get("rules_count") or 0)
+        if len(sources) != len(canonical):
+            sources = [(None, None)] * len(canonical)
+        now = time.time()
+        out = {"env": env, "id": run_id, "rules": len(canonical), "added": 0, "duplicates": 0,
+               "conflicts": [], "subsumptions": []}
+        with self._lock:
+            db = self._conn()
+            for (decision, values), (statement, text) in zip(canonical, sources):
+                h = rule_hash(decision, values)
+                cur = db.execute(
+                    "INSERT OR IGNORE INTO rules (env, hash, decision, subject, action, resource, purpose,"
+                    " condition, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (env, h, decision, *values, now))
+                if cur.rowcount:
+                    out["added"] += 1
+                    db.executemany("INSERT INTO generalizations (env, gkey, mask, hash) VALUES (?, ?, ?, ?)",
+                                   [(env, k, mask, h) for k, mask in generalizations(values)])
+                    for kind, a, b in self._relate(db, env, h, decision, values, now):
+                        out["conflicts" if kind == "conflict" else "subsumptions"].append({"a": a, "b": b})
+                else:
+                    out["duplicates"] += 1
+                db.execute("INSERT OR IGNORE INTO provenance (env, hash, run_id, statement, text, ingested_at)"
+                           " VALUES (?, ?, ?, ?, ?, ?)", (env, h, run_id, statement, text, now))
+            db.commit()
+        return out
+
+    def _rule_rows(self, db, env, hashes=None):
+        sql = "SELECT hash, decision, subject, action, resource, purpose, condition FROM rules WHERE env = ?"
+        args = [env]
+        if hashes is not None:
+            sql += f" AND hash IN ({','.join('?' * len(hashes))})"
+            args += list(hashes)
+        rules = {}
+        for h, d, *values in db.execute(sql + " ORDER BY created_at, hash", args):
+            rules[h] = dict(zip(("hash", "decision", *FIELDS), (h, d, *values)), runs=[])
+        for h, run_id, statement, text in db.execute(
+                "SELECT hash, run_id, statement, text FROM provenance WHERE env = ? ORDER BY ingested_at", (env,)):
+            if h in rules:
+                rules[h]["runs"].append({"id": run_id, "statement": statement, "text": text})
+        return rules
+
+    def rules(self, env):
+        with self._lock:
+            return list(self._rule_rows(self._conn(), env).values())
+
+    # relazioni tra regole ancora presenti, con le regole e la loro provenienza
+    def relations(self, env, kind):
+        with self._lock:
+            db = self._conn()
+            pairs = db.execute("SELECT a, b FROM relations WHERE env = ? AND kind = ? ORDER BY detected_at",
+                               (env, kind)).fetchall()
+            rules = self._rule_rows(db, env, {h for pair in pairs for h in pair}) if pairs else {}
+        out = []
+        for a, b in pairs:
+            if a in rules and b in rules:
+                ra, rb = rules[a], rules[b]
+                va, vb = tuple(ra[f] for f in FIELDS), tuple(rb[f] for f in FIELDS)
+                if kind == "conflict":
+                    scope = "exact" if va == vb else "shadowed" if covers(va, vb) else "overlap"
+                    out.append({"deny": ra, "allow": rb, "scope": scope})
+                else:
+                    out.append({"general": ra, "specific": rb})
+        return out
+
+    def conflicts(self, env):
+        return self.relations(env, "conflict")
+
+    def subsumptions(self, env):
+        return self.relations(env, "subsumes")
+
+    def stats(self, env):
+        with self._lock:
+            db = self._conn()
+            one = lambda sql, *args: db.execute(sql, (env, *args)).fetchone()[0]
+            return {
+                "env": env,
+                "rules": one("SELECT COUNT(*) FROM rules WHERE env = ?"),
+                "runs": one("SELECT COUNT(DISTINCT run_id) FROM provenance WHERE env = ?"),
+                "conflicts": one("SELECT COUNT(*) FROM relations WHERE env = ? AND kind = ?", "conflict"),
+                "subsumptions": one("SELECT COUNT(*) FROM relations WHERE env = ? AND kind = ?", "subsumes"),
+            }
+
+    def environments(self):
+        with self._lock:
+            return [r[0] for r in self._conn().execute("SELECT DISTINCT env FROM rules ORDER BY env")]
+
+
+STORE = PolicyStore()
+
+
+if __name__ == "__main__":
+    from decision import load_payloads
+    if len(sys.argv) < 3 or sys.argv[1] not in ("ingest", "conflicts", "subsumptions", "stats"):
+        sys.exit("usage: python policystore.py ingest <env> results.ndjson [...] | conflicts|subsumptions|stats <env>")
+    cmd, env = sys.argv[1], sys.argv[2]
+    if cmd == "ingest":
+        for path in sys.argv[3:]:
+            for payload in load_payloads(path):
+                r = STORE.ingest(env, payload)
+                print(json.dumps({k: v if not isinstance(v, list) else len(v) for k, v in r.items()}))
+    elif cmd == "stats":
+        print(json.dumps(STORE.stats(env), indent=2))
+    else:
+        print(json.dumps(STORE.relations(env, "conflict" if cmd == "conflicts" else "subsumes"), indent=2))
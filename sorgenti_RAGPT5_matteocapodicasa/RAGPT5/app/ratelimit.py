@@ -0,0 +1,232 @@
+import os
+import time
+import heapq
+import sqlite3
+import asyncio
+import threading
+import itertools
+from runs import RunCancelled
+
+# Scheduler davanti alle chiamate al modello: token bucket per richieste/minuto (LLM_RPM) e
+# token/minuto (LLM_TPM), condivisi tra i worker tramite un file SQLite locale.
+# Prima della chiamata si prenotano i token stimati, dopo si corregge con l'usage reale.
+# In ogni processo le chiamate in attesa sono servite per priorità (interactive > default > batch),
+# a parità di priorità in ordine di arrivo. 0 = limite disattivato.
+LLM_RPM = float(os.getenv("LLM_RPM", "0"))
+LLM_TPM = float(os.getenv("LLM_TPM", "0"))
+RATE_LIMIT_PATH = os.getenv("RATE_LIMIT_PATH", os.path.join(os.path.dirname(__file__), "cache", "ratelimit.sqlite3"))
+# token di completamento prenotati per chiamata, finché l'usage reale non corregge la stima
+LLM_TPM_COMPLETION_EST = int(os.getenv("LLM_TPM_COMPLETION_EST", "800"))
+
+PRIORITIES = {"interactive": 0, "default": 1, "batch": 2}
+# ogni quanto un'attesa ricontrolla cancellazione e bucket (gli altri worker consumano lo stesso budget)
+POLL = 0.05
+
+
+class RateLimited(TimeoutError):
+    pass
+
+
+# ~4 caratteri per token: basta per prenotare, la differenza si restituisce a fine chiamata
+def estimate_tokens(messages):
+    chars = sum(len(m.get("content") or "") for m in messages)
+    return chars // 4 + 4 * len(messages) + LLM_TPM_COMPLETION_EST
+
+
+class Ticket:
+    def __init__(self, tokens, priority, seq):
+        self.tokens = tokens
+        self.priority = priority
+        self.seq = seq
+        self.wait_ms = 0.0
+        # token/minuto presi davvero dal bucket (la stima può essere tagliata alla capacità)
+        self.taken = 0.0
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class BucketStore:
+    def __init__(self, path=RATE_LIMIT_PATH):
+        self.path = path
+        self._db = None
+        self._lock = threading.Lock()
+
+    def _conn(self):
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False, timeout=5, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS buckets ("
+                " name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+            )
+        return self._db
+
+    # una connessione SQLite non va usata attraverso un fork: il worker ne apre una sua
+    def reset(self):
+        self._db = None
+
+    # limits: {nome: (capacità, token al secondo)}; fn(livelli) -> (nuovi livelli, risultato),
+    # dentro una transazione che blocca gli altri worker
+    def update(self, limits, fn):
+        with self._lock:
+            db = self._conn()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                levels = {}
+                for name, (capacity, rate) in limits.items():
+                    row = db.execute("SELECT tokens, updated FROM buckets WHERE name = ?", (name,)).fetchone()
+                    tokens = capacity if row is None else min(capacity, row[0] + rate * max(0.0, now - row[1]))
+                    levels[name] = tokens
+                levels, result = fn(levels)
+                db.executemany("INSERT OR REPLACE INTO buckets (name, tokens, updated) VALUES (?, ?, ?)",
+                               [(name, tokens, now) for name, tokens in levels.items()])
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        return result
+
+
+class RateLimiter:
+    def __init__(self, rpm=LLM_RPM, tpm=LLM_TPM, store=None):
+        self.limits = {}
+        if rpm > 0:
+            self.limits["rpm"] = (rpm, rpm / 60.0)
+        if tpm > 0:
+            self.limits["tpm"] = (tpm, tpm / 60.0)
+        self.store = store or BucketStore()
+        self._queue = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self.counters = {"admitted": 0, "queued": 0, "wait_ms": 0.0, "max_wait_ms": 0.0, "penalties": 0}
+
+    @property
+    def enabled(self):
+        return bool(self.limits)
+
+    def _need(self, ticket):
+        need = {"rpm": 1.0, "tpm": float(ticket.tokens)}
+        # una richiesta più grande dell'intero bucket passa quando il bucket è pieno
+        return {name: min(need[name], capacity) for name, (capacity, _) in self.limits.items()}
+
+    # 0 se i token sono stati presi, altrimenti i secondi da attendere
+    def _try_take(self, ticket):
+        need = self._need(ticket)
+
+        def take(levels):
+            short = {n: need[n] - levels[n] for n in levels if levels[n] < need[n]}
+            if short:
+                return levels, max(s / self.limits[n][1] for n, s in short.items())
+            return {n: levels[n] - need[n] for n in levels}, 0.0
+        wait = self.store.update(self.limits, take)
+        if wait == 0:
+            ticket.taken = need.get("tpm", 0.0)
+        return wait
+
+    def _enqueue(self, tokens, priority):
+        ticket = Ticket(tokens, PRIORITIES.get(priority, PRIORITIES["default"]), next(self._seq))
+        with self._lock:
+            heapq.heappush(self._queue, ticket)
+        return ticket
+
+    def _leave(self, ticket, started):
+        ticket.wait_ms = (time.time() - started) * 1000
+        with self._lock:
+            self._queue.remove(ticket)
+            heapq.heapify(self._queue)
+            self.counters["admitted"] += 1
+            if ticket.wait_ms >= 1:
+                self.counters["queued"] += 1
+            self.counters["wait_ms"] += ticket.wait_ms
+            self.counters["max_wait_ms"] = max(self.counters["max_wait_ms"], ticket.wait_ms)
+            self._cond.notify_all()
+
+    # solo la testa della coda prova a prendere i token
+    def _turn(self, ticket, cancel):
+        if cancel is not None and cancel.is_set():
+            raise RunCancelled()
+        with self._lock:
+            return self._queue[0] is ticket
+
+    def _check(self, wait, deadline):
+        if wait and deadline is not None and time.time() + wait >= deadline:
+            raise RateLimited(f"rate limit: next slot in {wait:.1f}s, past the request deadline")
+        return wait
+
+    # blocca finché la chiamata può partire; il ticket va poi passato a settle() con l'usage
+    def acquire(self, tokens, priority=None, deadline=None, cancel=None):
+        ticket = Ticket(tokens, 0, 0)
+        if not self.enabled:
+            return ticket
+        started = time.time()
+        ticket = self._enqueue(tokens, priority)
+        try:
+            while True:
+                wait = self._check(self._try_take(ticket), deadline) if self._turn(ticket, cancel) else None
+                if wait == 0:
+                    return ticket
+                with self._lock:
+                    self._cond.wait(min(wait or POLL, POLL))
+        finally:
+            self._leave(ticket, started)
+
+    async def aacquire(self, tokens, priority=None, deadline=None, cancel=None):
+        ticket = Ticket(tokens, 0, 0)
+        if not self.enabled:
+            return ticket
+        started = time.time()
+        ticket = self._enqueue(tokens, priority)
+        try:
+            while True:
+                wait = None
+                # la transazione SQLite (BEGIN IMMEDIATE) può attendere gli altri worker: fuori dal loop
+                if self._turn(ticket, cancel):
+                    wait = self._check(await asyncio.to_thread(self._try_take, ticket), deadline)
+                if wait == 0:
+                    return ticket
+                await asyncio.sleep(min(wait or POLL, POLL))
+        finally:
+            self._leave(ticket, started)
+
+    # restituisce (o addebita) la differenza tra token presi e consumati davvero. Una chiamata
+    # interrotta non ha usage: il prompt è stato inviato, del completamento conta il testo arrivato
+    def settle(self, ticket, usage, text=""):
+        if "tpm" not in self.limits or ticket is None:
+            return
+        total = getattr(usage, "total_tokens", None) if usage is not None else None
+        if total is None:
+            total = max(0, ticket.tokens - LLM_TPM_COMPLETION_EST) + len(text) // 4
+        capacity = self.limits["tpm"][0]
+        delta = ticket.taken - total
+        self.store.update({"tpm": self.limits["tpm"]},
+                          lambda levels: ({"tpm": min(capacity, levels["tpm"] + delta)}, None))
+
+    async def asettle(self, ticket, usage, text=""):
+        if "tpm" in self.limits and ticket is not None:
+            await asyncio.to_thread(self.settle, ticket, usage, text)
+
+    # 429 dal provider: i bucket vanno in debito per `seconds`, così frenano tutti i worker
+    def penalize(self, seconds):
+        if not self.enabled:
+            return
+        self.store.update(self.limits, lambda levels: (
+            {n: min(levels[n], -self.limits[n][1] * seconds) for n in levels}, None))
+        with self._lock:
+            self.counters["penalties"] += 1
+
+    def stats(self):
+        with self._lock:
+            out = dict(self.counters)
+            out["waiting"] = len(self._queue)
+        out["wait_ms"] = round(out["wait_ms"], 3)
+        out["max_wait_ms"] = round(out["max_wait_ms"], 3)
+        out["rpm"] = self.limits.get("rpm", (None,))[0]
+        out["tpm"] = self.limits.get("tpm", (None,))[0]
+        return out
+
+
+LIMITER = RateLimiter()
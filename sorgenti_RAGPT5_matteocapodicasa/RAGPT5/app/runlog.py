@@ -0,0 +1,349 @@
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import threading
+from collections import deque
+from runs import RUNS_SHARED_PATH, _alive, process_token
+
+# Log degli eventi di ogni run /api/log: un ring buffer per id con numeri di sequenza crescenti,
+# usati come id SSE ("<run id>:<seq>"). La run gira in background e scrive nel log; la risposta SSE
+# lo legge. Un EventSource che si riconnette manda Last-Event-ID e riprende da lì, senza rieseguire
+# chiamate al modello. Le run finite restano leggibili per RUN_LOG_TTL secondi.
+# Con più worker (share() in gunicorn.conf.py) il log è copiato anche in un file SQLite condiviso:
+# una riconnessione che arriva a un altro worker legge da lì gli eventi della run.
+RUN_LOG_SIZE = int(os.getenv("RUN_LOG_SIZE", "2000"))
+RUN_LOG_TTL = float(os.getenv("RUN_LOG_TTL", "600"))
+# una run senza lettori per più di RUN_LOG_DETACH secondi viene cancellata (il client non è tornato)
+RUN_LOG_DETACH = float(os.getenv("RUN_LOG_DETACH", "30"))
+# ogni quanto uno stream fermo manda un commento SSE (e si accorge della disconnessione)
+RUN_LOG_KEEPALIVE = float(os.getenv("RUN_LOG_KEEPALIVE", "15"))
+RUN_LOG_SHARED_PATH = os.getenv("RUN_LOG_SHARED_PATH",
+                                os.path.join(os.path.dirname(RUNS_SHARED_PATH), "runlog.sqlite3"))
+# un solo thread per processo: scrive il log condiviso, segue le run degli altri worker ogni POLL
+# secondi e ogni SWEEP secondi cancella le run senza lettori e scarta i log scaduti
+POLL = 0.05
+SWEEP = 1.0
+
+
+# "<run id>:<seq>" -> (run id, seq); None se l'id non è di questo formato
+def parse_event_id(value):
+    run_id, _, seq = (value or "").strip().rpartition(":")
+    if not run_id or not seq.isdigit():
+        return None
+    return run_id, int(seq)
+
+
+class RunLog:
+    def __init__(self, run_id, cancel=None, size=RUN_LOG_SIZE, on_append=None):
+        self.run_id = run_id
+        self.cancel = cancel
+        self.events = deque(maxlen=size)
+        self.seq = 0
+        self.done = False
+        self.finished_at = None
+        self.readers = 0
+        self.detached_at = time.time()
+        self.on_append = on_append
+        self._cond = threading.Condition()
+        # lettori asyncio in attesa: (loop, Event), svegliati dal thread che scrive
+        self._waiters = set()
+
+    def _wake(self):
+        self._cond.notify_all()
+        for loop, event in self._waiters:
+            loop.call_soon_threadsafe(event.set)
+
+    def append(self, event, data):
+        with self._cond:
+            self.seq += 1
+            self.events.append((self.seq, event, data))
+            self._wake()
+            seq = self.seq
+        if self.on_append is not None:
+            self.on_append(("event", self.run_id, seq, event, data))
+        return seq
+
+    def close(self):
+        with self._cond:
+            self.done = True
+            self.finished_at = time.time()
+            self._wake()
+        if self.on_append is not None:
+            self.on_append(("close", self.run_id, self.finished_at))
+
+    # (eventi con seq > last, eventi persi perché usciti dal buffer, run finita)
+    def since(self, last):
+        with self._cond:
+            return self._since(last)
+
+    def _since(self, last):
+        if not self.events:
+            return [], 0, self.done
+        first = self.events[0][0]
+        missed = max(0, first - last - 1)
+        return [e for e in self.events if e[0] > last], missed, self.done
+
+    # come since(), ma aspetta fino a timeout che arrivi qualcosa
+    def wait(self, last, timeout):
+        with self._cond:
+            self._cond.wait_for(lambda: self.seq > last or self.done, timeout)
+            return self._since(last)
+
+    async def await_since(self, last, timeout):
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self._cond:
+            if self.seq > last or self.done:
+                return self._since(last)
+            self._waiters.add(waiter)
+        try:
+            await asyncio.wait_for(waiter[1].wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._cond:
+                self._waiters.discard(waiter)
+        return self.since(last)
+
+    def attach(self):
+        with self._cond:
+            self.readers += 1
+
+    def detach(self):
+        with self._cond:
+            self.readers -= 1
+            if self.readers <= 0:
+                self.detached_at = time.time()
+
+    # senza lettori da RUN_LOG_DETACH secondi (seen: ultimo lettore visto in un altro worker)
+    def orphaned(self, now, seen=0.0):
+        with self._cond:
+            return (self.cancel is not None and not self.done and self.readers <= 0
+                    and now - max(self.detached_at, seen) > RUN_LOG_DETACH)
+
+    def expired(self, now, ttl):
+        return self.done and now - self.finished_at > ttl
+
+    # copia locale del log di un altro worker: la riempie il thread del RunLogStore
+    def fill(self, rows, done):
+        with self._cond:
+            for seq, event, data in rows:
+                if seq > self.seq:
+                    self.events.append((seq, event, data))
+                    self.seq = seq
+            if done and not self.done:
+                self.done = True
+                self.finished_at = time.time()
+            if rows or done:
+                self._wake()
+
+
+class SharedLogs:
+    def __init__(self, path=RUN_LOG_SHARED_PATH, size=RUN_LOG_SIZE):
+        self.path = path
+        self.size = size
+        self._db = None
+        self._lock = threading.Lock()
+
+    def _conn(self):
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False, timeout=5)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript(
+                "CREATE TABLE IF NOT EXISTS logs (id TEXT PRIMARY KEY, pid INTEGER NOT NULL, owner TEXT NOT NULL,"
+                " done INTEGER NOT NULL,"
+                " finished_at REAL, seen_at REAL NOT NULL);"
+                "CREATE TABLE IF NOT EXISTS events (id TEXT NOT NULL, seq INTEGER NOT NULL, event TEXT NOT NULL,"
+                " data TEXT NOT NULL, PRIMARY KEY (id, seq));"
+            )
+            self._db.commit()
+        return self._db
+
+    # ops in ordine di arrivo: ("create", id, pid, owner) | ("event", id, seq, event, data) | ("close", id, t)
+    def write(self, ops):
+        with self._lock:
+            db = self._conn()
+            last = {}
+            for op in ops:
+                if op[0] == "create":
+                    db.execute("DELETE FROM events WHERE id = ?", (op[1],))
+                    db.execute("INSERT OR REPLACE INTO logs (id, pid, owner, done, finished_at, seen_at)"
+                               " VALUES (?, ?, ?, 0, NULL, 0)", op[1:4])
+                elif op[0] == "event":
+                    db.execute("INSERT OR REPLACE INTO events (id, seq, event, data) VALUES (?, ?, ?, ?)",
+                               (op[1], op[2], op[3], json.dumps(op[4])))
+                    last[op[1]] = op[2]
+                else:
+                    db.execute("UPDATE logs SET done = 1, finished_at = ? WHERE id = ?", (op[2], op[1]))
+            db.executemany("DELETE FROM events WHERE id = ? AND seq <= ?",
+                           [(run_id, seq - self.size) for run_id, seq in last.items() if seq > self.size])
+            db.commit()
+
+    # (righe con seq > last, run finita) o None se il log non c'è; la run di un worker morto è finita
+    def read(self, run_id, last):
+        with self._lock:
+            db = self._conn()
+            row = db.execute("SELECT done, pid, owner FROM logs WHERE id = ?", (run_id,)).fetchone()
+            if row is None:
+                return None
+            rows = db.execute("SELECT seq, event, data FROM events WHERE id = ? AND seq > ? ORDER BY seq",
+                              (run_id, last)).fetchall()
+        return [(seq, event, json.loads(data)) for seq, event, data in rows], bool(row[0]) or not _alive(*row[1:])
+
+    # i lettori in questo worker tengono viva la run del worker che la esegue
+    def seen(self, run_ids, now):
+        with self._lock:
+            db = self._conn()
+            db.executemany("UPDATE logs SET seen_at = ? WHERE id = ?", [(now, run_id) for run_id in run_ids])
+            db.commit()
+
+    def seen_at(self, run_ids):
+        if not run_ids:
+            return {}
+        with self._lock:
+            rows = self._conn().execute(
+                f"SELECT id, seen_at FROM logs WHERE id IN ({','.join('?' * len(run_ids))})", list(run_ids)).fetchall()
+        return dict(rows)
+
+    def purge(self, now, ttl):
+        with self._lock:
+            db = self._conn()
+            db.execute("DELETE FROM events WHERE id IN (SELECT id FROM logs WHERE done = 1 AND finished_at < ?)",
+                       (now - ttl,))
+            db.execute("DELETE FROM logs WHERE done = 1 AND finished_at < ?", (now - ttl,))
+            db.commit()
+
+
+class RunLogStore:
+    def __init__(self, size=RUN_LOG_SIZE, ttl=RUN_LOG_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._logs = {}
+        # copie dei log di altri worker con lettori in questo processo
+        self._remote = {}
+        self._lock = threading.Lock()
+        self._shared = None
+        self._pending = []
+        self._wakeup = threading.Event()
+        self._thread = None
+        self.counters = {"created": 0, "resumed": 0, "expired": 0, "cancelled": 0}
+
+    # da chiamare in ogni worker dopo il fork (gunicorn.conf.py)
+    def share(self, path=RUN_LOG_SHARED_PATH):
+        with self._lock:
+            self._logs.clear()
+            self._remote.clear()
+            self._pending = []
+            self._thread = None
+        self._shared = SharedLogs(path, self.size)
+        self._start()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._sweeper, name="runlog-sweeper", daemon=True)
+        self._thread.start()
+
+    def _queue(self, op):
+        if self._shared is None:
+            return
+        with self._lock:
+            self._pending.append(op)
+        self._wakeup.set()
+
+    def _sweeper(self):
+        last_sweep = 0.0
+        while True:
+            self._wakeup.wait(POLL)
+            self._wakeup.clear()
+            now = time.time()
+            try:
+                self._flush()
+                self._follow(now, now - last_sweep >= SWEEP)
+                if now - last_sweep >= SWEEP:
+                    last_sweep = now
+                    self._sweep(now)
+            except sqlite3.Error:
+                pass
+
+    def _flush(self):
+        with self._lock:
+            ops, self._pending = self._pending, []
+        if ops:
+            self._shared.write(ops)
+
+    def _follow(self, now, heartbeat):
+        if self._shared is None:
+            return
+        with self._lock:
+            remote = list(self._remote.values())
+        for log in remote:
+            if log.readers > 0 and not log.done:
+                out = self._shared.read(log.run_id, log.seq)
+                log.fill(*(out if out is not None else ([], True)))
+        if heartbeat:
+            self._shared.seen([log.run_id for log in remote if log.readers > 0], now)
+
+    def _sweep(self, now):
+        with self._lock:
+            local = [log for log in self._logs.values() if not log.done and log.readers <= 0]
+            for run_id in [k for k, log in self._logs.items() if log.expired(now, self.ttl)]:
+                del self._logs[run_id]
+                self.counters["expired"] += 1
+            for run_id in [k for k, log in self._remote.items()
+                           if log.readers <= 0 and (log.done or now - log.detached_at > RUN_LOG_DETACH)]:
+                del self._remote[run_id]
+        seen = self._shared.seen_at([log.run_id for log in local]) if self._shared is not None and local else {}
+        for log in local:
+            if log.orphaned(now, seen.get(log.run_id) or 0.0):
+                log.cancel.set()
+                with self._lock:
+                    self.counters["cancelled"] += 1
+        if self._shared is not None:
+            self._shared.purge(now, self.ttl)
+
+    def create(self, run_id, cancel=None):
+        self._start()
+        log = RunLog(run_id, cancel, self.size, on_append=self._queue)
+        with self._lock:
+            self._logs[run_id] = log
+            self.counters["created"] += 1
+        self._queue(("create", run_id, os.getpid(), process_token(os.getpid())))
+        return log
+
+    # log di una run da riprendere: di questo worker, altrimenti dal file condiviso (None se scaduto o mai visto)
+    def get(self, run_id):
+        with self._lock:
+            log = self._logs.get(run_id) or self._remote.get(run_id)
+        if log is not None and log.expired(time.time(), self.ttl):
+            log = None
+        if log is None and self._shared is not None:
+            out = self._shared.read(run_id, 0)
+            if out is not None:
+                self._start()
+                log = RunLog(run_id, size=self.size)
+                log.fill(*out)
+                with self._lock:
+                    log = self._remote.setdefault(run_id, log)
+        if log is not None:
+            with self._lock:
+                self.counters["resumed"] += 1
+        return log
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            out = dict(self.counters)
+            out["retained"] = sum(1 for log in self._logs.values() if not log.expired(now, self.ttl))
+            out["running"] = sum(1 for log in self._logs.values() if not log.done)
+            out["remote"] = len(self._remote)
+        out["ttl"] = self.ttl
+        out["size"] = self.size
+        out["shared"] = self._shared is not None
+        return out
+
+
+RUNLOGS = RunLogStore()
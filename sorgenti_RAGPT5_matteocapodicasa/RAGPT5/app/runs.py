@@ -0,0 +1,221 @@
+import os
+import time
+import sqlite3
+import threading
+
+# Cancellazione per run: ogni run registra un Event sotto il proprio id (quello di init_state).
+# /api/stop, la disconnessione del client SSE o la chiusura del generatore lo impostano;
+# check_limits e le chiamate in volo al modello lo controllano.
+# Con più worker (gunicorn.conf.py) /api/stop può arrivare a un processo diverso da quello della run:
+# le run attive e le richieste di stop passano anche da un file SQLite condiviso, che ogni worker
+# controlla ogni CANCEL_WATCH secondi per le proprie run. Una run è del processo che la esegue
+# (pid + token di avvio, vedi process_token) e della generazione del master che l'ha creato.
+RUNS_SHARED_PATH = os.getenv("RUNS_SHARED_PATH", os.path.join(os.path.dirname(__file__), "cache", "runs.sqlite3"))
+CANCEL_WATCH = float(os.getenv("CANCEL_WATCH", "0.5"))
+
+
+class RunCancelled(Exception):
+    pass
+
+
+# id scelto dal client già usato da una run in corso (in questo o in un altro worker)
+class RunIdInUse(ValueError):
+    pass
+
+
+class SharedRuns:
+    def __init__(self, path=RUNS_SHARED_PATH):
+        self.path = path
+        self._db = None
+        self._lock = threading.Lock()
+
+    def _conn(self):
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False, timeout=5)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript(
+                "CREATE TABLE IF NOT EXISTS active (id TEXT PRIMARY KEY, pid INTEGER NOT NULL, owner TEXT NOT NULL,"
+                " master_pid INTEGER NOT NULL, master TEXT NOT NULL, started_at REAL NOT NULL);"
+                "CREATE TABLE IF NOT EXISTS cancels (id TEXT PRIMARY KEY, requested_at REAL NOT NULL);"
+            )
+            self._db.commit()
+        return self._db
+
+    def _run(self, sql, args=()):
+        with self._lock:
+            db = self._conn()
+            rows = db.execute(sql, args).fetchall()
+            db.commit()
+            return rows
+
+    # False se l'id è già di una run attiva in un processo vivo
+    def start(self, run_id):
+        pid, master = os.getpid(), os.getppid()
+        with self._lock:
+            db = self._conn()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                row = db.execute("SELECT pid, owner FROM active WHERE id = ?", (run_id,)).fetchone()
+                if row is not None and _alive(*row):
+                    return False
+                db.execute("INSERT OR REPLACE INTO active (id, pid, owner, master_pid, master, started_at)"
+                           " VALUES (?, ?, ?, ?, ?, ?)",
+                           (run_id, pid, process_token(pid), master, process_token(master), time.time()))
+                return True
+            finally:
+                db.commit()
+
+    def finish(self, run_id):
+        with self._lock:
+            db = self._conn()
+            db.execute("DELETE FROM active WHERE id = ?", (run_id,))
+            db.execute("DELETE FROM cancels WHERE id = ?", (run_id,))
+            db.commit()
+
+    # stop per una run di un altro worker: False se nessun processo vivo la sta eseguendo
+    def request_cancel(self, run_id):
+        rows = self._run("SELECT pid, owner FROM active WHERE id = ?", (run_id,))
+        if not rows or not _alive(*rows[0]):
+            return False
+        self._run("INSERT OR REPLACE INTO cancels (id, requested_at) VALUES (?, ?)", (run_id, time.time()))
+        return True
+
+    def requested(self, run_ids):
+        if not run_ids:
+            return []
+        return [r[0] for r in self._run(
+            f"SELECT id FROM cancels WHERE id IN ({','.join('?' * len(run_ids))})", list(run_ids))]
+
+    # righe lasciate da un worker terminato senza finish()
+    def purge(self, pid):
+        self._run("DELETE FROM active WHERE pid = ?", (pid,))
+
+    # all'avvio del master: righe di una generazione precedente (master o worker non più vivi,
+    # anche se il loro pid ora è di un altro processo)
+    def purge_stale(self):
+        rows = self._run("SELECT id, pid, owner, master_pid, master FROM active")
+        stale = [(run_id,) for run_id, pid, owner, mpid, master in rows
+                 if not _alive(pid, owner) or not _alive(mpid, master)]
+        with self._lock:
+            db = self._conn()
+            db.executemany("DELETE FROM active WHERE id = ?", stale)
+            db.commit()
+        return len(stale)
+
+
+def _boot_id():
+    try:
+        with open("/proc/sys/kernel/random/boot_id") as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+BOOT_ID = _boot_id()
+
+
+# identità di un processo oltre il pid: boot_id + istante di avvio (campo 22 di /proc/<pid>/stat).
+# Un pid riusato da un altro processo ha un token diverso; "" dove /proc non c'è (si guarda solo il pid).
+def process_token(pid):
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as f:
+            stat = f.read()
+    except OSError:
+        return ""
+    # il nome del processo (campo 2, tra parentesi) può contenere spazi
+    return f"{BOOT_ID}:{int(stat[stat.rindex(b')') + 2:].split()[19])}"
+
+
+def _alive(pid, token=""):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return not token or process_token(pid) in ("", token)
+
+
+class RunRegistry:
+    def __init__(self):
+        self._active = {}
+        self._lock = threading.Lock()
+        self.counters = {"started": 0, "finished": 0, "cancelled": 0, "calls_saved": 0}
+        # media delle chiamate di una run completata, per stimare le chiamate risparmiate
+        self._calls_total = 0
+        self._calls_runs = 0
+        self._shared = None
+
+    # da chiamare in ogni worker dopo il fork (gunicorn.conf.py)
+    def share(self, path=RUNS_SHARED_PATH):
+        with self._lock:
+            self._active.clear()
+        self._shared = SharedRuns(path)
+        self._shared.purge(os.getpid())
+        threading.Thread(target=self._watch, name="runs-cancel-watch", daemon=True).start()
+
+    def _watch(self):
+        while True:
+            time.sleep(CANCEL_WATCH)
+            with self._lock:
+                active = dict(self._active)
+            try:
+                for run_id in self._shared.requested(list(active)):
+                    active[run_id].set()
+            except sqlite3.Error:
+                pass
+
+    # RunIdInUse se l'id è già registrato: due run con lo stesso id si fermerebbero a vicenda
+    def start(self, state):
+        cancel = state.get("cancel") or threading.Event()
+        state["cancel"] = cancel
+        with self._lock:
+            if state["id"] in self._active:
+                raise RunIdInUse(state["id"])
+            self._active[state["id"]] = cancel
+        if self._shared is not None and not self._shared.start(state["id"]):
+            with self._lock:
+                self._active.pop(state["id"], None)
+            raise RunIdInUse(state["id"])
+        with self._lock:
+            self.counters["started"] += 1
+        return cancel
+
+    def cancel(self, run_id):
+        with self._lock:
+            cancel = self._active.get(run_id)
+        if cancel is None:
+            return self._shared is not None and self._shared.request_cancel(run_id)
+        cancel.set()
+        return True
+
+    def expected_calls(self):
+        with self._lock:
+            return self._calls_total / self._calls_runs if self._calls_runs else 4.0
+
+    def finish(self, state):
+        cancelled = state["cancel"].is_set() if state.get("cancel") is not None else False
+        state["cancelled"] = cancelled
+        saved = max(0, round(self.expected_calls()) - state.get("n_calls", 0)) if cancelled else 0
+        state["calls_saved"] = saved
+        if self._shared is not None:
+            self._shared.finish(state["id"])
+        with self._lock:
+            self._active.pop(state["id"], None)
+            self.counters["finished"] += 1
+            if cancelled:
+                self.counters["cancelled"] += 1
+                self.counters["calls_saved"] += saved
+            else:
+                self._calls_total += state.get("n_calls", 0)
+                self._calls_runs += 1
+
+    def stats(self):
+        with self._lock:
+            out = dict(self.counters)
+            out["active"] = len(self._active)
+        out["expected_calls"] = round(self.expected_calls(), 2)
+        return out
+
+
+RUNS = RunRegistry()
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# i moduli dell'app si importano piatti, come nel container (WORKDIR /app)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("LLM_CACHE", "0")
@@ -0,0 +1,97 @@
+import json
+
+import pytest
+
+import agents
+from bench.mock_openai import MockState
+
+RULES = [{"decision": "allow", "subject": "professor", "action": "read", "resource": "grades",
+          "purpose": "none", "condition": "none"},
+         {"decision": "deny", "subject": "student", "action": "edit", "resource": "grades",
+          "purpose": "none", "condition": "none"}]
+
+
+@pytest.fixture
+def state(monkeypatch):
+    monkeypatch.setattr(agents, "REFINE_MODE", "patch")
+    monkeypatch.setattr(agents, "_snap_policy", lambda state, policy_json, attack, only=None: policy_json)
+    return {"env": "default", "env_var": {}, "text_preproc": "Professors can read grades.", "n_iter": 0,
+            "n_calls": 0, "max_calls": 10, "max_iter": 3, "has_verified": True, "feedback": None,
+            "policy_json": {"dsarcp": [dict(r) for r in RULES]},
+            "verifier_output": {"status": "incorrect",
+                                "issues": [{"index": 0, "field": "resource", "error": "wrong resource"}]}}
+
+
+def test_patch_skips_malformed_entries(state):
+    msg = {"patch": ["junk", {"index": "0"}, {"index": 1, "fields": {"resource": "x"}},
+                     {"index": 0, "fields": ["resource"]},
+                     {"index": 0, "fields": {"resource": "exam record", "subject": ["x"]}}]}
+    events = []
+    assert agents._patch_apply(state, msg, [0], events.append, None)
+    assert state["policy_json"]["dsarcp"][0]["resource"] == "exam record"
+    assert state["policy_json"]["dsarcp"][0]["subject"] == "professor"
+    assert state["policy_json"]["dsarcp"][1] == RULES[1]
+    assert events[-1]["skipped"] == 4
+
+
+@pytest.mark.parametrize("msg", [{"patch": {"index": 0}}, {"patch": [{"index": 0, "fields": "resource"}]}, ["x"]])
+def test_unusable_patch_falls_back_to_full_refine(state, monkeypatch, msg):
+    calls = []
+    full = {"policy_json": {"dsarcp": [dict(RULES[0], resource="exam record")]}}
+
+    def call_model(state, messages, logger=None, step=None):
+        calls.append(messages[0]["content"])
+        return msg if len(calls) == 1 else full
+    monkeypatch.setattr(agents, "call_model", call_model)
+    events = []
+    agents.agent_generate(state, events.append)
+    assert len(calls) == 2
+    assert calls[0] == agents.SYS_PATCH and calls[1] == agents.SYS_REFINE
+    assert [e["event"] for e in events].count("refine_patch_invalid") == 1
+    assert state["n_iter"] == 1
+    assert state["policy_json"]["dsarcp"][0]["resource"] == "exam record"
+
+
+ENV = {"subjects": ["professor", "student"], "actions": ["read"], "resources": ["grades"],
+       "purposes": [], "conditions": []}
+
+
+def vocab_state(env_var):
+    return {"env": "uni", "env_var": env_var, "text_preproc": "Professors can read grades.", "n_iter": 0,
+            "feedback": None, "verifier_output": None, "has_verified": False}
+
+
+@pytest.fixture
+def environment(monkeypatch):
+    sections = dict(ENV)
+    monkeypatch.setattr(agents, "read_entities", lambda env: sections)
+    monkeypatch.setattr(agents, "_vocab_memo", {})
+    return sections
+
+
+def test_snap_vocabulary_follows_env_var(environment):
+    state = vocab_state({"subjects": ["professor"], "actions": ["read"]})
+    assert agents._snap_vocab(state) is state["env_var"]
+    for env_var in ({}, {"subjects": [], "actions": []}, None):
+        assert agents._snap_vocab(vocab_state(env_var)) is None
+
+
+def test_two_runs_share_a_cacheable_prefix(environment):
+    environment.update({t: [f"{t[:-1]} number {i}" for i in range(150)] for t in ENV})
+    cache = MockState(0)
+    runs = [vocab_state({"subjects": ["professor"], "actions": ["read"]}), vocab_state({})]
+    runs[1]["text_preproc"] = "Students cannot edit grades."
+    first, second = (agents._generate_messages(state, None)[0] for state in runs)
+    assert [m["role"] for m in first] == [m["role"] for m in second] == ["system", "system", "user"]
+    assert json.dumps(first[:2]) == json.dumps(second[:2]) and first[2] != second[2]
+    assert "(truncated)" in first[1]["content"] and len(first[1]["content"]) <= agents.PROMPT_VOCAB_MAX_CHARS
+    cache.cached(first)
+    assert cache.cached(second) >= 1024
+
+
+def test_vocabulary_cut_is_balanced_and_bounded(environment):
+    environment["subjects"] = [f'subject "{i}"' for i in range(1000)]
+    vocab, truncated = agents._capped_vocab(environment, 400)
+    assert truncated and vocab["actions"] == ["read"] and vocab["resources"] == ["grades"]
+    assert 0 < len(vocab["subjects"]) < 1000 and len(json.dumps(vocab, ensure_ascii=False)) <= 400
+    assert agents._capped_vocab(ENV, 4000) == (ENV, False)
@@ -0,0 +1,79 @@
+import asyncio
+import sqlite3
+import threading
+import types
+
+import cache
+from cache import ResponseCache, cache_key
+
+MESSAGES = [{"role": "system", "content": "sys"}, {"role": "user", "content": '{"a": 1}'}]
+
+
+def test_verify_and_refine_are_not_cached():
+    assert cache_key("m", MESSAGES, "verify") is None
+    assert cache_key("m", MESSAGES, "refine") is None
+    assert cache_key("m", MESSAGES, "generate") == cache_key("m", MESSAGES)
+
+
+def test_hits_touch_accessed_at_in_batches(tmp_path):
+    cache = ResponseCache(str(tmp_path / "c.sqlite3"), memory_entries=2)
+    for i in range(4):
+        cache.put(f"k{i}", f"v{i}")
+    assert cache.get("k0") == "v0"
+    assert cache.get("k3") == "v3"
+    assert cache.get("missing") is None
+    stats = cache.stats()
+    assert (stats["disk_hits"], stats["memory_hits"], stats["misses"]) == (1, 1, 1)
+
+    db = sqlite3.connect(cache.path)
+    touched = "SELECT key FROM responses WHERE accessed_at > created_at ORDER BY key"
+    assert db.execute(touched).fetchall() == []
+    cache.put("k9", "v9")
+    assert db.execute(touched).fetchall() == [("k0",), ("k3",)]
+
+
+def test_expired_entries_are_misses(tmp_path):
+    cache = ResponseCache(str(tmp_path / "c.sqlite3"), ttl=-1)
+    cache.put("k", "v")
+    assert cache.get("k") is None
+    assert cache.stats()["evictions"] == 1
+
+
+def test_memory_hits_flush_touches_without_puts(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "LLM_CACHE_TOUCH_BATCH", 3)
+    c = ResponseCache(str(tmp_path / "c.sqlite3"))
+    for i in range(3):
+        c.put(f"k{i}", f"v{i}")
+    db = sqlite3.connect(c.path)
+    touched = "SELECT key FROM responses WHERE accessed_at > created_at ORDER BY key"
+    assert c.get("k0") == "v0" and c.get("k0") == "v0" and c.get("k1") == "v1"
+    assert c.stats()["memory_hits"] == 3
+    assert db.execute(touched).fetchall() == []
+    assert c.get("k2") == "v2"
+    assert db.execute(touched).fetchall() == [("k0",), ("k1",), ("k2",)]
+
+
+def test_async_cache_access_leaves_the_loop_free(tmp_path, monkeypatch):
+    import agents
+    c = ResponseCache(str(tmp_path / "c.sqlite3"))
+    monkeypatch.setattr(agents, "CACHE", c)
+    monkeypatch.setattr(agents, "LLM_CACHE", True)
+    seen, loop_thread = [], []
+    for name in ("get", "put"):
+        method = getattr(c, name)
+
+        def spy(*args, _method=method):
+            seen.append(threading.current_thread() is loop_thread[0])
+            return _method(*args)
+        monkeypatch.setattr(c, name, spy)
+    response = types.SimpleNamespace(usage=None, choices=[types.SimpleNamespace(
+        message=types.SimpleNamespace(content='{"ok": true}'))])
+
+    async def main():
+        loop_thread.append(threading.current_thread())
+        state = {"n_iter": 0}
+        assert await agents._acache_lookup(state, "k", None, "generate") is None
+        assert await agents._acall_end(state, response, None, "generate", "k") == {"ok": True}
+        assert await agents._acache_lookup(state, "k", None, "generate") == {"ok": True}
+    asyncio.run(main())
+    assert seen == [False, False, False]
@@ -0,0 +1,59 @@
+import pytest
+
+from classifier import VocabMatcher, classify_nlacp, vocab_hits
+
+SECTIONS = {
+    "subjects": ["professor", "student", "administrator", "lab technician"],
+    "actions": ["read", "view", "edit"],
+    "resources": ["grades", "exam record", "document"],
+    "purposes": ["evaluation"],
+    "conditions": ["during office hours"],
+}
+
+
+@pytest.mark.parametrize("text", [
+    "This document may only be read by the professor.",
+    "The following section must be edited only by administrators.",
+    "Hi, students can view grades.",
+    "Questo documento può essere letto solo dal professor.",
+])
+def test_acp_sentences_are_not_boilerplate(text):
+    assert classify_nlacp(text, SECTIONS)["is_nlacp"] is not False
+
+
+@pytest.mark.parametrize("text", [
+    "", "Hi!", "Thanks everyone.", "Table of contents", "Chapter 3", "The following section:", "1.2.3",
+])
+def test_headings_and_greetings_are_boilerplate(text):
+    assert classify_nlacp(text, SECTIONS) == {"is_nlacp": False, "confidence": 0.97, "reason": "boilerplate"}
+
+
+def test_heading_with_vocabulary_goes_to_the_model():
+    verdict = classify_nlacp("Section grades", SECTIONS)
+    assert verdict["is_nlacp"] is None
+
+
+def test_modal_subject_action_resource():
+    verdict = classify_nlacp("A professor can read the exam records.", SECTIONS)
+    assert verdict["is_nlacp"] is True and verdict["confidence"] == 0.95
+
+
+def test_questions_and_plain_text():
+    assert classify_nlacp("Where is the cafeteria?", SECTIONS)["is_nlacp"] is False
+    assert classify_nlacp("The weather is nice today.", SECTIONS)["is_nlacp"] is False
+
+
+def test_vocab_hits_prefixes_and_multiword():
+    hits = vocab_hits("Lab technicians and professore may view exam-records", SECTIONS)
+    assert hits["subjects"] == ["lab technician", "professor"]
+    assert hits["actions"] == ["view"]
+    assert hits["resources"] == ["exam record"]
+    # le parole corte valgono solo uguali o al plurale
+    assert vocab_hits("labor technician", SECTIONS)["subjects"] == []
+    assert vocab_hits("labs technician", SECTIONS)["subjects"] == ["lab technician"]
+
+
+def test_matcher_is_reused_and_sized():
+    matcher = VocabMatcher(SECTIONS)
+    assert vocab_hits("student", matcher)["subjects"] == ["student"]
+    assert matcher.nbytes() > 0
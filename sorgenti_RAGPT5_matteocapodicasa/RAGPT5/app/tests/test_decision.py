@@ -0,0 +1,69 @@
+import pytest
+
+from decision import InvalidRequest, PolicyEngine
+
+RULES = [
+    {"decision": "allow", "subject": "professor", "action": "read", "resource": "grades"},
+    {"decision": "deny", "subject": "none", "action": "read", "resource": "grades", "condition": "exam week"},
+    {"decision": "allow", "subject": "student", "action": "view", "resource": "none", "purpose": "study"},
+    {"decision": "deny", "subject": "student", "action": "view", "resource": "exam record"},
+]
+
+
+def decide(request, **kw):
+    return PolicyEngine(RULES, **kw).decide(request)
+
+
+def test_deny_overrides_allow():
+    req = {"subject": "Professor", "action": "read", "resource": "grades"}
+    assert decide(req) == {"decision": "allow", "applicable": True}
+    assert decide(dict(req, condition="exam  week")) == {"decision": "deny", "applicable": True}
+    assert decide(dict(req, conditions=["other", "exam week"]))["decision"] == "deny"
+    assert decide({"subject": "student", "action": "view", "resource": "exam record", "purpose": "study"}) == \
+        {"decision": "deny", "applicable": True}
+    assert decide({"subject": "student", "action": "view", "resource": "notes", "purpose": "study"}) == \
+        {"decision": "allow", "applicable": True}
+
+
+def test_default_when_nothing_applies():
+    req = {"subject": "student", "action": "edit", "resource": "grades"}
+    assert decide(req) == {"decision": "deny", "applicable": False}
+    assert decide(req, default="allow") == {"decision": "allow", "applicable": False}
+
+
+def test_explain_lists_the_deciding_rules():
+    out = PolicyEngine(RULES).decide({"subject": "professor", "action": "read", "resource": "grades",
+                                      "condition": "exam week"}, explain=True)
+    assert [r["index"] for r in out["rules"]] == [1]
+
+
+@pytest.mark.parametrize("request_", [
+    {"subject": "professor", "action": "read", "resource": "grades", "conditions": "exam week"},
+    {"subject": ["professor"], "action": "read", "resource": "grades"},
+    {"subject": "professor", "conditions": [{"a": 1}]},
+    "professor",
+])
+def test_malformed_requests_are_rejected(request_):
+    with pytest.raises(InvalidRequest):
+        PolicyEngine(RULES).decide(request_)
+
+
+@pytest.mark.parametrize("policy", [["rule"], [{"dsarcp": "rules"}], [{"dsarcp": [{"subject": {"x": 1}}]}],
+                                    [{"dsarcp": ["rule"]}]])
+def test_malformed_policies_are_rejected(policy):
+    with pytest.raises(InvalidRequest):
+        PolicyEngine.from_payloads(policy)
+
+
+def test_evaluate_endpoint_answers_400_on_bad_shapes():
+    from app import app
+    client = app.test_client()
+    policy = {"dsarcp": RULES}
+    ok = client.post("/api/evaluate", json={"policy": policy, "request": {"subject": "professor", "action": "read",
+                                                                          "resource": "grades"}})
+    assert ok.status_code == 200 and ok.get_json()["decision"] == "allow"
+    for body in ({"policy": policy, "request": {"subject": "professor", "conditions": "exam week"}},
+                 {"policy": "rules", "request": {}},
+                 {"policy": [{"dsarcp": [["subject"]]}], "request": {}}):
+        assert client.post("/api/evaluate", json=body).status_code == 400
+    assert client.post("/api/evaluate", json={"environment": 3, "request": {}}).status_code == 404
@@ -0,0 +1,102 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import hedging
+from hedging import Attempt, acall_hedged, call_hedged
+from runs import RunCancelled
+
+
+# primaria ferma finché non viene interrotta, duplicato veloce
+def slow_primary(delay_hedge=0.01):
+    def create(timeout, attempt):
+        if not attempt.hedge:
+            attempt.cancel.wait(10)
+            attempt.check()
+            return "primary"
+        time.sleep(delay_hedge)
+        attempt.usage = "hedge-usage"
+        return "hedge"
+    return create
+
+
+def test_hedge_wins_and_aborts_the_primary():
+    t0 = time.time()
+    response, hedged, won, losers = call_hedged(slow_primary(), 5, 0.1, cancel=threading.Event())
+    assert (response, hedged, won) == ("hedge", True, True)
+    assert time.time() - t0 < 1
+    assert [a.hedge for a in losers] == [False] and losers[0].aborted
+
+
+def test_primary_wins_and_the_hedge_is_a_loser():
+    def create(timeout, attempt):
+        if attempt.hedge:
+            attempt.cancel.wait(timeout)
+            attempt.check()
+        time.sleep(0.2)
+        return "primary"
+    response, hedged, won, losers = call_hedged(create, 5, 0.05, cancel=threading.Event())
+    assert (response, hedged, won) == ("primary", True, False)
+    assert [a.hedge for a in losers] == [True]
+
+
+def test_hedge_needs_admission():
+    admitted = []
+
+    def admit(attempt):
+        admitted.append(attempt)
+        return False
+    with pytest.raises(TimeoutError):
+        call_hedged(slow_primary(), 0.5, 0.05, admit_hedge=admit)
+    assert len(admitted) == 1
+
+
+def test_full_pool_skips_the_hedge(monkeypatch):
+    monkeypatch.setattr(hedging, "_slots", threading.BoundedSemaphore(1))
+    hedging._slots.acquire()
+    with pytest.raises(TimeoutError):
+        call_hedged(slow_primary(), 0.4, 0.05)
+    hedging._slots.release()
+
+
+def test_primary_runs_on_the_caller_thread():
+    seen = []
+
+    def create(timeout, attempt):
+        seen.append(threading.current_thread())
+        return "ok"
+    assert call_hedged(create, 5, None, cancel=threading.Event())[0] == "ok"
+    assert seen == [threading.current_thread()]
+
+
+def test_cancel_interrupts_the_call():
+    cancel = threading.Event()
+    threading.Timer(0.1, cancel.set).start()
+    t0 = time.time()
+    with pytest.raises(RunCancelled):
+        call_hedged(slow_primary(), 5, None, cancel=cancel)
+    assert time.time() - t0 < 1
+
+
+def test_async_hedge_is_admitted_and_accounted():
+    async def create(timeout, attempt):
+        await asyncio.sleep(5 if not attempt.hedge else 0.01)
+        return "hedge" if attempt.hedge else "primary"
+
+    async def admit(attempt):
+        attempt.ticket = "ticket"
+        return True
+
+    response, hedged, won, losers = asyncio.run(acall_hedged(create, 5, 0.05, admit_hedge=admit))
+    assert (response, hedged, won) == ("hedge", True, True)
+    assert [a.hedge for a in losers] == [False]
+
+
+def test_attempt_abort_before_bind():
+    attempt = Attempt(hedge=True)
+    attempt.abort()
+    with pytest.raises(hedging.Aborted):
+        attempt.check()
+    assert attempt.bind(object()) is not None
@@ -0,0 +1,38 @@
+import json
+import random
+
+from jsonstream import ArrayItemStream
+
+RULES = [{"decision": "allow", "subject": f"s{i}", "action": "read", "resource": "r {x}",
+          "condition": 'quoted "}" and \\\\', "extra": {"nested": [i, {"k": "]"}]}} for i in range(40)]
+DOC = json.dumps({"note": "preamble {", "policy_json": {"dsarcp": RULES, "other": [{"x": 1}]},
+                  "tail": [{"decision": "deny"}]})
+
+
+def feed_in_pieces(doc, sizes):
+    parser = ArrayItemStream()
+    items, i = [], 0
+    while i < len(doc):
+        n = sizes()
+        items += parser.feed(doc[i:i + n])
+        i += n
+    return parser, items
+
+
+def test_items_are_emitted_whatever_the_chunking():
+    rng = random.Random(0)
+    for sizes in (lambda: 1, lambda: 7, lambda: rng.randint(1, 50), lambda: len(DOC)):
+        parser, items = feed_in_pieces(DOC, sizes)
+        assert items == RULES
+        assert parser.value() == DOC
+
+
+def test_buffer_holds_only_the_open_item():
+    parser, items = feed_in_pieces(DOC, lambda: 3)
+    assert len(items) == len(RULES)
+    assert len(parser.buf) < len(json.dumps(RULES[0])) * 2
+
+
+def test_other_arrays_and_broken_items_are_ignored():
+    doc = '{"dsarcp": [{"a": 1}], "policy_json": {"dsarcp": [{"a": 1,}, {"b": 2}]}}'
+    assert ArrayItemStream().feed(doc) == [{"b": 2}]
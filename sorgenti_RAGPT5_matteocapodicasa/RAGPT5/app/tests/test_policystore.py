@@ -0,0 +1,51 @@
+import random
+
+import pytest
+
+import policystore
+from policystore import FIELDS, WILDCARD, PolicyStore, canonicalize, covers
+from tools import EntityIndex
+
+
+def test_snap_memo_lives_on_the_index(monkeypatch):
+    indexes = iter([EntityIndex({"subjects": ["professor"]}), EntityIndex({"subjects": ["professional"]})])
+    monkeypatch.setattr(policystore, "environment_index", lambda env: next(indexes))
+    rule = [{"decision": "allow", "subject": "professr", "action": "read"}]
+    # un indice nuovo (anche se all'indirizzo di uno scartato) non riusa gli snap del precedente
+    assert canonicalize(rule, "a")[0][1][0] == "professor"
+    assert canonicalize(rule, "a")[0][1][0] == "professional"
+
+
+# confronto a coppie che l'indice delle generalizzazioni deve riprodurre
+def scan_relations(rules):
+    seen, found = {}, set()
+    for decision, values in rules:
+        h = policystore.rule_hash(decision, values)
+        if h in seen:
+            continue
+        for other, (d, ov) in seen.items():
+            if not all(x == WILDCARD or y == WILDCARD or x == y for x, y in zip(values, ov)):
+                continue
+            if d != decision:
+                found.add(("conflict", h, other) if decision == "deny" else ("conflict", other, h))
+            elif covers(ov, values):
+                found.add(("subsumes", other, h))
+            elif covers(values, ov):
+                found.add(("subsumes", h, other))
+        seen[h] = (decision, values)
+    return found
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2, 3])
+def test_relations_match_pairwise_scan(tmp_path, monkeypatch, seed):
+    rnd = random.Random(seed)
+    domain = ["a", "b", WILDCARD]
+    rules = [(rnd.choice(["allow", "deny"]), tuple(rnd.choice(domain) for _ in FIELDS)) for _ in range(60)]
+    monkeypatch.setattr(policystore, "canonicalize", lambda payload, env: payload)
+    store = PolicyStore(str(tmp_path / "store.sqlite3"))
+    for start in range(0, len(rules), 7):
+        store.ingest("demo", {"id": f"run{start}", "dsarcp": rules[start:start + 7]})
+    found = {("conflict", r["deny"]["hash"], r["allow"]["hash"]) for r in store.conflicts("demo")}
+    found |= {("subsumes", r["general"]["hash"], r["specific"]["hash"]) for r in store.subsumptions("demo")}
+    assert found == scan_relations(rules)
+    assert any(kind == "conflict" for kind, _, _ in found) and any(kind == "subsumes" for kind, _, _ in found)
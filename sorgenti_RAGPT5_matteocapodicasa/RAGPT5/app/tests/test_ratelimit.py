@@ -0,0 +1,128 @@
+import asyncio
+import threading
+import time
+import types
+
+import pytest
+
+from ratelimit import BucketStore, RateLimited, RateLimiter
+from runs import RunCancelled
+
+
+def limiter(tmp_path, **kw):
+    return RateLimiter(store=BucketStore(str(tmp_path / "rl.sqlite3")), **kw)
+
+
+def level(lim, name="tpm"):
+    return lim.store.update({name: lim.limits[name]}, lambda levels: (levels, levels[name]))
+
+
+def usage(total):
+    return types.SimpleNamespace(total_tokens=total)
+
+
+def test_settle_refunds_the_unused_estimate(tmp_path):
+    lim = limiter(tmp_path, rpm=0, tpm=6000)
+    ticket = lim.acquire(1000)
+    assert level(lim) == pytest.approx(5000, abs=5)
+    lim.settle(ticket, usage(300))
+    assert level(lim) == pytest.approx(5700, abs=5)
+
+
+def test_settle_charges_what_the_estimate_missed(tmp_path):
+    lim = limiter(tmp_path, rpm=0, tpm=6000)
+    lim.settle(lim.acquire(1000), usage(1500))
+    assert level(lim) == pytest.approx(4500, abs=5)
+
+
+def test_capped_take_refunds_only_what_was_taken(tmp_path):
+    lim = limiter(tmp_path, rpm=0, tpm=600)
+    ticket = lim.acquire(5000)
+    assert ticket.taken == 600
+    lim.settle(ticket, usage(100))
+    # prima si restituivano 4900 token mai presi: il bucket risultava pieno
+    assert level(lim) == pytest.approx(500, abs=5)
+
+
+def test_deadline_and_cancel(tmp_path):
+    lim = limiter(tmp_path, rpm=1, tpm=0)
+    lim.acquire(10)
+    with pytest.raises(RateLimited):
+        lim.acquire(10, deadline=time.time() + 1)
+    cancel = threading.Event()
+    cancel.set()
+    with pytest.raises(RunCancelled):
+        lim.acquire(10, cancel=cancel)
+    assert lim.stats()["waiting"] == 0
+
+
+def test_async_acquire_leaves_the_loop_free(tmp_path):
+    lim = limiter(tmp_path, rpm=0, tpm=6000)
+    seen = []
+
+    async def main():
+        loop_thread = threading.current_thread()
+        take = lim.store.update
+
+        def update(limits, fn):
+            seen.append(threading.current_thread() is loop_thread)
+            return take(limits, fn)
+        lim.store.update = update
+        ticket = await lim.aacquire(1000)
+        await lim.asettle(ticket, usage(1000))
+    asyncio.run(main())
+    assert seen == [False, False]
+
+
+def test_interrupted_call_refunds_the_unused_completion(tmp_path):
+    lim = limiter(tmp_path, rpm=0, tpm=6000)
+    ticket = lim.acquire(1000)
+    lim.settle(ticket, None, "x" * 400)
+    # prompt stimato (1000 - 800) + 100 token di testo arrivato
+    assert level(lim) == pytest.approx(5700, abs=5)
+
+
+def chunk(text):
+    return types.SimpleNamespace(choices=[types.SimpleNamespace(delta=types.SimpleNamespace(content=text))], usage=None)
+
+
+class BrokenStream:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def __iter__(self):
+        yield chunk("x" * 400)
+        raise ConnectionError("reset")
+
+    async def __aiter__(self):
+        yield chunk("x" * 400)
+        raise ConnectionError("reset")
+
+
+@pytest.mark.parametrize("is_async", [False, True])
+def test_broken_stream_settles_its_ticket(tmp_path, monkeypatch, is_async):
+    import agents
+    lim = limiter(tmp_path, rpm=0, tpm=6000)
+    monkeypatch.setattr(agents, "LIMITER", lim)
+    monkeypatch.setattr(agents, "estimate_tokens", lambda messages: 1000)
+
+    async def acreate(*args):
+        return BrokenStream()
+    monkeypatch.setattr(agents, "_stream_create", acreate if is_async else lambda *args: BrokenStream())
+    state = {"id": "r1", "n_iter": 0, "n_calls": 0, "max_calls": 10, "max_iter": 3}
+    messages = [{"role": "user", "content": "{}"}]
+    if is_async:
+        out = asyncio.run(agents.call_model_stream_async(state, messages, step="generate"))
+    else:
+        out = agents.call_model_stream(state, messages, step="generate")
+    assert out is None
+    assert level(lim) == pytest.approx(5700, abs=5)
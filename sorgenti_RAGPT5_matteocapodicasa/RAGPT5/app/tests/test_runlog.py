@@ -0,0 +1,107 @@
+import asyncio
+import os
+import threading
+import time
+
+import pytest
+
+import runlog
+from runlog import RunLog, RunLogStore
+
+
+def wait_for(check, timeout=3):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if check():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+@pytest.fixture
+def workers(tmp_path):
+    # due worker con lo stesso file condiviso
+    path = str(tmp_path / "runlog.sqlite3")
+    stores = [RunLogStore(size=5), RunLogStore(size=5)]
+    for store in stores:
+        store.share(path)
+    return stores
+
+
+def test_resume_on_another_worker(workers):
+    owner, other = workers
+    log = owner.create("r1", threading.Event())
+    for i in range(8):
+        log.append("log", {"i": i})
+    assert wait_for(lambda: other.get("r1") is not None and other.get("r1").seq == 8)
+    remote = other.get("r1")
+    events, missed, done = remote.since(6)
+    assert [e[2]["i"] for e in events] == [6, 7] and not done
+    # solo il ring buffer sopravvive: i primi eventi sono segnalati come persi
+    assert remote.since(0)[1] == 3
+    remote.attach()
+    log.append("done", {"i": 8})
+    log.close()
+    events, _, done = remote.wait(8, 3)
+    assert [e[2]["i"] for e in events] == [8] and done
+    assert other.get("missing") is None
+
+
+def test_detached_run_is_cancelled_by_the_sweeper(monkeypatch):
+    monkeypatch.setattr(runlog, "RUN_LOG_DETACH", 0.1)
+    monkeypatch.setattr(runlog, "SWEEP", 0.05)
+    store = RunLogStore()
+    cancel = threading.Event()
+    log = store.create("r1", cancel)
+    log.attach()
+    log.detach()
+    assert cancel.wait(2)
+    before = threading.active_count()
+    for i in range(20):
+        other = store.create(f"d{i}", threading.Event())
+        other.attach()
+        other.detach()
+    # nessun thread per client staccato
+    assert threading.active_count() == before
+
+
+def test_remote_reader_keeps_the_run_alive(workers, monkeypatch):
+    monkeypatch.setattr(runlog, "RUN_LOG_DETACH", 0.3)
+    monkeypatch.setattr(runlog, "SWEEP", 0.05)
+    owner, other = workers
+    cancel = threading.Event()
+    log = owner.create("r1", cancel)
+    log.attach()
+    log.detach()
+    assert wait_for(lambda: other.get("r1") is not None)
+    other.get("r1").attach()
+    assert not cancel.wait(0.8)
+
+
+def test_async_reader_is_woken_by_append():
+    log = RunLog("r1")
+
+    async def main():
+        reader = asyncio.ensure_future(log.await_since(0, 5))
+        await asyncio.sleep(0.05)
+        threading.Timer(0.05, log.append, ("log", {"x": 1})).start()
+        t0 = time.time()
+        events, _, _ = await reader
+        return events, time.time() - t0
+    events, elapsed = asyncio.run(main())
+    assert [e[2] for e in events] == [{"x": 1}] and elapsed < 1
+
+
+def test_dead_owner_ends_the_remote_log(tmp_path):
+    store = RunLogStore()
+    store.share(str(tmp_path / "runlog.sqlite3"))
+    store._shared.write([("create", "r1", 2 ** 22 + 12345, ""), ("event", "r1", 1, "log", {"x": 1})])
+    assert store.get("r1").done
+    assert os.path.exists(store._shared.path)
+
+
+def test_unknown_resume_is_404_not_a_new_run():
+    from app import app
+    client = app.test_client()
+    r = client.get("/api/log?text=hello&environment=universita", headers={"Last-Event-ID": "gone:4"})
+    assert r.status_code == 404 and r.get_json()["id"] == "gone"
@@ -0,0 +1,61 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from runs import BOOT_ID, RunIdInUse, RunRegistry, SharedRuns, _alive, process_token
+
+needs_proc = pytest.mark.skipif(not os.path.isdir("/proc/self"), reason="process tokens need /proc")
+
+
+def test_duplicate_run_id_is_rejected():
+    runs = RunRegistry()
+    first = {"id": "r1", "n_calls": 0}
+    runs.start(first)
+    with pytest.raises(RunIdInUse):
+        runs.start({"id": "r1", "n_calls": 0})
+    assert not first["cancel"].is_set()
+    runs.finish(first)
+    runs.start({"id": "r1", "n_calls": 0})
+
+
+def test_duplicate_run_id_across_workers(tmp_path):
+    shared = SharedRuns(str(tmp_path / "runs.sqlite3"))
+    assert shared.start("r1")
+    assert not shared.start("r1")
+    shared.finish("r1")
+    assert shared.start("r1")
+
+
+@needs_proc
+def test_reused_pid_is_not_the_owner(tmp_path):
+    shared = SharedRuns(str(tmp_path / "runs.sqlite3"))
+    assert shared.start("r1")
+    # la riga sopravvive a un riavvio e il pid ora è di un altro processo
+    shared._run("UPDATE active SET owner = ?", (f"{BOOT_ID}:1",))
+    assert not shared.request_cancel("r1")
+    assert shared.start("r1")
+
+
+@needs_proc
+def test_master_start_purges_the_previous_generation(tmp_path):
+    shared = SharedRuns(str(tmp_path / "runs.sqlite3"))
+    for run_id in ("live", "old-master", "dead-worker"):
+        assert shared.start(run_id)
+    shared._run("UPDATE active SET master = ? WHERE id = 'old-master'", (f"{BOOT_ID}:1",))
+    shared._run("UPDATE active SET pid = ? WHERE id = 'dead-worker'", (2 ** 22 + 12345,))
+    assert shared.purge_stale() == 2
+    assert [r[0] for r in shared._run("SELECT id FROM active")] == ["live"]
+
+
+@needs_proc
+def test_process_token_tells_processes_apart():
+    assert process_token(os.getpid()) == process_token(os.getpid())
+    child = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(5)"])
+    try:
+        assert process_token(child.pid) not in ("", process_token(os.getpid()))
+        assert _alive(child.pid, process_token(child.pid)) and not _alive(child.pid, process_token(os.getpid()))
+    finally:
+        child.kill()
+        child.wait()
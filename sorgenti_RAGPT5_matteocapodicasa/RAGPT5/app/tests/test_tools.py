@@ -0,0 +1,80 @@
+import random
+
+import pytest
+
+import tools
+from bench.micro import queries_for, synthetic_vocab
+from environments import EnvironmentRegistry
+from tools import EntityIndex, NgramPostings, VocabIndex, ratio
+
+
+# la scansione completa che l'indice deve riprodurre
+def scan_nearest(value, vocab, threshold=0.6):
+    best, best_r = None, 0.0
+    for item in vocab:
+        r = ratio(value, item)
+        if r > best_r:
+            best_r, best = r, item
+    return best if best and best_r >= threshold else "none"
+
+
+def scan_rank(query, vocab, k=5):
+    scored = sorted(((-ratio(query, s), i) for i, s in enumerate(vocab)))
+    return [vocab[i] for _, i in scored[:k]]
+
+
+@pytest.fixture(scope="module")
+def vocab():
+    return tuple(synthetic_vocab(1000))
+
+
+@pytest.mark.parametrize("candidates", [1, 8, 128])
+def test_nearest_matches_full_scan(vocab, candidates):
+    index = VocabIndex(vocab, candidates=candidates)
+    queries = queries_for(list(vocab), 60) + ["", "ra", vocab[10]]
+    assert index.nearest_many(queries) == [scan_nearest(q, vocab) if q else "none" for q in queries]
+
+
+@pytest.mark.parametrize("candidates", [1, 8, 128])
+def test_rank_matches_full_scan(vocab, candidates):
+    index = VocabIndex(vocab, candidates=candidates)
+    for q in queries_for(list(vocab), 15, seed=3):
+        assert index.rank(q, k=5) == scan_rank(q, vocab)
+
+
+def test_sparse_index_matches_dense(vocab, monkeypatch):
+    monkeypatch.setattr(tools, "NGRAM_DENSE_MAX", 100)
+    sparse = VocabIndex(vocab, candidates=4)
+    assert isinstance(sparse.matrix, NgramPostings)
+    assert sparse.nbytes() > 0
+    queries = queries_for(list(vocab), 40, seed=5)
+    assert sparse.nearest_many(queries) == VocabIndex(vocab, candidates=4).nearest_many(queries)
+
+
+def test_ties_keep_vocabulary_order():
+    vocab = ("abcx", "abcy", "abcz") + tuple(f"item {i}" for i in range(50))
+    index = VocabIndex(vocab, candidates=1)
+    assert index.nearest("abc") == scan_nearest("abc", vocab) == "abcx"
+    assert index.rank("abc", k=3) == ["abcx", "abcy", "abcz"]
+
+
+def test_snap_rules_matches_nearest(vocab):
+    rnd = random.Random(7)
+    index = EntityIndex({t: vocab for t in tools.ENTITY_TYPES}, candidates=4)
+    rules = [{f: rnd.choice(vocab)[:-1] for f in EntityIndex.FIELDS} for _ in range(10)]
+    rules.append({"subject": "none", "action": None})
+    for rule, snapped in zip(rules, index.snap_rules(rules)):
+        for field in EntityIndex.FIELDS:
+            value = rule.get(field)
+            expected = "none" if value in (None, "none") else scan_nearest(value, vocab)
+            assert snapped[field] == expected
+
+
+def test_list_helpers_reuse_the_environment_index(tmp_path, monkeypatch):
+    (tmp_path / "demo.txt").write_text("[subjects]\nprofessor\nstudent\n[actions]\nread\n", encoding="utf-8")
+    registry = EnvironmentRegistry(str(tmp_path), budget_mb=0)
+    monkeypatch.setattr("environments.REGISTRY", registry)
+    section = registry.get("demo").sections["subjects"]
+    assert tools._vocab_index(section) is registry.get("demo").index["subjects"]
+    assert tools.nearest("profesor", section) == "professor"
+    assert registry.index_of(list(section)) is None
@@ -0,0 +1,73 @@
+import pytest
+
+import vocabfile
+from bench.micro import queries_for, synthetic_vocab
+from environments import EnvironmentRegistry
+from tools import ENTITY_TYPES, EntityIndex, parse_entities_text
+from vocabfile import CompiledVocab, compile_environment
+
+
+def write_env(path, sections):
+    path.write_text("".join(f"[{t}]\n" + "".join(f"{s}\n" for s in sections.get(t, []))
+                            for t in ENTITY_TYPES), encoding="utf-8")
+
+
+@pytest.fixture
+def env(tmp_path):
+    vocab = synthetic_vocab(600)
+    # "gestione voti" in più tipi: una sola volta nella tabella delle stringhe
+    sections = {"subjects": vocab[:300] + ["gestione voti"], "actions": ["read", "gestione voti"],
+                "resources": vocab[300:], "purposes": [], "conditions": ["èà ünïcode"]}
+    write_env(tmp_path / "demo.txt", sections)
+    return tmp_path, parse_entities_text((tmp_path / "demo.txt").read_text(encoding="utf-8"))
+
+
+def test_round_trip(env):
+    tmp_path, sections = env
+    vocab = CompiledVocab(compile_environment(str(tmp_path / "demo.txt")))
+    assert {t: list(v) for t, v in vocab.sections().items()} == {t: list(sections[t]) for t in ENTITY_TYPES}
+    # 600 voci sintetiche + "gestione voti", "read", "èà ünïcode"
+    assert vocab.array("strings.offsets").size == 603 + 1
+    for t, (lengths, counts) in vocab.profiles().items():
+        assert counts.shape == (len(sections[t]), vocabfile.CHAR_BUCKETS)
+        assert not lengths.flags.writeable and not counts.flags.writeable
+
+
+def test_mapped_lookups_match_in_memory_index(env):
+    tmp_path, sections = env
+    vocab = CompiledVocab(compile_environment(str(tmp_path / "demo.txt")))
+    mapped = EntityIndex(vocab.sections(), candidates=4, matrices=vocab.matrices(), profiles=vocab.profiles())
+    memory = EntityIndex(sections, candidates=4)
+    for t in ("subjects", "resources"):
+        queries = queries_for(list(sections[t]), 40, seed=len(t))
+        assert mapped[t].nearest_many(queries) == memory[t].nearest_many(queries)
+        for q in queries[:10]:
+            assert mapped.rank(t, q, k=5) == memory.rank(t, q, k=5)
+    # niente costruito in memoria privata: matrici e profili restano quelli mappati
+    assert mapped.nbytes() == 0
+    assert not any(mapped[t].profile[1].flags.writeable for t in ENTITY_TYPES)
+
+
+def test_stale_source_falls_back_until_recompiled(env):
+    tmp_path, sections = env
+    compile_environment(str(tmp_path / "demo.txt"))
+    registry = EnvironmentRegistry(str(tmp_path), budget_mb=0)
+    assert registry.get("demo").kind == "compiled"
+
+    sections = dict(sections, actions=["read", "write"])
+    write_env(tmp_path / "demo.txt", sections)
+    snap = registry.get("demo")
+    assert snap.kind == "text" and list(snap.sections["actions"]) == ["read", "write"]
+
+    compile_environment(str(tmp_path / "demo.txt"))
+    snap = registry.get("demo")
+    assert snap.kind == "compiled" and list(snap.sections["actions"]) == ["read", "write"]
+
+
+def test_other_format_version_is_not_mapped(env, monkeypatch):
+    tmp_path, _ = env
+    compile_environment(str(tmp_path / "demo.txt"))
+    monkeypatch.setattr(vocabfile, "VERSION", vocabfile.VERSION + 1)
+    with pytest.raises(ValueError):
+        CompiledVocab(str(tmp_path / "demo.vocab"))
+    assert EnvironmentRegistry(str(tmp_path), budget_mb=0).get("demo").kind == "text"
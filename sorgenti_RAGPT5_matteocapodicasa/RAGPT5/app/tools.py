@@ -1,34 +1,53 @@
 import os
 import json
 import re
+import zlib
 from difflib import SequenceMatcher
 
+import numpy as np
+
 DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+ENTITY_TYPES = ("subjects", "actions", "resources", "purposes", "conditions")
+
+# indice n-gram: dimensione dei vettori (hashing trick) e candidati rivalutati con ratio()
+NGRAM = 2
+NGRAM_DIM = 1024
+SNAP_CANDIDATES = 128
+# oltre questo numero di voci l'indice usa liste invertite invece della matrice densa
+NGRAM_DENSE_MAX = 4096
+# classi di caratteri per il limite superiore di ratio() sulle voci escluse dalla shortlist
+CHAR_BUCKETS = 32
 
 # durante il retrieve si controllano le entità già estrapolate da un ipotetico LDAP
-def parse_entities_file(path):
+def parse_entities_text(text):
     sections = {"subjects": [], "actions": [], "resources": [], "purposes": [], "conditions": []}
     cur = None
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        m = re.match(r"\[(.+)\]", line.lower())
+        if m:
+            key = m.group(1).strip()
+            cur = key if key in sections else None
+            continue
+        if cur:
+            sections[cur].append(line)
+    return sections
+
+def parse_entities_file(path):
     if not os.path.exists(path):
-        return sections
+        return parse_entities_text("")
     with open(path, "r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if not line or line.startswith("#"):
-                continue
-            m = re.match(r"\[(.+)\]", line.lower())
-            if m:
-                key = m.group(1).strip()
-                cur = key if key in sections else None
-                continue
-            if cur:
-                sections[cur].append(line)
-    return sections
+        return parse_entities_text(f.read())
 
+# le sezioni arrivano dal registry (file parsato una volta, ricaricato se cambia)
 def read_entities(environment):
-    filename = f"{environment}.txt"
-    path = os.path.join(DATA_DIR, filename)
-    return parse_entities_file(path)
+    from environments import REGISTRY
+    try:
+        return REGISTRY.get(environment).sections
+    except FileNotFoundError:
+        return parse_entities_text("")
 
 
 def norm(s):
@@ -38,81 +57,330 @@ def norm(s):
 def ratio(a, b):
     return SequenceMatcher(None, norm(a), norm(b)).ratio()
 
+# (riga, colonna) di ogni n-gram di ogni stringa, colonna = hash del n-gram
+def _ngram_cells(strings, n, dim):
+    rows, cols = [], []
+    for i, s in enumerate(strings):
+        s = f" {norm(s)} "
+        for j in range(max(1, len(s) - n + 1)):
+            rows.append(i)
+            cols.append(zlib.crc32(s[j:j + n].encode("utf-8")) % dim)
+    return np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64)
+
+# vettori n-gram di caratteri normalizzati (L2), una riga per stringa
+def ngram_matrix(strings, n=NGRAM, dim=NGRAM_DIM):
+    rows, cols = _ngram_cells(strings, n, dim)
+    mat = np.zeros((len(strings), dim), dtype=np.float32)
+    if len(rows):
+        np.add.at(mat, (rows, cols), 1.0)
+    lengths = np.linalg.norm(mat, axis=1, keepdims=True)
+    np.divide(mat, lengths, out=mat, where=lengths > 0)
+    return mat
+
+# gli stessi vettori come liste invertite per colonna (colptr, righe, valori): per i vocabolari
+# grandi (file compilati) il coseno tocca solo le righe che condividono un n-gram con la query
+def ngram_postings(strings, n=NGRAM, dim=NGRAM_DIM):
+    rows, cols = _ngram_cells(strings, n, dim)
+    cells, counts = np.unique(rows * dim + cols, return_counts=True)
+    r, c = cells // dim, cells % dim
+    counts = counts.astype(np.float64)
+    lengths = np.sqrt(np.bincount(r, weights=counts ** 2, minlength=len(strings)))
+    vals = (counts / lengths[r]).astype(np.float32)
+    order = np.lexsort((r, c))
+    colptr = np.zeros(dim + 1, dtype=np.int64)
+    colptr[1:] = np.cumsum(np.bincount(c, minlength=dim))
+    return colptr, r[order].astype(np.uint32), vals[order]
+
+
+class NgramPostings:
+    def __init__(self, colptr, rows, vals, n_rows):
+        self.colptr = colptr
+        self.rows = rows
+        self.vals = vals
+        self.n_rows = n_rows
+
+    def nbytes(self):
+        return self.colptr.nbytes + self.rows.nbytes + self.vals.nbytes
+
+    # per ogni query (riga di ngram_matrix) gli indici dei c vettori più vicini, non ordinati
+    def top(self, qm, c):
+        out = []
+        for q in qm:
+            dims = np.flatnonzero(q)
+            spans = [(self.colptr[d], self.colptr[d + 1]) for d in dims]
+            scores = np.zeros(self.n_rows)
+            if spans:
+                rows = np.concatenate([self.rows[a:b] for a, b in spans])
+                weights = np.concatenate([self.vals[a:b] * q[d] for (a, b), d in zip(spans, dims)])
+                scores = np.bincount(rows, weights=weights, minlength=self.n_rows)
+            out.append(np.argpartition(-scores, c - 1)[:c])
+        return out
+
+
+# indice su una singola lista di entità: il coseno sui n-gram preseleziona i candidati
+# (una moltiplicazione di matrici), il punteggio finale resta quello di ratio().
+# La shortlist non basta a garantire il risultato: le voci escluse che per lunghezza potrebbero
+# ancora raggiungere il punteggio da battere vengono rivalutate (prima con quick_ratio()), così
+# rank() e nearest() restituiscono esattamente quello della scansione completa.
+# lunghezze e conteggi dei caratteri (per classi, CHAR_BUCKETS) delle voci normalizzate:
+# bastano per i limiti superiori di ratio() senza toccare le stringhe
+def vocab_profile(items):
+    normed = [norm(s) for s in items]
+    lengths = np.fromiter((len(s) for s in normed), dtype=np.int64, count=len(normed))
+    codes = np.frombuffer("".join(normed).encode("utf-32-le"), dtype=np.uint32) % CHAR_BUCKETS
+    rows = np.repeat(np.arange(len(normed)), lengths)
+    counts = np.bincount(rows * CHAR_BUCKETS + codes, minlength=len(normed) * CHAR_BUCKETS)
+    return lengths, counts.reshape(len(normed), CHAR_BUCKETS).astype(np.uint16)
+
+
+class VocabIndex:
+    def __init__(self, items, candidates=SNAP_CANDIDATES, matrix=None, profile=None):
+        self.items = items
+        self.candidates = max(1, candidates)
+        self._matrix = matrix
+        self._owned = matrix is None
+        self._profile = profile
+        self._owned_profile = profile is None
+
+    def __len__(self):
+        return len(self.items)
+
+    # densa fino a NGRAM_DENSE_MAX voci, oltre liste invertite (n x NGRAM_DIM float32 diventa troppo)
+    @property
+    def matrix(self):
+        if self._matrix is None:
+            if len(self.items) > NGRAM_DENSE_MAX:
+                self._matrix = NgramPostings(*ngram_postings(self.items), len(self.items))
+            else:
+                self._matrix = ngram_matrix(self.items)
+        return self._matrix
+
+    # vedi vocab_profile; da un file compilato arriva già pronto (mappato)
+    @property
+    def profile(self):
+        if self._profile is None:
+            self._profile = vocab_profile(self.items)
+        return self._profile
+
+    def shortlist(self, queries, k=None):
+        c = max(self.candidates, k or 0)
+        n = len(self.items)
+        if n <= c:
+            return [range(n)] * len(queries)
+        qm = ngram_matrix(queries)
+        if isinstance(self.matrix, NgramPostings):
+            top = self.matrix.top(qm, c)
+        else:
+            top = np.argpartition(-(qm @ self.matrix.T), c - 1, axis=1)[:, :c]
+        # ordine originale del vocabolario: a parità di ratio vince il primo, come nella scansione
+        return [np.sort(row) for row in top]
+
+    # voci fuori dalla shortlist con ratio() potenzialmente >= cutoff: prima il limite sulle lunghezze
+    # 2*min(la, lb)/(la+lb), poi quello sui caratteri in comune (come quick_ratio(), per classi)
+    def _rest(self, query, idx, cutoff):
+        q = norm(query)
+        lengths, counts = self.profile
+        total = lengths + len(q)
+        bound = np.where(total > 0, 2.0 * np.minimum(lengths, len(q)) / np.maximum(total, 1), 1.0)
+        mask = bound >= cutoff
+        mask[np.asarray(idx, dtype=np.int64)] = False
+        rest = np.flatnonzero(mask)
+        if len(rest):
+            qc = np.bincount(np.frombuffer(q.encode("utf-32-le"), dtype=np.uint32) % CHAR_BUCKETS,
+                             minlength=CHAR_BUCKETS)
+            common = np.minimum(counts[rest], qc).sum(axis=1)
+            rest = rest[2.0 * common / np.maximum(total[rest], 1) >= cutoff]
+        return rest
+
+    # (indice, ratio); con cutoff scarta senza calcolare ratio() le voci che non possono arrivarci
+    def scored(self, query, idx, cutoff=None):
+        q = norm(query)
+        out = []
+        for i in idx:
+            sm = SequenceMatcher(None, q, norm(self.items[i]))
+            if cutoff is not None and sm.quick_ratio() < cutoff:
+                continue
+            out.append((int(i), sm.ratio()))
+        return out
+
+    def _exact(self, query, idx, scored, cutoff):
+        if len(idx) < len(self.items):
+            scored += self.scored(query, self._rest(query, idx, cutoff), cutoff)
+        return scored
+
+    def rank(self, query, k=5):
+        k = max(1, k)
+        idx = self.shortlist([query], k)[0]
+        scored = sorted(self.scored(query, idx), key=lambda x: (-x[1], x[0]))
+        if len(scored) >= k:
+            scored = sorted(self._exact(query, idx, scored, scored[k - 1][1]), key=lambda x: (-x[1], x[0]))
+        return [self.items[i] for i, _ in scored[:k]]
+
+    def nearest_many(self, values, threshold=0.6):
+        out = ["none"] * len(values)
+        todo = [i for i, v in enumerate(values) if v]
+        if not todo or not len(self.items):
+            return out
+        queries = [values[i] for i in todo]
+        for pos, idx in zip(todo, self.shortlist(queries)):
+            scored = self.scored(values[pos], idx)
+            cutoff = max([threshold] + [r for _, r in scored])
+            scored = self._exact(values[pos], idx, scored, cutoff)
+            # come la scansione: il primo con ratio massimo, se > 0
+            best_i, best_r = min(scored, key=lambda x: (-x[1], x[0]), default=(None, 0.0))
+            best = self.items[best_i] if best_i is not None and best_r > 0 else None
+            out[pos] = best if best and best_r >= threshold else "none"
+        return out
+
+    def nearest(self, value, threshold=0.6):
+        return self.nearest_many([value], threshold)[0]
+
+    # memoria propria dell'indice: matrice o liste costruite qui e profilo delle voci
+    # (liste e profilo di un file compilato sono mappati e contano nel file)
+    def nbytes(self):
+        total = sum(a.nbytes for a in self._profile) if self._owned_profile and self._profile is not None else 0
+        if not self._owned or self._matrix is None:
+            return total
+        if isinstance(self._matrix, NgramPostings):
+            return total + self._matrix.nbytes()
+        return total + self._matrix.nbytes
+
+
+# indice di un environment: un VocabIndex per tipo, costruito una volta sola
+class EntityIndex:
+    FIELDS = {
+        "subject": "subjects",
+        "action": "actions",
+        "resource": "resources",
+        "purpose": "purposes",
+        "condition": "conditions",
+    }
+
+    # matrices, profiles: indici n-gram e profili già pronti per tipo (es. dal file compilato)
+    def __init__(self, entities, candidates=SNAP_CANDIDATES, matrices=None, profiles=None):
+        matrices, profiles = matrices or {}, profiles or {}
+        self.types = {t: VocabIndex(entities.get(t, []), candidates, matrices.get(t), profiles.get(t))
+                      for t in ENTITY_TYPES}
+        # (campo, valore) -> valore snappato, per policystore.canonicalize: vive e muore con l'indice
+        self.snapped = {}
+
+    def __getitem__(self, tipo):
+        return self.types[tipo]
+
+    def rank(self, tipo, query, k=5):
+        return self.types[tipo].rank(query, k)
+
+    def nearest(self, tipo, value, threshold=0.6):
+        return self.types[tipo].nearest(value, threshold)
+
+    # costruisce subito le matrici, invece che alla prima query di ogni tipo
+    def build(self):
+        for index in self.types.values():
+            index.matrix
+        return self
+
+    def nbytes(self):
+        return sum(index.nbytes() for index in self.types.values())
+
+    # snap di tutti i campi di tutte le regole: una sola query batch per tipo
+    def snap_rules(self, rules, fields=tuple(FIELDS), threshold=0.6):
+        out = [{} for _ in rules]
+        for field in fields:
+            values = [r.get(field) for r in rules]
+            todo = [i for i, v in enumerate(values) if v is not None and v != "none"]
+            for i in range(len(rules)):
+                out[i][field] = "none"
+            snapped = self.types[self.FIELDS[field]].nearest_many([str(values[i]) for i in todo], threshold)
+            for i, v in zip(todo, snapped):
+                out[i][field] = v
+        return out
+
+
+# indice di una lista: quello dell'environment residente da cui viene (vive e viene scartato con il suo
+# snapshot, contato nel budget del registry), altrimenti uno costruito per la chiamata
+def _vocab_index(items):
+    from environments import REGISTRY
+    index = REGISTRY.index_of(items)
+    return index if index is not None else VocabIndex(tuple(items))
+
+def environment_index(environment):
+    from environments import REGISTRY
+    try:
+        return REGISTRY.get(environment).index
+    except FileNotFoundError:
+        return EntityIndex({})
+
+def vocab_entity_index(vocab):
+    return EntityIndex({t: tuple(vocab.get(t, [])) for t in ENTITY_TYPES})
+
+
 # similarità del coseno 5k
 def rank_entities(query, items, k=5):
-    scored = sorted([(it, ratio(query, it)) for it in items], key=lambda x: x[1], reverse=True)
-    return [t for t, _ in scored[:max(1, k)]]
+    return _vocab_index(items).rank(query, k)
 
 #  nearest
 def nearest(value, vocab, threshold=0.6):
     if not value or not vocab:
         return "none"
-    best = None
-    best_r = 0.0
-    for it in vocab:
-        r = ratio(value, it)
-        if r > best_r:
-            best_r, best = r, it
-    return best if best and best_r >= threshold else "none"
+    return _vocab_index(vocab).nearest(value, threshold)
 
-# Step 4 
-def ensure_policy_parameters(policy_json, environment, vocab=None):
+def _decision(rule):
+    return rule.get("decision", "deny") if rule.get("decision") in ("allow", "deny") else "deny"
+
+def _snap_index(environment, vocab):
     if vocab and isinstance(vocab, dict):
-        entities = {
-            "subjects": vocab.get("subjects", []),
-            "actions": vocab.get("actions", []),
-            "resources": vocab.get("resources", []),
-            "purposes": vocab.get("purposes", []),
-            "conditions": vocab.get("conditions", []),
-        }
-    else:
-        entities = read_entities(environment)
-
-    #return nearest
-    def snap(v, tipo):
-        if v is None or v == "none":
-            return "none"
-        return nearest(str(v), entities.get(tipo, []))
+        return vocab_entity_index(vocab)
+    return environment_index(environment)
+
+# snap dei soli campi cambiati da una patch di refine ({indice: campi}); il resto delle regole è già snappato
+def _snap_changed(index, dsarcp, only, fields):
+    rules = [dict(r) for r in dsarcp]
+    for field in fields:
+        todo = sorted(i for i, changed in only.items() if field in changed)
+        if todo:
+            for i, s in zip(todo, index.snap_rules([dsarcp[i] for i in todo], fields=(field,))):
+                rules[i][field] = s[field]
+    for i, changed in only.items():
+        if "decision" in changed:
+            rules[i]["decision"] = _decision(dsarcp[i])
+    return {"dsarcp": rules}
+
+# Step 4 
+def ensure_policy_parameters(policy_json, environment, vocab=None, only=None):
+    index = _snap_index(environment, vocab)
+    dsarcp = policy_json.get("dsarcp", [])
+    if only is not None:
+        return _snap_changed(index, dsarcp, only, tuple(EntityIndex.FIELDS))
+    snapped = index.snap_rules(dsarcp)
 
     rules = []
-    for r in policy_json.get("dsarcp", []):
+    for r, s in zip(dsarcp, snapped):
         rules.append({
-            "decision": r.get("decision", "deny") if r.get("decision") in ("allow", "deny") else "deny",
-            "subject":   snap(r.get("subject"), "subjects"),
-            "action":    snap(r.get("action"), "actions"),
-            "resource":  snap(r.get("resource"), "resources"),
-            "purpose":   snap(r.get("purpose"), "purposes"),
-            "condition": snap(r.get("condition"), "conditions"),
+            "decision": _decision(r),
+            "subject":   s["subject"],
+            "action":    s["action"],
+            "resource":  s["resource"],
+            "purpose":   s["purpose"],
+            "condition": s["condition"],
         })
     return {"dsarcp": rules}
 
 # Step 4 
-def ensure_sar(policy_json, environment, vocab=None):
-    if vocab and isinstance(vocab, dict):
-        entities = {
-            "subjects": vocab.get("subjects", []),
-            "actions": vocab.get("actions", []),
-            "resources": vocab.get("resources", []),
-            "purposes": vocab.get("purposes", []),
-            "conditions": vocab.get("conditions", []),
-        }
-    else:
-        entities = read_entities(environment)
-
-    #return nearest
-    def snap(v, tipo):
-        if v is None or v == "none":
-            return "none"
-        return nearest(str(v), entities.get(tipo, []))
+def ensure_sar(policy_json, environment, vocab=None, only=None):
+    index = _snap_index(environment, vocab)
+    dsarcp = policy_json.get("dsarcp", [])
+    if only is not None:
+        return _snap_changed(index, dsarcp, only, ("subject", "action", "resource"))
+    snapped = index.snap_rules(dsarcp, fields=("subject", "action", "resource"))
 
     rules = []
-    for r in policy_json.get("dsarcp", []):
+    for r, s in zip(dsarcp, snapped):
         rules.append({
-            "decision": r.get("decision", "deny") if r.get("decision") in ("allow", "deny") else "deny",
-            "subject":   snap(r.get("subject"), "subjects"),
-            "action":    snap(r.get("action"), "actions"),
-            "resource":  snap(r.get("resource"), "resources"),
+            "decision": _decision(r),
+            "subject":   s["subject"],
+            "action":    s["action"],
+            "resource":  s["resource"],
             "purpose":   r.get("purpose"),
             "condition": r.get("condition"),
         })
-    return {"dsarcp": rules}
\ No newline at end of file
+    return {"dsarcp": rules}
@@ -0,0 +1,151 @@
+import os
+import sys
+import json
+import mmap
+from collections.abc import Sequence
+
+import numpy as np
+
+from tools import CHAR_BUCKETS, ENTITY_TYPES, NGRAM, NGRAM_DIM, parse_entities_text, ngram_postings, vocab_profile
+
+# Formato compilato di un environment (data/<env>.vocab), letto con mmap:
+#   MAGIC | lunghezza header (uint32) | header JSON | array allineati a 8 byte
+# Array: tabella delle stringhe (blob utf-8 + offset, ogni stringa una volta sola),
+# per tipo gli id delle sue voci, le liste invertite n-gram (colptr, righe, valori) e il profilo
+# (lunghezze e conteggi per classe di carattere, vedi tools.vocab_profile).
+# Le pagine del file sono condivise tra i worker; le stringhe si decodificano solo quando servono.
+#   python vocabfile.py data/universita.txt [data/altro.txt ...]
+
+MAGIC = b"RGPVOCAB"
+VERSION = 2
+
+
+def compiled_path(txt_path):
+    return os.path.splitext(txt_path)[0] + ".vocab"
+
+
+def source_stamp(st):
+    return [st.st_mtime_ns, st.st_size]
+
+
+def compile_environment(src, dst=None):
+    dst = dst or compiled_path(src)
+    with open(src, "rb") as f:
+        st = os.fstat(f.fileno())
+        sections = parse_entities_text(f.read().decode("utf-8"))
+
+    # tabella delle stringhe interned: una voce presente in più tipi è scritta una volta sola
+    ids, strings = {}, []
+    for t in ENTITY_TYPES:
+        for s in sections[t]:
+            if s not in ids:
+                ids[s] = len(strings)
+                strings.append(s)
+    encoded = [s.encode("utf-8") for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.uint64)
+    offsets[1:] = np.cumsum([len(b) for b in encoded], dtype=np.uint64)
+
+    arrays = {"strings.blob": np.frombuffer(b"".join(encoded), dtype=np.uint8),
+              "strings.offsets": offsets}
+    for t in ENTITY_TYPES:
+        colptr, rows, vals = ngram_postings(sections[t])
+        arrays[f"{t}.ids"] = np.asarray([ids[s] for s in sections[t]], dtype=np.uint32)
+        arrays[f"{t}.colptr"] = colptr
+        arrays[f"{t}.rows"] = rows
+        arrays[f"{t}.vals"] = vals
+        lengths, counts = vocab_profile(sections[t])
+        arrays[f"{t}.lengths"] = lengths
+        arrays[f"{t}.chars"] = counts.ravel()
+
+    header = {"version": VERSION, "ngram": NGRAM, "dim": NGRAM_DIM, "buckets": CHAR_BUCKETS,
+              "source": source_stamp(st),
+              "counts": {t: len(sections[t]) for t in ENTITY_TYPES}, "arrays": {}}
+    # gli offset degli array dipendono dalla lunghezza dell'header: si ricalcola finché è stabile
+    blob = b""
+    while True:
+        pos = _align(len(MAGIC) + 4 + len(blob))
+        for name, arr in arrays.items():
+            header["arrays"][name] = [pos, arr.dtype.str, int(arr.size)]
+            pos = _align(pos + arr.nbytes)
+        new, blob = blob, json.dumps(header).encode("utf-8")
+        if len(new) == len(blob):
+            break
+
+    tmp = f"{dst}.tmp{os.getpid()}"
+    with open(tmp, "wb") as f:
+        f.write(MAGIC)
+        f.write(len(blob).to_bytes(4, "little"))
+        f.write(blob)
+        for name, arr in arrays.items():
+            f.write(b"\0" * (header["arrays"][name][0] - f.tell()))
+            f.write(arr.tobytes())
+    # rename atomico: chi ha già mappato il vecchio file continua a leggerlo
+    os.replace(tmp, dst)
+    return dst
+
+
+def _align(n, to=8):
+    return (n + to - 1) // to * to
+
+
+# voci di un tipo, decodificate a richiesta dal blob mappato
+class MappedStrings(Sequence):
+    def __init__(self, blob, offsets, ids):
+        self.blob = blob
+        self.offsets = offsets
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        sid = int(self.ids[i])
+        return bytes(self.blob[int(self.offsets[sid]):int(self.offsets[sid + 1])]).decode("utf-8")
+
+
+class CompiledVocab:
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path}: not a compiled environment")
+        n = int.from_bytes(self._mm[len(MAGIC):len(MAGIC) + 4], "little")
+        self.header = json.loads(self._mm[len(MAGIC) + 4:len(MAGIC) + 4 + n].decode("utf-8"))
+        if self.header.get("version") != VERSION or self.header.get("ngram") != NGRAM \
+                or self.header.get("dim") != NGRAM_DIM or self.header.get("buckets") != CHAR_BUCKETS:
+            raise ValueError(f"{path}: compiled with different parameters, recompile it")
+        self.nbytes = len(self._mm)
+
+    def array(self, name):
+        offset, dtype, count = self.header["arrays"][name]
+        return np.frombuffer(self._mm, dtype=np.dtype(dtype), count=count, offset=offset)
+
+    @property
+    def source(self):
+        return tuple(self.header["source"])
+
+    def sections(self):
+        blob, offsets = self.array("strings.blob"), self.array("strings.offsets")
+        return {t: MappedStrings(blob, offsets, self.array(f"{t}.ids")) for t in ENTITY_TYPES}
+
+    def matrices(self):
+        from tools import NgramPostings
+        return {t: NgramPostings(self.array(f"{t}.colptr"), self.array(f"{t}.rows"), self.array(f"{t}.vals"),
+                                 self.header["counts"][t])
+                for t in ENTITY_TYPES}
+
+    # profili per VocabIndex: viste in sola lettura, nessuna stringa decodificata
+    def profiles(self):
+        return {t: (self.array(f"{t}.lengths"), self.array(f"{t}.chars").reshape(-1, CHAR_BUCKETS))
+                for t in ENTITY_TYPES}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.exit("usage: python vocabfile.py data/<env>.txt [...]")
+    for src in sys.argv[1:]:
+        dst = compile_environment(src)
+        print(f"{src} -> {dst} ({os.path.getsize(dst)} bytes)")